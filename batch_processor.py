@@ -14,163 +14,335 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException, WebDriverException, NoSuchElementException
 
 # Import solver từ file cục bộ
-from captcha_solver import solve_captcha
+from captcha_solver import solve_captcha_with_confidence, reload_if_changed
+from page_readiness import (captcha_src_changed, ReadinessTracker, CAPTCHA_SRC_PREFIX,
+                            CAPTCHA_SLEEP_BASELINE, PAGE_RELOAD_SLEEP_BASELINE)
+from run_metrics import SpanRecorder
+from failed_captcha_store import open_failed_captcha_store, KIND_WRONG, KIND_TIMEOUT
 
 URL = "https://www.customs.gov.vn/index.jsp?pageId=136&cid=93"
 FAILED_CAPTCHA_FOLDER = "failed_captchas"
 MAX_RETRIES_PER_TK = 5  # Tăng số lần thử lại CAPTCHA
 MA_DOANH_NGHIEP = "3700482964"
 SO_CMT = "079172041842"
+WRONG_CAPTCHA_XPATH = "//*[contains(text(), 'Sai mã kiểm tra')]"
 
-def run_batch_processing(so_tk_list, stop_event):
+# Tài nguyên không cần cho form tra cứu, ảnh CAPTCHA (data URI) và bảng kết quả
+DEFAULT_BLOCKED_URL_PATTERNS = [
+    "*.css", "*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot",
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.svg", "*.ico", "*.webp", "*.mp4",
+    "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*",
+    "*facebook.net*", "*facebook.com*", "*youtube.com*", "*fonts.googleapis.com*", "*fonts.gstatic.com*",
+]
+DEFAULT_BROWSER_SETTINGS = {
+    'headless': False,
+    'block_resources': False,
+    'disable_images': False,
+    'blocked_url_patterns': DEFAULT_BLOCKED_URL_PATTERNS,
+    'lookup_url': URL,  # Đổi sang địa chỉ máy chủ giả lập (mock_portal.py) khi đo hiệu năng
+}
+
+def create_driver(browser_settings=None):
     """
-    Hàm xử lý tra cứu hàng loạt với logic chờ đợi và xử lý lỗi được cải tiến.
+    Khởi tạo trình duyệt Chrome dùng cho tra cứu theo mục 'browser' trong app_config.json:
+    - headless: chạy ẩn.
+    - block_resources: chặn ở mức CDP các URL trong `blocked_url_patterns` (CSS, font, ảnh, quảng cáo...).
+    - disable_images: tắt tải ảnh; ảnh CAPTCHA là data URI nên vẫn đọc được thuộc tính src.
     """
-    os.makedirs(FAILED_CAPTCHA_FOLDER, exist_ok=True)
+    settings = {**DEFAULT_BROWSER_SETTINGS, **(browser_settings or {})}
     options = Options()
-    # options.add_argument("--headless") # Bỏ comment để chạy ẩn
+    if settings['headless']:
+        options.add_argument("--headless=new")
+        options.add_argument("--window-size=1280,720")
     options.add_argument("--disable-gpu")
     options.add_argument("--log-level=3")
     options.add_experimental_option('excludeSwitches', ['enable-logging'])
-    
-    driver = None
-    total_tk = len(so_tk_list)
+    if settings['block_resources'] or settings['disable_images']:
+        # Không chờ tải xong ảnh/stylesheet, chỉ cần DOM sẵn sàng
+        options.page_load_strategy = 'eager'
+        options.add_argument("--disable-extensions")
+    if settings['disable_images']:
+        options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+
+    driver = webdriver.Chrome(options=options)
+    if settings['block_resources']:
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': settings['blocked_url_patterns']})
+    return driver
+
+def serve_cached_results(so_tk_list, result_cache):
+    """
+    Sinh sự kiện RESULT (có 'cached': True) cho các tờ khai còn kết quả hợp lệ trong bộ nhớ.
+    Giá trị trả về (dùng với `yield from`) là danh sách tờ khai còn phải tra cứu.
+    """
+    if not result_cache:
+        return list(so_tk_list)
+    remaining = []
+    for so_tk in so_tk_list:
+        cached_data = result_cache.get(so_tk)
+        if cached_data:
+            yield {'status': 'RESULT', 'so_tk': so_tk, 'data': cached_data, 'cached': True}
+        else:
+            remaining.append(so_tk)
+    if len(remaining) < len(so_tk_list):
+        yield {'status': 'PROGRESS', 'message': f'Lấy {len(so_tk_list) - len(remaining)} tờ khai từ bộ nhớ kết quả, còn {len(remaining)} tờ khai cần tra cứu.', 'value': 0}
+    return remaining
+
+def lookup_url_from(browser_settings):
+    """Địa chỉ trang tra cứu theo mục 'browser' (mặc định là cổng hải quan thật)."""
+    return {**DEFAULT_BROWSER_SETTINGS, **(browser_settings or {})}['lookup_url']
+
+def load_lookup_page(driver, rate_limiter=None, url=URL):
+    """Tải (lại) trang tra cứu, tính là một request tới cổng hải quan."""
+    if rate_limiter:
+        rate_limiter.acquire()
+    driver.get(url)
+
+def save_failed_captcha(img_data, so_tk, predicted_label, kind=KIND_WRONG):
+    """Lưu ảnh CAPTCHA giải sai (mỗi nội dung ảnh một lần) để kiểm tra lại và huấn luyện bổ sung."""
+    open_failed_captcha_store(FAILED_CAPTCHA_FOLDER).add(img_data, so_tk, predicted_label, kind)
+
+def refresh_captcha(driver):
+    """Yêu cầu trang tải CAPTCHA mới; trang web không tự làm mới sau khi nhập sai."""
+    driver.find_element(By.CSS_SELECTOR, 'button[onclick="getCaptcha()"]').click()
+
+def lookup_declaration(driver, wait, so_tk, stop_event, progress_value, result_cache=None, rate_limiter=None, readiness=None,
+                       confidence_gate=None, lookup_url=URL):
+    """
+    Tra cứu một tờ khai trên trang đã được tải sẵn trong `driver`.
+    Sinh ra các sự kiện PROGRESS/ERROR/RESULT/FINAL_ERROR; kết thúc ngay sau STOPPED hoặc FATAL_ERROR.
+    Sự kiện RESULT kèm 'wait_saved': số giây tiết kiệm ở mỗi lần thử so với sleep cố định.
+    Nếu có `confidence_gate`, dự đoán kém tin cậy không được gửi mà lấy CAPTCHA mới ngay
+    (không tính vào số lần thử), và kết quả mỗi lần gửi được ghi lại để chỉnh ngưỡng.
+    Sự kiện cuối cùng của tờ khai (RESULT/FINAL_ERROR/ERROR) kèm 'metrics': thời gian từng giai đoạn
+    và số lần gửi/đúng/sai/bỏ qua (xem run_metrics).
+    """
+    readiness = readiness or ReadinessTracker()
+    new_version = reload_if_changed()
+    if new_version:
+        yield {'status': 'PROGRESS', 'message': f'Đã chuyển sang model CAPTCHA mới ({new_version}).', 'value': progress_value}
+    stale_captcha_src = None  # src của ảnh CAPTCHA đã dùng, khi đã yêu cầu ảnh mới
+    wait_saved = []
+    skips_left = confidence_gate.settings['max_skips_per_tk'] if confidence_gate else 0
+    spans = SpanRecorder()
+    counts = {'attempts': 0, 'correct': 0, 'wrong': 0, 'skipped': 0}
     try:
-        yield {'status': 'PROGRESS', 'message': 'Đang khởi tạo trình duyệt...', 'value': 0}
-        driver = webdriver.Chrome(options=options)
-        # Tăng thời gian chờ chính lên 15 giây
-        wait = WebDriverWait(driver, 15)
-        yield {'status': 'PROGRESS', 'message': f'Đang tải trang: {URL}...', 'value': 0}
-        driver.get(URL)
+        # 1. Điền thông tin vào form
+        so_tk_input = wait.until(EC.presence_of_element_located((By.ID, "soTK")))
+        so_tk_input.clear()
+        driver.find_element(By.ID, "maDN").clear()
+        driver.find_element(By.ID, "soCMT").clear()
         
-        for index, so_tk in enumerate(so_tk_list):
+        so_tk_input.send_keys(so_tk)
+        driver.find_element(By.ID, "maDN").send_keys(MA_DOANH_NGHIEP)
+        driver.find_element(By.ID, "soCMT").send_keys(SO_CMT)
+
+        for attempt in range(MAX_RETRIES_PER_TK):
             if stop_event.is_set():
                 yield {'status': 'STOPPED', 'message': 'Người dùng đã yêu cầu dừng.'}
                 return
+                
+            yield {'status': 'PROGRESS', 'message': f'Tờ khai {so_tk}: Lần thử CAPTCHA {attempt + 1}/{MAX_RETRIES_PER_TK}...', 'value': progress_value}
+            # Chờ đến khi ảnh CAPTCHA mới thực sự được tải về (thay cho sleep cố định 1 giây)
+            with spans.span('captcha_wait'):
+                captcha_element, saved = readiness.wait_for(wait, captcha_src_changed(stale_captcha_src), CAPTCHA_SLEEP_BASELINE)
+            wait_saved.append(round(saved, 3))
+            
+            # 2. Giải CAPTCHA
+            img_src = captcha_element.get_attribute('src')
+            base64_string = img_src.split(CAPTCHA_SRC_PREFIX)[1]
+            img_data = base64.b64decode(base64_string)
+            with spans.span('inference'):
+                predicted_label, _, score = solve_captcha_with_confidence(img_data)
 
-            progress_value = int(((index) / total_tk) * 100)
-            yield {'status': 'PROGRESS', 'message': f'Bắt đầu xử lý tờ khai {index + 1}/{total_tk}: {so_tk}', 'value': progress_value}
+            # Dự đoán kém tin cậy gần như chắc chắn sai: lấy CAPTCHA mới ngay thay vì gửi và chờ thông báo lỗi
+            while predicted_label and skips_left and confidence_gate.should_skip(score):
+                skips_left -= 1
+                counts['skipped'] += 1
+                yield {'status': 'PROGRESS', 'message': f'Tờ khai {so_tk}: Độ tin cậy {score:.2f} dưới ngưỡng {confidence_gate.threshold:.2f}, lấy CAPTCHA mới.', 'value': progress_value}
+                refresh_captcha(driver)
+                with spans.span('captcha_wait'):
+                    captcha_element, saved = readiness.wait_for(wait, captcha_src_changed(img_src), CAPTCHA_SLEEP_BASELINE)
+                wait_saved.append(round(saved, 3))
+                img_src = captcha_element.get_attribute('src')
+                img_data = base64.b64decode(img_src.split(CAPTCHA_SRC_PREFIX)[1])
+                with spans.span('inference'):
+                    predicted_label, _, score = solve_captcha_with_confidence(img_data)
+            
+            if not predicted_label:
+                yield {'status': 'ERROR', 'message': f'Tờ khai {so_tk}: Lần {attempt + 1} không giải được CAPTCHA. Lấy CAPTCHA mới.'}
+                refresh_captcha(driver)
+                stale_captcha_src = img_src
+                continue
+
+            # 3. Điền CAPTCHA và nhấn nút
+            captcha_input_element = driver.find_element(By.ID, "check-input")
+            # Sử dụng Javascript để điền giá trị, ổn định hơn send_keys
+            driver.execute_script(f"arguments[0].value = '{predicted_label}';", captcha_input_element)
+            
+            # Lấy tham chiếu đến bảng kết quả *cũ* (nếu có) trước khi nhấn
+            try:
+                old_result_table = driver.find_element(By.CLASS_NAME, "tbl-TTTK")
+            except NoSuchElementException:
+                old_result_table = None
+            # ... và thông báo lỗi của lần thử trước: nó vẫn nằm trên trang cho đến khi có phản hồi mới
+            old_errors = driver.find_elements(By.XPATH, WRONG_CAPTCHA_XPATH)
+            old_error = old_errors[0] if old_errors else None
 
+            # Giới hạn tốc độ chung cho mọi trình duyệt trước khi gửi yêu cầu tra cứu
+            if rate_limiter:
+                rate_limiter.acquire()
+            driver.find_element(By.ID, "btn-search").click()
+            submitted_at = time.monotonic()
+            counts['attempts'] += 1
+            
+            # 4. PHƯƠNG THỨC CHỜ ĐỢI THÔNG MINH
             try:
-                # 1. Điền thông tin vào form
-                so_tk_input = wait.until(EC.presence_of_element_located((By.ID, "soTK")))
-                so_tk_input.clear()
-                driver.find_element(By.ID, "maDN").clear()
-                driver.find_element(By.ID, "soCMT").clear()
+                # Chờ đợi một cách linh hoạt:
+                # - Hoặc là bảng kết quả mới xuất hiện (thành công)
+                # - Hoặc là thông báo lỗi CAPTCHA sai xuất hiện
+                # - Hoặc là bảng kết quả cũ biến mất (dấu hiệu đang tải)
+                # Tăng thời gian chờ ở đây lên 10 giây
+                long_wait = WebDriverWait(driver, 10)
                 
-                so_tk_input.send_keys(so_tk)
-                driver.find_element(By.ID, "maDN").send_keys(MA_DOANH_NGHIEP)
-                driver.find_element(By.ID, "soCMT").send_keys(SO_CMT)
-
-                for attempt in range(MAX_RETRIES_PER_TK):
-                    if stop_event.is_set():
-                        yield {'status': 'STOPPED', 'message': 'Người dùng đã yêu cầu dừng.'}
-                        return
-                        
-                    yield {'status': 'PROGRESS', 'message': f'Tờ khai {so_tk}: Lần thử CAPTCHA {attempt + 1}/{MAX_RETRIES_PER_TK}...', 'value': progress_value}
-                    time.sleep(1) # Chờ một chút để captcha mới có thể tải về
-                    
-                    # 2. Giải CAPTCHA
-                    captcha_element = wait.until(EC.visibility_of_element_located((By.CSS_SELECTOR, "#mainCaptcha img")))
-                    img_src = captcha_element.get_attribute('src')
-                    base64_string = img_src.split('data:image/jpg;base64,')[1]
-                    img_data = base64.b64decode(base64_string)
-                    predicted_label = solve_captcha(img_data)
+                # Điều kiện phức hợp: chờ cho đến khi có kết quả hoặc có thông báo lỗi.
+                # Nếu đã có bảng/thông báo lỗi cũ, chỉ tính bảng/thông báo mới khi cái cũ đã bị thay thế (stale).
+                new_table_ready = EC.presence_of_element_located((By.CLASS_NAME, "tbl-TTTK"))
+                if old_result_table:
+                    new_table_ready = EC.all_of(EC.staleness_of(old_result_table), new_table_ready)
+                new_error_ready = EC.presence_of_element_located((By.XPATH, WRONG_CAPTCHA_XPATH))
+                if old_error:
+                    new_error_ready = EC.all_of(EC.staleness_of(old_error), new_error_ready)
+                with spans.span('submit_wait'):
+                    long_wait.until(
+                        EC.any_of(
+                            new_table_ready,
+                            new_error_ready
+                        )
+                    )
+
+                # Sau khi chờ, kiểm tra xem kết quả là gì
+                try:
+                    # Trường hợp thành công: tìm thấy bảng kết quả
+                    result_table = driver.find_element(By.CLASS_NAME, "tbl-TTTK")
                     
-                    if not predicted_label:
-                        yield {'status': 'ERROR', 'message': f'Tờ khai {so_tk}: Lần {attempt + 1} không giải được CAPTCHA. Lấy CAPTCHA mới.'}
-                        driver.find_element(By.CSS_SELECTOR, 'button[onclick="getCaptcha()"]').click()
+                    # Kỹ thuật kiểm tra "Stale Element": đảm bảo đây là bảng MỚI
+                    if old_result_table and old_result_table.id == result_table.id:
+                        yield {'status': 'ERROR', 'message': f'Tờ khai {so_tk}: Lần {attempt + 1} - trang không cập nhật kết quả mới.'}
+                        # Tải lại captcha và thử lại
+                        refresh_captcha(driver)
+                        stale_captcha_src = img_src
                         continue
 
-                    # 3. Điền CAPTCHA và nhấn nút
-                    captcha_input_element = driver.find_element(By.ID, "check-input")
-                    # Sử dụng Javascript để điền giá trị, ổn định hơn send_keys
-                    driver.execute_script(f"arguments[0].value = '{predicted_label}';", captcha_input_element)
+                    counts['correct'] += 1
+                    if confidence_gate:
+                        confidence_gate.record(score, True, time.monotonic() - submitted_at, forced=not skips_left)
+                    rows = result_table.find_elements(By.TAG_NAME, "tr")
+                    result_data = {cells[0].text.strip(): cells[1].text.strip() for row in rows if len(cells := row.find_elements(By.TAG_NAME, "td")) == 2}
                     
-                    # Lấy tham chiếu đến bảng kết quả *cũ* (nếu có) trước khi nhấn
-                    try:
-                        old_result_table = driver.find_element(By.CLASS_NAME, "tbl-TTTK")
-                    except NoSuchElementException:
-                        old_result_table = None
-
-                    driver.find_element(By.ID, "btn-search").click()
+                    if not result_data:
+                         yield {'status': 'ERROR', 'message': f'Tờ khai {so_tk}: Tìm thấy bảng kết quả nhưng không có dữ liệu.',
+                                'metrics': {'so_tk': so_tk, 'spans': spans.spans, **counts}}
+                         break # Thoát khỏi vòng lặp attempt, xử lý tờ khai tiếp theo
                     
-                    # 4. PHƯƠNG THỨC CHỜ ĐỢI THÔNG MINH
-                    try:
-                        # Chờ đợi một cách linh hoạt:
-                        # - Hoặc là bảng kết quả mới xuất hiện (thành công)
-                        # - Hoặc là thông báo lỗi CAPTCHA sai xuất hiện
-                        # - Hoặc là bảng kết quả cũ biến mất (dấu hiệu đang tải)
-                        # Tăng thời gian chờ ở đây lên 10 giây
-                        long_wait = WebDriverWait(driver, 10)
-                        
-                        # Điều kiện phức hợp: chờ cho đến khi có kết quả hoặc có thông báo lỗi
-                        long_wait.until(
-                            EC.any_of(
-                                EC.presence_of_element_located((By.CLASS_NAME, "tbl-TTTK")),
-                                EC.presence_of_element_located((By.XPATH, "//*[contains(text(), 'Sai mã kiểm tra')]"))
-                            )
-                        )
-
-                        # Sau khi chờ, kiểm tra xem kết quả là gì
-                        try:
-                            # Trường hợp thành công: tìm thấy bảng kết quả
-                            result_table = driver.find_element(By.CLASS_NAME, "tbl-TTTK")
-                            
-                            # Kỹ thuật kiểm tra "Stale Element": đảm bảo đây là bảng MỚI
-                            if old_result_table and old_result_table.id == result_table.id:
-                                yield {'status': 'ERROR', 'message': f'Tờ khai {so_tk}: Lần {attempt + 1} - trang không cập nhật kết quả mới.'}
-                                # Tải lại captcha và thử lại
-                                driver.find_element(By.CSS_SELECTOR, 'button[onclick="getCaptcha()"]').click()
-                                continue
-
-                            rows = result_table.find_elements(By.TAG_NAME, "tr")
-                            result_data = {cells[0].text.strip(): cells[1].text.strip() for row in rows if len(cells := row.find_elements(By.TAG_NAME, "td")) == 2}
-                            
-                            if not result_data:
-                                 yield {'status': 'ERROR', 'message': f'Tờ khai {so_tk}: Tìm thấy bảng kết quả nhưng không có dữ liệu.'}
-                                 break # Thoát khỏi vòng lặp attempt, xử lý tờ khai tiếp theo
-                            
-                            yield {'status': 'RESULT', 'so_tk': so_tk, 'data': result_data}
-                            break # Thoát khỏi vòng lặp attempt vì đã thành công
-                            
-                        except NoSuchElementException:
-                            # Trường hợp CAPTCHA sai: không tìm thấy bảng, nhưng có thể có thông báo lỗi
-                            message = f'Tờ khai {so_tk}: Lần thử {attempt + 1} thất bại (CAPTCHA sai).'
-                            yield {'status': 'ERROR', 'message': message}
-                            filepath = os.path.join(FAILED_CAPTCHA_FOLDER, f"failed_{so_tk}_{predicted_label}_{int(time.time())}.png")
-                            with open(filepath, 'wb') as f: f.write(img_data)
-                            # Trang web không tự refresh captcha, ta phải tự nhấn
-                            driver.find_element(By.CSS_SELECTOR, 'button[onclick="getCaptcha()"]').click()
-                            
-                    except TimeoutException:
-                        # Hết 10 giây mà không thấy bảng kết quả hay thông báo lỗi
-                        message = f'Tờ khai {so_tk}: Lần thử {attempt + 1} - trang không phản hồi sau khi nhấn nút.'
-                        yield {'status': 'ERROR', 'message': message}
-                        # Lưu lại captcha để kiểm tra
-                        filepath = os.path.join(FAILED_CAPTCHA_FOLDER, f"failed_timeout_{so_tk}_{predicted_label}_{int(time.time())}.png")
-                        with open(filepath, 'wb') as f: f.write(img_data)
+                    if result_cache:
+                        result_cache.put(so_tk, result_data)
+                    yield {'status': 'RESULT', 'so_tk': so_tk, 'data': result_data, 'wait_saved': wait_saved,
+                           'metrics': {'so_tk': so_tk, 'spans': spans.spans, **counts}}
+                    break # Thoát khỏi vòng lặp attempt vì đã thành công
                     
-                    # Nếu là lần thử cuối cùng mà vẫn thất bại
-                    if attempt == MAX_RETRIES_PER_TK - 1:
-                        yield {'status': 'FINAL_ERROR', 'message': f'Không thể lấy thông tin cho tờ khai {so_tk} sau {MAX_RETRIES_PER_TK} lần thử.'}
+                except NoSuchElementException:
+                    # Trường hợp CAPTCHA sai: không tìm thấy bảng, nhưng có thể có thông báo lỗi
+                    message = f'Tờ khai {so_tk}: Lần thử {attempt + 1} thất bại (CAPTCHA sai).'
+                    counts['wrong'] += 1
+                    if confidence_gate:
+                        confidence_gate.record(score, False, time.monotonic() - submitted_at, forced=not skips_left)
+                    yield {'status': 'ERROR', 'message': message}
+                    save_failed_captcha(img_data, so_tk, predicted_label)
+                    # Trang web không tự refresh captcha, ta phải tự nhấn
+                    refresh_captcha(driver)
+                    stale_captcha_src = img_src
+                    
+            except TimeoutException:
+                # Hết 10 giây mà không thấy bảng kết quả hay thông báo lỗi
+                message = f'Tờ khai {so_tk}: Lần thử {attempt + 1} - trang không phản hồi sau khi nhấn nút.'
+                yield {'status': 'ERROR', 'message': message}
+                # Lưu lại captcha để kiểm tra
+                save_failed_captcha(img_data, so_tk, predicted_label, kind=KIND_TIMEOUT)
+                # CAPTCHA đã gửi không dùng lại được, lấy ảnh mới cho lần thử sau
+                refresh_captcha(driver)
+                stale_captcha_src = img_src
+        else:
+            # Hết số lần thử mà vẫn thất bại (kể cả khi lần cuối không giải được CAPTCHA hoặc trang không cập nhật)
+            yield {'status': 'FINAL_ERROR', 'message': f'Không thể lấy thông tin cho tờ khai {so_tk} sau {MAX_RETRIES_PER_TK} lần thử.',
+                   'metrics': {'so_tk': so_tk, 'spans': spans.spans, **counts}}
 
-            except Exception as e:
-                yield {'status': 'ERROR', 'message': f'Lỗi hệ thống khi xử lý tờ khai {so_tk}: {e}'}
-                try:
-                    driver.get(URL) # Tải lại trang để bắt đầu lại
-                    time.sleep(2)
-                except WebDriverException:
-                    yield {'status': 'FATAL_ERROR', 'message': 'Mất kết nối với trình duyệt. Vui lòng khởi động lại.'}
+    except Exception as e:
+        yield {'status': 'ERROR', 'message': f'Lỗi hệ thống khi xử lý tờ khai {so_tk}: {e}',
+               'metrics': {'so_tk': so_tk, 'spans': spans.spans, **counts}}
+        reload_spans = SpanRecorder()
+        try:
+            with reload_spans.span('page_load'):
+                load_lookup_page(driver, rate_limiter, lookup_url) # Tải lại trang để bắt đầu lại
+                # Chờ form sẵn sàng thay cho sleep cố định 2 giây
+                readiness.wait_for(wait, EC.presence_of_element_located((By.ID, "soTK")), PAGE_RELOAD_SLEEP_BASELINE)
+            yield {'status': 'PROGRESS', 'message': 'Đã tải lại trang tra cứu.', 'value': progress_value, 'metrics': {'spans': reload_spans.spans}}
+        except TimeoutException:
+            yield {'status': 'ERROR', 'message': f'Trang tra cứu chưa sẵn sàng sau khi tải lại (tờ khai {so_tk}).'}
+        except WebDriverException:
+            yield {'status': 'FATAL_ERROR', 'message': 'Mất kết nối với trình duyệt. Vui lòng khởi động lại.'}
+
+def run_batch_processing(so_tk_list, stop_event, result_cache=None, driver=None, rate_limiter=None, browser_settings=None,
+                         confidence_gate=None):
+    """
+    Hàm xử lý tra cứu hàng loạt với logic chờ đợi và xử lý lỗi được cải tiến.
+    Nếu có `result_cache`, các tờ khai đã có kết quả còn hiệu lực được trả về ngay
+    (sự kiện RESULT có 'cached': True) mà không cần mở trình duyệt.
+    Nếu truyền `driver` (trình duyệt dùng lại giữa nhiều lượt chạy), hàm sẽ không đóng nó khi kết thúc.
+    """
+    so_tk_list = yield from serve_cached_results(so_tk_list, result_cache)
+    if not so_tk_list:
+        yield {'status': 'DONE', 'message': 'Hoàn tất quá trình tra cứu.', 'value': 100}
+        return
+
+    os.makedirs(FAILED_CAPTCHA_FOLDER, exist_ok=True)
+    owns_driver = driver is None
+    total_tk = len(so_tk_list)
+    readiness = ReadinessTracker()
+    lookup_url = lookup_url_from(browser_settings)
+    try:
+        if owns_driver:
+            yield {'status': 'PROGRESS', 'message': 'Đang khởi tạo trình duyệt...', 'value': 0}
+            driver = create_driver(browser_settings)
+        # Tăng thời gian chờ chính lên 15 giây
+        wait = WebDriverWait(driver, 15)
+        yield {'status': 'PROGRESS', 'message': f'Đang tải trang: {lookup_url}...', 'value': 0}
+        spans = SpanRecorder()
+        with spans.span('page_load'):
+            load_lookup_page(driver, rate_limiter, lookup_url)
+        yield {'status': 'PROGRESS', 'message': f'Trang tra cứu đã sẵn sàng sau {spans.spans[0][1]:.1f} giây.', 'value': 0, 'metrics': {'spans': spans.spans}}
+        
+        for index, so_tk in enumerate(so_tk_list):
+            if stop_event.is_set():
+                yield {'status': 'STOPPED', 'message': 'Người dùng đã yêu cầu dừng.'}
+                return
+
+            progress_value = int(((index) / total_tk) * 100)
+            yield {'status': 'PROGRESS', 'message': f'Bắt đầu xử lý tờ khai {index + 1}/{total_tk}: {so_tk}', 'value': progress_value}
+
+            for event in lookup_declaration(driver, wait, so_tk, stop_event, progress_value, result_cache, rate_limiter, readiness,
+                                            confidence_gate, lookup_url):
+                yield event
+                if event['status'] in ('STOPPED', 'FATAL_ERROR'):
                     return
-                continue # Bỏ qua tờ khai hiện tại và tiếp tục với tờ khai tiếp theo
                 
     except WebDriverException as e:
         yield {'status': 'FATAL_ERROR', 'message': f'Lỗi nghiêm trọng với Selenium/WebDriver: {e}. Hãy đảm bảo chromedriver tương thích với phiên bản Chrome của bạn.'}
     except Exception as e:
         yield {'status': 'FATAL_ERROR', 'message': f'Lỗi không xác định trong quá trình xử lý: {e}'}
     finally:
-        if driver: 
+        if driver and owns_driver:
             driver.quit()
         if not stop_event.is_set():
-            yield {'status': 'DONE', 'message': 'Hoàn tất quá trình tra cứu.', 'value': 100}
\ No newline at end of file
+            gate_summary = f' {confidence_gate.summary()}' if confidence_gate else ''
+            yield {'status': 'DONE', 'message': f'Hoàn tất quá trình tra cứu. {readiness.summary()}{gate_summary}', 'value': 100}
\ No newline at end of file
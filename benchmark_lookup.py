@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+ĐO TỐC ĐỘ TRA CỨU ĐẦU-CUỐI VỚI MÁY CHỦ GIẢ LẬP (V1)
+=====================================================
+Khởi động `mock_portal.MockPortal` cục bộ rồi chạy quy trình tra cứu thật (`worker_pool.run_lookup`:
+Selenium một/nhiều trình duyệt hoặc `http_engine`) trên một danh sách tờ khai giả, không gửi request
+nào tới cổng hải quan. Báo cáo số tờ khai mỗi phút cùng thống kê của `run_metrics`.
+- Cấu hình lấy từ app_config.json, chỉ thay địa chỉ trang tra cứu, bỏ giới hạn tốc độ và bộ nhớ kết quả.
+- Kết quả gửi CAPTCHA được ghi vào bản sao tạm của `captcha_outcomes.jsonl`, không ảnh hưởng dữ liệu thật.
+- Ảnh CAPTCHA giải sai được lưu vào thư mục tạm, không lẫn vào `failed_captchas` dùng để kiểm tra lại và huấn luyện.
+
+Cách dùng:
+    python benchmark_lookup.py [--count 30] [--engine selenium|http] [--workers 1] [--latency-ms 300]
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import threading
+
+from mock_portal import MockPortal, CAPTCHA_IMAGE_FOLDER, DEFAULT_SETTINGS as PORTAL_SETTINGS
+import batch_processor
+from worker_pool import run_lookup
+from run_metrics import RunMetrics, track
+
+CONFIG_FILE = "app_config.json"
+UNLIMITED_REQUESTS_PER_MINUTE = 1_000_000
+
+
+def read_config():
+    try:
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def benchmark_config(config, portal_url, engine, workers, headless, outcomes_file):
+    """Bản sao cấu hình trỏ tới máy chủ giả lập."""
+    config = json.loads(json.dumps(config))
+    config['lookup_engine'] = engine
+    config['worker_pool'] = {'workers': workers, 'max_requests_per_minute': UNLIMITED_REQUESTS_PER_MINUTE}
+    config['browser'] = {**config.get('browser', {}), 'lookup_url': portal_url}
+    if headless:
+        config['browser']['headless'] = True
+    config['http_engine'] = {**config.get('http_engine', {}), 'page_url': portal_url,
+                             'captcha_url': portal_url + 'captcha', 'search_url': portal_url + 'search'}
+    config['confidence_gate'] = {**config.get('confidence_gate', {}), 'outcomes_file': outcomes_file}
+    config['result_cache'] = {'enabled': False}
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Đo số tờ khai tra cứu được mỗi phút với máy chủ giả lập.")
+    parser.add_argument("--folder", default=CAPTCHA_IMAGE_FOLDER)
+    parser.add_argument("--count", type=int, default=30, help="Số tờ khai giả cần tra cứu.")
+    parser.add_argument("--engine", choices=["selenium", "http"], default="selenium")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--headless", action="store_true", help="Chạy Chrome ở chế độ ẩn.")
+    parser.add_argument("--latency-ms", type=float, default=PORTAL_SETTINGS['latency_ms'])
+    parser.add_argument("--latency-jitter-ms", type=float, default=PORTAL_SETTINGS['latency_jitter_ms'])
+    parser.add_argument("--server-error-rate", type=float, default=PORTAL_SETTINGS['server_error_rate'])
+    args = parser.parse_args()
+
+    portal_settings = {'latency_ms': args.latency_ms, 'latency_jitter_ms': args.latency_jitter_ms,
+                       'server_error_rate': args.server_error_rate}
+    try:
+        portal = MockPortal(args.folder, portal_settings).start()
+    except (OSError, ValueError) as e:
+        print(f"[ERROR] {e}")
+        return 1
+
+    config = read_config()
+    work_dir = tempfile.mkdtemp(prefix="benchmark-")
+    outcomes_file = os.path.join(work_dir, "captcha_outcomes.jsonl")
+    real_outcomes = config.get('confidence_gate', {}).get('outcomes_file', 'captcha_outcomes.jsonl')
+    if os.path.exists(real_outcomes):
+        shutil.copyfile(real_outcomes, outcomes_file)
+    config = benchmark_config(config, portal.url, args.engine, args.workers, args.headless, outcomes_file)
+    batch_processor.FAILED_CAPTCHA_FOLDER = os.path.join(work_dir, "failed_captchas")
+
+    so_tk_list = [str(100000000000 + i) for i in range(args.count)]
+    metrics = RunMetrics(total=len(so_tk_list))
+    errors = 0
+    print(f"[INFO] Tra cứu {len(so_tk_list)} tờ khai qua {args.engine} ({args.workers} luồng) tại {portal.url}")
+    try:
+        for event in track(run_lookup(so_tk_list, threading.Event(), config), metrics):
+            if event['status'] in ('FINAL_ERROR', 'FATAL_ERROR'):
+                errors += 1
+                print(f"[ERROR] {event['message']}")
+    finally:
+        portal.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for line in metrics.summary():
+        print(line)
+    stats = portal.stats
+    print(f"Máy chủ giả lập: {stats['pages']} lần tải trang, {stats['captchas']} CAPTCHA mới, {stats['searches']} lần tra cứu "
+          f"({stats['correct']} đúng, {stats['wrong']} sai, {stats['server_errors']} lỗi máy chủ).")
+    print(f"KẾT QUẢ: {metrics.declarations_per_minute():.1f} tờ khai/phút, {errors} tờ khai lỗi.")
+    return 0 if not errors else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
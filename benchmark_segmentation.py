@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+ĐO TỐC ĐỘ TÁCH KÝ TỰ CAPTCHA (V1)
+==================================
+So sánh bước tách ký tự cũ (gọi contourArea/boundingRect nhiều lần cho mỗi contour)
+với `captcha_solver._preprocess_and_segment` hiện tại trên thư mục `captcha_result`:
+- Kiểm tra hai cách cho ra các ảnh ký tự giống hệt nhau.
+- Báo cáo thời gian tách trung bình mỗi ảnh của từng cách.
+
+Cách dùng:
+    python benchmark_segmentation.py [--folder captcha_result] [--repeat 5]
+"""
+import os
+import sys
+import time
+import argparse
+import cv2
+import numpy as np
+import imutils
+
+from captcha_solver import _preprocess_and_segment, CAPTCHA_LENGTH, IMAGE_WIDTH, IMAGE_HEIGHT
+
+CAPTCHA_IMAGE_FOLDER = "captcha_result"
+
+
+def legacy_preprocess_and_segment(image):
+    """Bản tách ký tự trước khi tối ưu, giữ nguyên để làm mốc so sánh."""
+    if image is None: return []
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    lower_blue, upper_blue = np.array([90, 80, 2]), np.array([150, 255, 255])
+    mask = cv2.inRange(hsv, lower_blue, upper_blue)
+    opening = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((2, 2), np.uint8))
+    closing = cv2.morphologyEx(opening, cv2.MORPH_CLOSE, np.ones((3, 3), np.uint8))
+    contours = cv2.findContours(closing.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    contours = sorted(imutils.grab_contours(contours), key=cv2.contourArea, reverse=True)
+    char_contours = [c for c in contours if cv2.contourArea(c) > 15 and cv2.boundingRect(c)[3] > 10]
+    if len(char_contours) < CAPTCHA_LENGTH: return []
+    char_contours = sorted(char_contours, key=cv2.contourArea, reverse=True)[:CAPTCHA_LENGTH]
+    char_contours = sorted(char_contours, key=lambda c: cv2.boundingRect(c)[0])
+    if len(char_contours) != CAPTCHA_LENGTH: return []
+    return [cv2.resize(closing[y:y+h, x:x+w], (IMAGE_WIDTH, IMAGE_HEIGHT)) for x,y,w,h in [cv2.boundingRect(c) for c in char_contours]]
+
+
+def load_images(folder):
+    images = {}
+    for filename in sorted(os.listdir(folder)):
+        if filename.lower().endswith((".png", ".jpg", ".jpeg")):
+            image = cv2.imread(os.path.join(folder, filename))
+            if image is not None:
+                images[filename] = image
+    return images
+
+
+def time_per_image(segment, images, repeat):
+    """Thời gian tách trung bình mỗi ảnh (ms), lấy lượt nhanh nhất trong `repeat` lượt."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for image in images:
+            segment(image)
+        best = min(best, time.perf_counter() - start)
+    return best / len(images) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Đo tốc độ tách ký tự CAPTCHA.")
+    parser.add_argument("--folder", default=CAPTCHA_IMAGE_FOLDER)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder):
+        print(f"Không tìm thấy thư mục '{args.folder}'.")
+        return 1
+    images = load_images(args.folder)
+    if not images:
+        print(f"Thư mục '{args.folder}' không có ảnh nào.")
+        return 1
+
+    mismatches = []
+    for filename, image in images.items():
+        old, new = legacy_preprocess_and_segment(image), _preprocess_and_segment(image)
+        if len(old) != len(new) or any(not np.array_equal(a, b) for a, b in zip(old, new)):
+            mismatches.append(filename)
+
+    old_ms = time_per_image(legacy_preprocess_and_segment, list(images.values()), args.repeat)
+    new_ms = time_per_image(_preprocess_and_segment, list(images.values()), args.repeat)
+    print(f"Số ảnh: {len(images)}")
+    print(f"Cách cũ : {old_ms:.3f} ms/ảnh")
+    print(f"Cách mới: {new_ms:.3f} ms/ảnh ({old_ms / new_ms:.2f} lần nhanh hơn)")
+    if mismatches:
+        print(f"KHÁC BIỆT ở {len(mismatches)} ảnh: {', '.join(mismatches[:20])}")
+        return 1
+    print("Kết quả tách ký tự giống hệt nhau trên toàn bộ ảnh.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+ĐO TỐC ĐỘ VÀ ĐỘ CHÍNH XÁC CỦA BỘ GIẢI CAPTCHA (V1)
+====================================================
+Chạy bộ giải trên toàn bộ ảnh có nhãn trong `captcha_result` (mỗi nội dung ảnh một lần) qua
+`captcha_solver.solve_captchas`, mỗi lần một ảnh như khi tra cứu thật, và báo cáo:
+- Số ảnh mỗi giây, độ trễ p50/p99 mỗi ảnh.
+- Tỉ lệ ảnh không tách được ký tự.
+- Độ chính xác trên cả CAPTCHA (đúng cả CAPTCHA_LENGTH ký tự).
+Kết quả được so với mốc đã lưu trong `solver_baseline.json`; chậm hơn hoặc kém chính xác hơn quá
+ngưỡng cho phép thì trả mã lỗi 1.
+Khi đã có mốc, `train_captcha_model` chạy cùng phép đo cho model vừa huấn luyện trước khi dùng nó
+(`check_solver_baseline`): phiên bản kém hơn mốc được lưu nhưng không được dùng.
+
+Cách dùng:
+    python benchmark_solver.py                   # Đo và so với mốc
+    python benchmark_solver.py --version v5      # Đo một phiên bản trong models/ (kể cả chưa được dùng)
+    python benchmark_solver.py --save-baseline   # Đo và lưu làm mốc mới
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+
+import captcha_solver
+import model_store
+from captcha_solver import solve_captchas, CAPTCHA_LENGTH
+from char_dataset import label_from_filename, hash_image_bytes, IMAGE_EXTENSIONS
+from run_metrics import percentile
+
+CAPTCHA_IMAGE_FOLDER = "captcha_result"
+BASELINE_FILE = "solver_baseline.json"
+DEFAULT_MAX_SLOWDOWN = 0.20         # Cho phép chậm hơn mốc tối đa 20% (p50 và số ảnh/giây)
+DEFAULT_MAX_ACCURACY_DROP = 0.5     # Điểm phần trăm
+DEFAULT_MAX_SEGMENTATION_RISE = 0.5  # Điểm phần trăm
+
+
+def load_corpus(folder):
+    """Danh sách (bytes ảnh, nhãn) và mã băm của toàn bộ tập ảnh (để biết mốc có đo trên cùng tập hay không)."""
+    corpus, seen = [], set()
+    digest = hashlib.sha1()
+    for filename in sorted(os.listdir(folder)):
+        if not filename.lower().endswith(IMAGE_EXTENSIONS): continue
+        label = label_from_filename(filename)
+        if len(label) != CAPTCHA_LENGTH: continue
+        with open(os.path.join(folder, filename), 'rb') as f:
+            image_bytes = f.read()
+        image_hash = hash_image_bytes(image_bytes)
+        if image_hash in seen: continue
+        seen.add(image_hash)
+        corpus.append((image_bytes, label))
+        digest.update(f"{image_hash}:{label}\n".encode('utf-8'))
+    return corpus, digest.hexdigest()
+
+
+def load_solver(version=None):
+    """(model, label encoder, tên phiên bản): phiên bản chỉ định trong models/ hoặc model đang dùng."""
+    if version is None:
+        model, le = captcha_solver.load_model()
+        return model, le, captcha_solver.model_version
+    model_path, labels_path, _ = model_store.version_paths(version)
+    model, le = captcha_solver.load_model_files(model_path, labels_path)
+    return model, le, version
+
+
+def run_benchmark(corpus, model, le):
+    """Giải từng ảnh như khi tra cứu thật; trả về dict các chỉ số."""
+    # Lượt chạy khởi động: lần forward đầu tiên của torch chậm hơn hẳn
+    solver = (model, le)
+    solve_captchas([corpus[0][0]], solver)
+
+    latencies, correct, failed = [], 0, 0
+    started_at = time.perf_counter()
+    for image_bytes, label in corpus:
+        start = time.perf_counter()
+        predicted = solve_captchas([image_bytes], solver)[0]
+        latencies.append((time.perf_counter() - start) * 1000)
+        if predicted is None:
+            failed += 1
+        elif predicted == label:
+            correct += 1
+    elapsed = time.perf_counter() - started_at
+    return {
+        'images': len(corpus),
+        'images_per_second': len(corpus) / elapsed,
+        'p50_ms': percentile(latencies, 50),
+        'p99_ms': percentile(latencies, 99),
+        'segmentation_failure_rate': 100 * failed / len(corpus),
+        'accuracy': 100 * correct / len(corpus),
+    }
+
+
+def read_baseline(path=BASELINE_FILE):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def save_baseline(result, path=BASELINE_FILE):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def find_regressions(result, baseline, max_slowdown, max_accuracy_drop, max_segmentation_rise):
+    """Danh sách mô tả các chỉ số kém hơn mốc quá ngưỡng cho phép (rỗng nếu đạt)."""
+    regressions = []
+    if result['p50_ms'] > baseline['p50_ms'] * (1 + max_slowdown):
+        regressions.append(f"p50 {result['p50_ms']:.2f} ms > mốc {baseline['p50_ms']:.2f} ms (+{100 * max_slowdown:.0f}%)")
+    if result['images_per_second'] < baseline['images_per_second'] / (1 + max_slowdown):
+        regressions.append(f"{result['images_per_second']:.1f} ảnh/giây < mốc {baseline['images_per_second']:.1f} ảnh/giây")
+    if result['accuracy'] < baseline['accuracy'] - max_accuracy_drop:
+        regressions.append(f"độ chính xác {result['accuracy']:.2f}% < mốc {baseline['accuracy']:.2f}%")
+    if result['segmentation_failure_rate'] > baseline['segmentation_failure_rate'] + max_segmentation_rise:
+        regressions.append(f"tỉ lệ không tách được ký tự {result['segmentation_failure_rate']:.2f}% > mốc "
+                           f"{baseline['segmentation_failure_rate']:.2f}%")
+    return regressions
+
+
+def check_solver_baseline(model, le, folder=CAPTCHA_IMAGE_FOLDER, path=BASELINE_FILE):
+    """Danh sách chỉ số của (model, le) kém hơn mốc đã lưu quá ngưỡng mặc định; rỗng nếu đạt hoặc chưa có mốc."""
+    baseline = read_baseline(path)
+    if baseline is None or not os.path.isdir(folder):
+        return []
+    corpus, _ = load_corpus(folder)
+    if not corpus:
+        return []
+    print(f"[INFO] So sánh với mốc '{path}' trên {len(corpus)} ảnh...")
+    result = run_benchmark(corpus, model, le)
+    return find_regressions(result, baseline, DEFAULT_MAX_SLOWDOWN, DEFAULT_MAX_ACCURACY_DROP, DEFAULT_MAX_SEGMENTATION_RISE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Đo tốc độ và độ chính xác của bộ giải CAPTCHA.")
+    parser.add_argument("--folder", default=CAPTCHA_IMAGE_FOLDER)
+    parser.add_argument("--version", help="Phiên bản trong models/ cần đo (mặc định: model đang dùng).")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="Lưu kết quả lần đo này làm mốc mới.")
+    parser.add_argument("--max-slowdown", type=float, default=DEFAULT_MAX_SLOWDOWN)
+    parser.add_argument("--max-accuracy-drop", type=float, default=DEFAULT_MAX_ACCURACY_DROP)
+    parser.add_argument("--max-segmentation-rise", type=float, default=DEFAULT_MAX_SEGMENTATION_RISE)
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder):
+        print(f"[ERROR] Không tìm thấy thư mục '{args.folder}'.")
+        return 1
+    corpus, corpus_hash = load_corpus(args.folder)
+    if not corpus:
+        print(f"[ERROR] Thư mục '{args.folder}' không có ảnh nào có nhãn hợp lệ.")
+        return 1
+    model, le, version = load_solver(args.version)
+    if model is None or le is None:
+        print("[ERROR] Không nạp được model CAPTCHA.")
+        return 1
+
+    result = run_benchmark(corpus, model, le)
+    result.update({'model_version': version, 'corpus_hash': corpus_hash, 'created_at': time.time()})
+    print(f"Model: {version or 'đóng gói kèm ứng dụng'} - {result['images']} ảnh")
+    print(f"Tốc độ: {result['images_per_second']:.1f} ảnh/giây, p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms")
+    print(f"Không tách được ký tự: {result['segmentation_failure_rate']:.2f}%")
+    print(f"Độ chính xác cả CAPTCHA: {result['accuracy']:.2f}%")
+
+    if args.save_baseline:
+        save_baseline(result, args.baseline)
+        print(f"[INFO] Đã lưu mốc vào '{args.baseline}'.")
+        return 0
+
+    baseline = read_baseline(args.baseline)
+    if baseline is None:
+        print(f"[INFO] Chưa có mốc '{args.baseline}'. Chạy lại với --save-baseline để lưu.")
+        return 0
+    if baseline.get('corpus_hash') != corpus_hash:
+        print(f"[WARNING] Tập ảnh đã thay đổi kể từ khi lưu mốc ({baseline['images']} ảnh), so sánh chỉ mang tính tham khảo.")
+    regressions = find_regressions(result, baseline, args.max_slowdown, args.max_accuracy_drop, args.max_segmentation_rise)
+    if regressions:
+        for regression in regressions:
+            print(f"[KÉM HƠN MỐC] {regression}")
+        return 1
+    print(f"[OK] Không kém hơn mốc (model {baseline.get('model_version') or 'đóng gói kèm ứng dụng'}).")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,18 @@
 # -*- coding: utf-8 -*-
 """
-MODULE GIẢI MÃ CAPTCHA (V2.3 - Tương thích .exe)
-==================================================
+MODULE GIẢI MÃ CAPTCHA (V2.4 - Nạp trễ torch/cv2 và model)
+==========================================================
+torch và cv2 chỉ được import khi thực sự cần; model được nạp ở lần giải đầu tiên
+hoặc trước đó bằng `warm_up()` trên một luồng nền, để giao diện mở ngay lập tức.
+`reload_if_changed()` chuyển sang phiên bản model mới trong `models/` (xem model_store) giữa các lần tra cứu.
 """
-import cv2
 import pickle
 import numpy as np
-import imutils
-import torch
-import torch.nn as nn
 import os
 import sys
+import threading
+
+import model_store
 
 def resource_path(relative_path):
     """ Lấy đường dẫn tuyệt đối đến tài nguyên, hoạt động cho cả môi trường dev và PyInstaller """
@@ -26,6 +28,8 @@ MODEL_LABELS_FILENAME = "label_encoder.pkl"
 IMAGE_WIDTH = 20
 IMAGE_HEIGHT = 20
 CAPTCHA_LENGTH = 5
+MAX_BATCH_CHARS = 2560  # Giới hạn số ký tự mỗi lần forward để không tốn quá nhiều RAM
+MAX_VARIANTS = 7  # Số biến thể tối đa của `_char_variants` dùng cho đồng thuận
 
 # --- LỚP TÙY CHỈNH (phải có ở đây để pickle hoạt động) ---
 class SimpleLabelEncoder:
@@ -37,59 +41,229 @@ class SimpleLabelEncoder:
     def fit_transform(self, labels): self.fit(labels); return self.transform(labels)
     def transform(self, labels): return np.array([self._map.get(label, -1) for label in labels])
     def inverse_transform(self, encoded_labels): return np.array([self._inverse_map.get(i, '?') for i in encoded_labels])
+    def extend(self, labels):
+        """Thêm các nhãn chưa có vào cuối danh sách lớp (giữ nguyên chỉ số cũ). Trả về số lớp mới."""
+        new_labels = [label for label in np.unique(labels) if label not in self._map]
+        for label in new_labels:
+            self._map[label] = len(self._map); self._inverse_map[self._map[label]] = label
+        if new_labels: self.classes_ = np.array(list(self.classes_) + new_labels)
+        return len(new_labels)
+
+def _build_captcha_net_class():
+    import torch.nn as nn
+
+    class CaptchaNet(nn.Module):
+        def __init__(self, num_classes):
+            super(CaptchaNet, self).__init__()
+            self.conv1 = nn.Conv2d(1, 32, kernel_size=5, padding='same'); self.relu1 = nn.ReLU(); self.pool1 = nn.MaxPool2d(kernel_size=2)
+            self.conv2 = nn.Conv2d(32, 64, kernel_size=3, padding='same'); self.relu2 = nn.ReLU(); self.pool2 = nn.MaxPool2d(kernel_size=2)
+            self.flatten = nn.Flatten(); self.fc1 = nn.Linear(64 * 5 * 5, 512); self.relu3 = nn.ReLU(); self.dropout = nn.Dropout(0.5)
+            self.fc2 = nn.Linear(512, num_classes)
+        def forward(self, x):
+            x = self.pool1(self.relu1(self.conv1(x))); x = self.pool2(self.relu2(self.conv2(x))); x = self.flatten(x)
+            x = self.relu3(self.fc1(x)); x = self.dropout(x); x = self.fc2(x); return x
+
+    CaptchaNet.__module__ = __name__
+    return CaptchaNet
 
-class CaptchaNet(nn.Module):
-    def __init__(self, num_classes):
-        super(CaptchaNet, self).__init__()
-        self.conv1 = nn.Conv2d(1, 32, kernel_size=5, padding='same'); self.relu1 = nn.ReLU(); self.pool1 = nn.MaxPool2d(kernel_size=2)
-        self.conv2 = nn.Conv2d(32, 64, kernel_size=3, padding='same'); self.relu2 = nn.ReLU(); self.pool2 = nn.MaxPool2d(kernel_size=2)
-        self.flatten = nn.Flatten(); self.fc1 = nn.Linear(64 * 5 * 5, 512); self.relu3 = nn.ReLU(); self.dropout = nn.Dropout(0.5)
-        self.fc2 = nn.Linear(512, num_classes)
-    def forward(self, x):
-        x = self.pool1(self.relu1(self.conv1(x))); x = self.pool2(self.relu2(self.conv2(x))); x = self.flatten(x)
-        x = self.relu3(self.fc1(x)); x = self.dropout(x); x = self.fc2(x); return x
-
-# --- NẠP MODEL MỘT LẦN KHI MODULE ĐƯỢC IMPORT ---
+def __getattr__(name):
+    # `CaptchaNet` kế thừa torch.nn.Module nên chỉ được tạo khi có người dùng đến (import torch trễ)
+    if name == 'CaptchaNet':
+        globals()['CaptchaNet'] = _build_captcha_net_class()
+        return globals()['CaptchaNet']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# --- NẠP MODEL MỘT LẦN, Ở LẦN SỬ DỤNG ĐẦU TIÊN; NẠP LẠI KHI CÓ PHIÊN BẢN MỚI ---
 model, le = None, None
-try:
-    labels_path = resource_path(MODEL_LABELS_FILENAME)
-    model_path = resource_path(MODEL_FILENAME)
+model_version = None
+_model_loaded = False
+_manifest_mtime = None
+_model_lock = threading.Lock()
+
+def _model_paths():
+    """Phiên bản hiện tại trong `models/manifest.json` nếu có, ngược lại là model đóng gói kèm ứng dụng."""
+    versioned = model_store.current_model_paths()
+    if versioned and os.path.exists(versioned[0]):
+        return versioned
+    return resource_path(MODEL_FILENAME), resource_path(MODEL_LABELS_FILENAME), None
+
+def _manifest_changed_at():
+    try:
+        return os.path.getmtime(model_store.manifest_path())
+    except OSError:
+        return None
+
+def load_model_files(model_path, labels_path):
+    """Nạp (model, label encoder) từ hai tệp; model là None nếu thiếu tệp. Không thay model đang dùng."""
+    import torch
+    loaded_le, net = None, None
     if os.path.exists(labels_path) and os.path.getsize(labels_path) > 0:
         with open(labels_path, "rb") as f:
-            le = pickle.load(f)
-    if le and os.path.exists(model_path):
-        model = CaptchaNet(num_classes=len(le.classes_))
-        model.load_state_dict(torch.load(model_path, map_location=torch.device('cpu')))
-        model.eval()
-except Exception as e:
-    with open("error_log.txt", "a") as f: f.write(f"Error loading model: {e}\n")
+            loaded_le = pickle.load(f)
+    if loaded_le and os.path.exists(model_path):
+        net = __getattr__('CaptchaNet')(num_classes=len(loaded_le.classes_))
+        net.load_state_dict(torch.load(model_path, map_location=torch.device('cpu')))
+        net.eval()
+    return net, loaded_le
+
+def _load_current():
+    """Nạp phiên bản hiện tại và thay model đang dùng (gọi khi đang giữ `_model_lock`)."""
+    global model, le, model_version, _manifest_mtime
+    _manifest_mtime = _manifest_changed_at()
+    try:
+        model_path, labels_path, version = _model_paths()
+        new_model, new_le = load_model_files(model_path, labels_path)
+        if new_model is not None or model is None:
+            model, le, model_version = new_model, new_le, version
+    except Exception as e:
+        with open("error_log.txt", "a") as f: f.write(f"Error loading model: {e}\n")
+
+def load_model():
+    """Nạp label encoder và model (chỉ một lần, an toàn đa luồng). Trả về (model, le)."""
+    global _model_loaded
+    with _model_lock:
+        if not _model_loaded:
+            _load_current()
+            _model_loaded = True
+        return model, le
+
+def reload_if_changed():
+    """
+    Gọi giữa các lần tra cứu: nếu manifest đã đổi (có phiên bản mới hoặc rollback), nạp phiên bản
+    hiện tại thay cho model đang dùng mà không cần khởi động lại. Trả về tên phiên bản mới nếu đã đổi, ngược lại None.
+    """
+    if not _model_loaded or _manifest_changed_at() == _manifest_mtime:
+        return None
+    with _model_lock:
+        previous_version = model_version
+        _load_current()
+        return model_version if model_version != previous_version else None
+
+def warm_up():
+    """Nạp torch và model trên luồng nền để lần giải đầu tiên không phải chờ."""
+    if not _model_loaded:
+        threading.Thread(target=load_model, daemon=True).start()
+
+_LOWER_BLUE, _UPPER_BLUE = np.array([90, 80, 2]), np.array([150, 255, 255])
+_OPEN_KERNEL, _CLOSE_KERNEL = np.ones((2, 2), np.uint8), np.ones((3, 3), np.uint8)
+
+def _blob_stats(binary):
+    """Một lần duyệt contour: trả về mảng diện tích (contourArea) và mảng bbox (x, y, w, h)."""
+    import cv2
+    contours = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    areas = np.array([cv2.contourArea(c) for c in contours], dtype=np.float64)
+    boxes = np.array([cv2.boundingRect(c) for c in contours], dtype=np.int32).reshape(-1, 4)
+    return areas, boxes
+
+def _select_char_boxes(areas, boxes):
+    """
+    Chọn bbox của CAPTCHA_LENGTH ký tự (vector hóa bằng NumPy): lọc vùng nhiễu, giữ các vùng
+    lớn nhất rồi sắp xếp trái sang phải. Sắp xếp ổn định để giữ đúng thứ tự của `sorted()` cũ.
+    """
+    by_area = np.argsort(-areas, kind='stable')
+    keep = by_area[(areas[by_area] > 15) & (boxes[by_area, 3] > 10)]
+    if len(keep) < CAPTCHA_LENGTH: return None
+    chosen = boxes[keep[:CAPTCHA_LENGTH]]
+    return chosen[np.argsort(chosen[:, 0], kind='stable')]
 
 def _preprocess_and_segment(image):
+    import cv2
     if image is None: return []
-    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    lower_blue, upper_blue = np.array([90, 80, 2]), np.array([150, 255, 255])
-    mask = cv2.inRange(hsv, lower_blue, upper_blue)
-    opening = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((2, 2), np.uint8))
-    closing = cv2.morphologyEx(opening, cv2.MORPH_CLOSE, np.ones((3, 3), np.uint8))
-    contours = cv2.findContours(closing.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    contours = sorted(imutils.grab_contours(contours), key=cv2.contourArea, reverse=True)
-    char_contours = [c for c in contours if cv2.contourArea(c) > 15 and cv2.boundingRect(c)[3] > 10]
-    if len(char_contours) < CAPTCHA_LENGTH: return []
-    char_contours = sorted(char_contours, key=cv2.contourArea, reverse=True)[:CAPTCHA_LENGTH]
-    char_contours = sorted(char_contours, key=lambda c: cv2.boundingRect(c)[0])
-    if len(char_contours) != CAPTCHA_LENGTH: return []
-    return [cv2.resize(closing[y:y+h, x:x+w], (IMAGE_WIDTH, IMAGE_HEIGHT)) for x,y,w,h in [cv2.boundingRect(c) for c in char_contours]]
+    mask = cv2.inRange(cv2.cvtColor(image, cv2.COLOR_BGR2HSV), _LOWER_BLUE, _UPPER_BLUE)
+    closing = cv2.morphologyEx(cv2.morphologyEx(mask, cv2.MORPH_OPEN, _OPEN_KERNEL), cv2.MORPH_CLOSE, _CLOSE_KERNEL)
+    char_boxes = _select_char_boxes(*_blob_stats(closing))
+    if char_boxes is None: return []
+    return [cv2.resize(closing[y:y+h, x:x+w], (IMAGE_WIDTH, IMAGE_HEIGHT)) for x, y, w, h in char_boxes]
 
-def solve_captcha(image_data_bytes):
-    if model is None or le is None: return None
+def segment_image_bytes(image_data_bytes):
+    """Giải mã ảnh và tách ký tự; dùng chung cho lúc giải CAPTCHA và lúc huấn luyện."""
+    import cv2
     nparr = np.frombuffer(image_data_bytes, np.uint8)
-    img_original = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    segmented_chars = _preprocess_and_segment(img_original)
-    if len(segmented_chars) != CAPTCHA_LENGTH: return None
-    X_pred = np.array(segmented_chars, dtype="float32") / 255.0
+    img_original = cv2.imdecode(nparr, cv2.IMREAD_COLOR) if nparr.size else None
+    return _preprocess_and_segment(img_original)
+
+def _predict(char_groups, model, le):
+    """
+    Một lần forward (chia lô theo MAX_BATCH_CHARS) cho nhiều nhóm CAPTCHA_LENGTH ký tự.
+    Trả về (các chuỗi nhãn, mảng xác suất softmax của ký tự được chọn, kích thước (số nhóm, CAPTCHA_LENGTH)).
+    """
+    import torch
+    X_pred = np.array([char for chars in char_groups for char in chars], dtype="float32") / 255.0
     X_pred = torch.from_numpy(np.expand_dims(X_pred, axis=1))
     with torch.no_grad():
-        outputs = model(X_pred)
-        _, predictions = torch.max(outputs, 1)
-        predicted_label = "".join(le.inverse_transform(predictions.numpy()))
-    return predicted_label
\ No newline at end of file
+        probabilities, predictions = torch.cat([torch.softmax(model(X_pred[start:start + MAX_BATCH_CHARS]), 1)
+                                                for start in range(0, len(X_pred), MAX_BATCH_CHARS)]).max(1)
+    chars = le.inverse_transform(predictions.numpy()).reshape(len(char_groups), CAPTCHA_LENGTH)
+    return ["".join(row) for row in chars], probabilities.numpy().reshape(len(char_groups), CAPTCHA_LENGTH)
+
+def solve_captchas_with_confidence(images_data_bytes, solver=None):
+    """
+    Như `solve_captchas`, nhưng mỗi ảnh trả về (nhãn, độ tin cậy từng ký tự, điểm tổng) với điểm tổng là
+    tích độ tin cậy các ký tự (xác suất cả CAPTCHA đúng). Ảnh không tách được ký tự: (None, [], 0.0).
+    """
+    results = [(None, [], 0.0)] * len(images_data_bytes)
+    model, le = solver or load_model()
+    if model is None or le is None: return results
+    segmented = [segment_image_bytes(data) for data in images_data_bytes]
+    valid_indexes = [i for i, chars in enumerate(segmented) if len(chars) == CAPTCHA_LENGTH]
+    if not valid_indexes: return results
+
+    labels, confidences = _predict([segmented[i] for i in valid_indexes], model, le)
+    for row, i in enumerate(valid_indexes):
+        results[i] = (labels[row], confidences[row].tolist(), float(np.prod(confidences[row])))
+    return results
+
+def solve_captchas(images_data_bytes, solver=None):
+    """
+    Giải nhiều CAPTCHA cùng lúc: tách ký tự của mọi ảnh rồi ghép thành một tensor để chạy
+    một lần forward (chia lô theo MAX_BATCH_CHARS khi danh sách quá lớn).
+    Trả về danh sách nhãn theo đúng thứ tự đầu vào, None với ảnh không tách được ký tự.
+    `solver`: (model, le) dùng thay cho model hiện tại, ví dụ của `load_model_files`.
+    """
+    return [label for label, _, _ in solve_captchas_with_confidence(images_data_bytes, solver)]
+
+def solve_captcha_with_confidence(image_data_bytes):
+    return solve_captchas_with_confidence([image_data_bytes])[0]
+
+def solve_captcha(image_data_bytes):
+    return solve_captchas([image_data_bytes])[0]
+
+def _shift(char, dy, dx):
+    """Dịch ảnh ký tự (dy, dx) pixel, phần trống được lấp bằng 0."""
+    shifted = np.zeros_like(char)
+    h, w = char.shape
+    shifted[max(dy, 0):h + min(dy, 0), max(dx, 0):w + min(dx, 0)] = char[max(-dy, 0):h - max(dy, 0), max(-dx, 0):w - max(dx, 0)]
+    return shifted
+
+def _char_variants(char):
+    """Các biến thể nhỏ của một ký tự: nguyên bản, dịch 1 pixel, làm dày/mỏng nét (tương đương đổi ngưỡng)."""
+    import cv2
+    kernel = np.ones((2, 2), np.uint8)
+    return [char, _shift(char, 0, 1), _shift(char, 1, 0), cv2.dilate(char, kernel), cv2.erode(char, kernel),
+            _shift(char, 0, -1), _shift(char, -1, 0)]
+
+def solve_captchas_variants(images_data_bytes, num_variants=5):
+    """
+    Giải mỗi CAPTCHA trên `num_variants` biến thể (tối đa MAX_VARIANTS), cả danh sách trong một lần
+    forward, để đo mức đồng thuận thực sự của model. Trả về mỗi ảnh một danh sách nhãn
+    (toàn None nếu ảnh không tách được ký tự).
+    """
+    num_variants = min(num_variants, MAX_VARIANTS)
+    results = [[None] * num_variants for _ in images_data_bytes]
+    model, le = load_model()
+    if model is None or le is None: return results
+    segmented = [segment_image_bytes(data) for data in images_data_bytes]
+    valid_indexes = [i for i, chars in enumerate(segmented) if len(chars) == CAPTCHA_LENGTH]
+    if not valid_indexes: return results
+
+    char_groups = []
+    for i in valid_indexes:
+        per_char = [_char_variants(char)[:num_variants] for char in segmented[i]]
+        char_groups.extend([variants[v] for variants in per_char] for v in range(num_variants))
+    labels, _ = _predict(char_groups, model, le)
+    for row, i in enumerate(valid_indexes):
+        results[i] = labels[row * num_variants:(row + 1) * num_variants]
+    return results
+
+def solve_captcha_variants(image_data_bytes, num_variants=5):
+    return solve_captchas_variants([image_data_bytes], num_variants)[0]
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+MODULE BỘ NHỚ ĐỆM KÝ TỰ ĐÃ TÁCH DÙNG CHO HUẤN LUYỆN (V1)
+==========================================================
+Lưu các ký tự đã tách (uint8, IMAGE_HEIGHT x IMAGE_WIDTH) của mỗi ảnh CAPTCHA vào một tệp
+nhị phân đọc được bằng `np.memmap`, khóa theo mã băm nội dung ảnh:
+- Mỗi lần huấn luyện chỉ tách ký tự cho các ảnh mới thêm vào `captcha_result`.
+- Các ảnh trùng nội dung (cùng bytes) chỉ được dùng một lần.
+- Nhãn luôn lấy theo tên tệp hiện tại, nên đổi tên/sửa nhãn không làm mất bộ nhớ đệm; ảnh được sửa nhãn
+  được đánh dấu lại thời điểm thêm vào, để lần fine-tune sau coi nó là dữ liệu mới.
+- Khoảng HOLDOUT_PERCENT% ảnh (chọn cố định theo mã băm) là tập kiểm tra giữ riêng: không bao giờ được
+  dùng để huấn luyện, để so sánh model mới với model hiện tại trên dữ liệu cả hai chưa từng thấy.
+Việc tách ký tự dùng chung `captcha_solver.segment_image_bytes` với lúc giải CAPTCHA.
+"""
+import os
+import json
+import time
+import hashlib
+from collections import namedtuple
+import numpy as np
+
+from captcha_solver import segment_image_bytes, CAPTCHA_LENGTH, IMAGE_WIDTH, IMAGE_HEIGHT
+
+DEFAULT_CACHE_DIR = "char_cache"
+CHARS_FILENAME = "chars.u8"
+INDEX_FILENAME = "index.json"
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+CHAR_SIZE = IMAGE_HEIGHT * IMAGE_WIDTH
+HOLDOUT_PERCENT = 10
+
+# chars: mảng uint8 (N, IMAGE_HEIGHT, IMAGE_WIDTH); labels, image_hashes: danh sách dài N;
+# added_at: mảng thời điểm ảnh của mỗi ký tự được đưa vào bộ nhớ đệm (dùng khi fine-tune);
+# holdout: mảng bool, True với ký tự thuộc tập kiểm tra giữ riêng
+CharacterDataset = namedtuple('CharacterDataset', ['chars', 'labels', 'image_hashes', 'added_at', 'holdout', 'stats'])
+
+
+def label_from_filename(filename):
+    return os.path.splitext(filename)[0].split('_')[0]
+
+
+def hash_image_bytes(image_bytes):
+    return hashlib.sha1(image_bytes).hexdigest()
+
+
+def is_holdout(image_hash):
+    """Ảnh thuộc tập kiểm tra giữ riêng hay không; cố định theo nội dung ảnh, không phụ thuộc lần chạy."""
+    return int(image_hash[:8], 16) % 100 < HOLDOUT_PERCENT
+
+
+class CharacterCache:
+    """
+    `index.json` ánh xạ mã băm ảnh -> {'start': vị trí ký tự đầu tiên trong `chars.u8`, 'added_at', 'label'},
+    'start' = None với ảnh không tách được ký tự (để không phải tách lại).
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.chars_path = os.path.join(cache_dir, CHARS_FILENAME)
+        self.index_path = os.path.join(cache_dir, INDEX_FILENAME)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index, self.num_chars = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+            return saved['images'], saved['num_chars']
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return {}, 0
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'num_chars': self.num_chars, 'images': self.index}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def add_images(self, new_images):
+        """Tách ký tự cho các ảnh chưa có trong bộ nhớ đệm. `new_images`: danh sách (mã băm, bytes)."""
+        if not new_images:
+            return 0
+        now = time.time()
+        with open(self.chars_path, 'ab') as f:
+            # Bỏ phần ghi dở của lần chạy bị ngắt trước đó (chưa kịp lưu vào index)
+            f.truncate(self.num_chars * CHAR_SIZE)
+            for image_hash, image_bytes in new_images:
+                chars = segment_image_bytes(image_bytes)
+                if len(chars) == CAPTCHA_LENGTH:
+                    f.write(np.asarray(chars, dtype=np.uint8).tobytes())
+                    self.index[image_hash] = {'start': self.num_chars, 'added_at': now}
+                    self.num_chars += CAPTCHA_LENGTH
+                else:
+                    self.index[image_hash] = {'start': None, 'added_at': now}
+        self._save_index()
+        return len(new_images)
+
+    def update_labels(self, labelled):
+        """
+        Ghi nhãn hiện tại của các ảnh (`labelled`: danh sách (mã băm, nhãn)); ảnh đổi nhãn so với lần trước
+        được gán lại 'added_at'. Trả về số ảnh đổi nhãn.
+        """
+        now, changed, relabelled = time.time(), False, 0
+        for image_hash, label in labelled:
+            entry = self.index[image_hash]
+            if entry.get('label') == label:
+                continue
+            if 'label' in entry:
+                entry['added_at'] = now
+                relabelled += 1
+            entry['label'] = label
+            changed = True
+        if changed:
+            self._save_index()
+        return relabelled
+
+    def chars(self):
+        """Toàn bộ ký tự đã lưu dưới dạng `np.memmap` chỉ đọc (không nạp cả tệp vào bộ nhớ)."""
+        if not self.num_chars:
+            return np.empty((0, IMAGE_HEIGHT, IMAGE_WIDTH), dtype=np.uint8)
+        return np.memmap(self.chars_path, dtype=np.uint8, mode='r', shape=(self.num_chars, IMAGE_HEIGHT, IMAGE_WIDTH))
+
+
+def load_character_dataset(image_folder, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Cập nhật bộ nhớ đệm với các ảnh mới trong `image_folder` rồi trả về `CharacterDataset`
+    gồm ký tự của mọi ảnh có nhãn hợp lệ, mỗi nội dung ảnh một lần.
+    """
+    cache = CharacterCache(cache_dir)
+    labelled, new_images = [], []
+    seen = set()
+    duplicates = 0
+    for filename in sorted(os.listdir(image_folder)):
+        if not filename.lower().endswith(IMAGE_EXTENSIONS): continue
+        captcha_text = label_from_filename(filename)
+        if len(captcha_text) != CAPTCHA_LENGTH: continue
+        with open(os.path.join(image_folder, filename), 'rb') as f:
+            image_bytes = f.read()
+        image_hash = hash_image_bytes(image_bytes)
+        if image_hash in seen:
+            duplicates += 1
+            continue
+        seen.add(image_hash)
+        labelled.append((image_hash, captcha_text))
+        if image_hash not in cache.index:
+            new_images.append((image_hash, image_bytes))
+
+    segmented = cache.add_images(new_images)
+    relabelled = cache.update_labels(labelled)
+    all_chars = cache.chars()
+    rows, labels, image_hashes, added_at = [], [], [], []
+    failed = 0
+    for image_hash, captcha_text in labelled:
+        start = cache.index[image_hash]['start']
+        if start is None:
+            failed += 1
+            continue
+        rows.extend(range(start, start + CAPTCHA_LENGTH))
+        labels.extend(captcha_text)
+        image_hashes.extend([image_hash] * CAPTCHA_LENGTH)
+        added_at.extend([cache.index[image_hash]['added_at']] * CAPTCHA_LENGTH)
+
+    stats = {'images': len(labelled), 'new_images': segmented, 'relabelled': relabelled, 'duplicates': duplicates,
+             'segmentation_failed': failed}
+    chars = all_chars[np.asarray(rows, dtype=np.int64)] if rows else all_chars[:0]
+    holdout = np.asarray([is_holdout(image_hash) for image_hash in image_hashes], dtype=bool)
+    return CharacterDataset(chars, labels, image_hashes, np.asarray(added_at, dtype=np.float64), holdout, stats)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+MODULE LỌC CAPTCHA THEO ĐỘ TIN CẬY (V1)
+========================================
+Bỏ qua (không gửi) các dự đoán có điểm tin cậy thấp và lấy CAPTCHA mới ngay, vì một lần gửi sai
+tốn thời gian chờ phản hồi lâu hơn nhiều so với một lần `getCaptcha()`.
+- Mỗi lần gửi được ghi lại (điểm tin cậy, đúng/sai, thời gian chờ, ngưỡng đang dùng, trọng số)
+  vào `captcha_outcomes.jsonl`.
+- Ngưỡng được chọn từ các kết quả đã ghi để giảm thời gian trung bình cho mỗi lần giải đúng:
+      (P(bỏ qua)·t_bỏ_qua + P(gửi, đúng)·t_đúng + P(gửi, sai)·t_sai) / P(gửi, đúng)
+- Khi chưa đủ dữ liệu, mọi dự đoán đều được gửi; sau đó chỉ một tỉ lệ `explore_rate` dự đoán dưới ngưỡng
+  vẫn được gửi. Các lần gửi này được ghi với trọng số 1/explore_rate (mỗi lần đại diện cho cả các dự đoán
+  cùng mức điểm đã bị bỏ qua), nên phân bố điểm dùng để chọn ngưỡng không bị lệch về phía điểm cao.
+"""
+import os
+import json
+import random
+import threading
+
+DEFAULT_SETTINGS = {
+    'enabled': True,
+    'outcomes_file': 'captcha_outcomes.jsonl',
+    'min_outcomes': 50,          # Số lần gửi tối thiểu trước khi bắt đầu bỏ qua
+    'explore_rate': 0.05,        # Tỉ lệ dự đoán dưới ngưỡng vẫn được gửi
+    'max_skips_per_tk': 10,      # Số lần bỏ qua tối đa cho mỗi tờ khai
+    'skip_cost_seconds': 1.0,    # Thời gian ước tính để lấy CAPTCHA mới
+}
+MAX_OUTCOMES = 5000  # Chỉ dùng các kết quả gần nhất
+RETUNE_EVERY = 20
+
+
+class ConfidenceGate:
+    def __init__(self, settings=None, base_dir="."):
+        self.settings = {**DEFAULT_SETTINGS, **(settings or {})}
+        self.path = self.settings['outcomes_file']
+        if not os.path.isabs(self.path):
+            self.path = os.path.join(base_dir, self.path)
+        self._lock = threading.Lock()
+        self._rng = random.Random()
+        self.outcomes = self._load()
+        self._since_tune = 0
+        self.threshold = self.tune()
+
+    def _load(self):
+        outcomes = []
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        outcomes.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+        except FileNotFoundError:
+            pass
+        return outcomes[-MAX_OUTCOMES:]
+
+    def tune(self):
+        """Chọn ngưỡng có thời gian trung bình cho mỗi lần giải đúng nhỏ nhất; 0.0 nếu chưa đủ dữ liệu."""
+        with self._lock:
+            outcomes = list(self.outcomes)
+        if len(outcomes) < self.settings['min_outcomes'] or not any(o['correct'] for o in outcomes):
+            return 0.0
+
+        def weight(outcome):
+            return outcome.get('weight', 1.0)
+
+        def mean_seconds(correct, default):
+            matching = [o for o in outcomes if o['correct'] == correct]
+            total_weight = sum(weight(o) for o in matching)
+            return sum(weight(o) * o['seconds'] for o in matching) / total_weight if total_weight else default
+        correct_cost = mean_seconds(True, 2.0)
+        wrong_cost = mean_seconds(False, 4.0)
+        skip_cost = self.settings['skip_cost_seconds']
+
+        # Duyệt các ngưỡng theo điểm tăng dần; với ngưỡng = điểm của outcomes[i], các lần gửi là outcomes[i:]
+        outcomes.sort(key=lambda o: o['score'])
+        total = sum(weight(o) for o in outcomes)
+        correct = sum(weight(o) for o in outcomes if o['correct'])
+        skipped = 0.0
+        best_threshold, best_cost = 0.0, None
+        for i, outcome in enumerate(outcomes):
+            if correct <= 0:
+                break
+            if i == 0 or outcome['score'] != outcomes[i - 1]['score']:
+                threshold = 0.0 if i == 0 else outcome['score']
+                submitted = total - skipped
+                cost = (skipped * skip_cost + correct * correct_cost + (submitted - correct) * wrong_cost) / correct
+                if best_cost is None or cost < best_cost:
+                    best_threshold, best_cost = threshold, cost
+            skipped += weight(outcome)
+            if outcome['correct']:
+                correct -= weight(outcome)
+        return best_threshold
+
+    def should_skip(self, score):
+        """True nếu nên bỏ qua dự đoán này và lấy CAPTCHA mới."""
+        if not self.settings['enabled'] or score >= self.threshold:
+            return False
+        return self._rng.random() >= self.settings['explore_rate']
+
+    def record(self, score, correct, seconds, forced=False):
+        """
+        Ghi kết quả của một lần gửi CAPTCHA và chỉnh lại ngưỡng sau mỗi RETUNE_EVERY lần.
+        `forced`: dự đoán được gửi vì đã hết số lần bỏ qua của tờ khai (không phải lần gửi thăm dò).
+        """
+        explore_rate = self.settings['explore_rate']
+        explored = self.settings['enabled'] and not forced and score < self.threshold and explore_rate > 0
+        outcome = {'score': round(score, 4), 'correct': correct, 'seconds': round(seconds, 3),
+                   'threshold': round(self.threshold, 4), 'weight': round(1 / explore_rate, 2) if explored else 1.0}
+        with self._lock:
+            self.outcomes.append(outcome)
+            del self.outcomes[:-MAX_OUTCOMES]
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(outcome) + "\n")
+            self._since_tune += 1
+            retune = self._since_tune >= RETUNE_EVERY
+            if retune:
+                self._since_tune = 0
+        if retune:
+            self.threshold = self.tune()
+
+    def summary(self):
+        return f'Ngưỡng tin cậy CAPTCHA hiện tại: {self.threshold:.3f} (từ {len(self.outcomes)} lần gửi đã ghi).'
+
+
+def open_confidence_gate(config, base_dir="."):
+    """Tạo bộ lọc theo mục 'confidence_gate' trong app_config.json. Trả về None nếu bị tắt."""
+    settings = config.get('confidence_gate', {})
+    if not settings.get('enabled', True):
+        return None
+    return ConfidenceGate(settings, base_dir=base_dir)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+MODULE LƯU TRỮ CAPTCHA GIẢI SAI (V1 - Đánh địa chỉ theo nội dung)
+=================================================================
+Mỗi ảnh CAPTCHA giải sai được lưu một lần trong `failed_captchas/<mã băm>.png`
+(ảnh trùng nội dung bị bỏ qua), kèm một dòng trong `failed_captchas/index.sqlite3`:
+    hash, filename, so_tk, predicted_label, kind ('wrong' | 'timeout'), created_at
+- Liệt kê theo trang (con trỏ `created_at`/`hash`) và đếm bằng truy vấn trên chỉ mục,
+  không cần `os.listdir` cả thư mục.
+- Các ảnh tên cũ (`failed_<so_tk>_<nhãn>_<thời điểm>.png`) được chuyển vào chỉ mục khi mở kho lần đầu.
+"""
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+
+DEFAULT_FOLDER = "failed_captchas"
+INDEX_FILENAME = "index.sqlite3"
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+KIND_WRONG = 'wrong'
+KIND_TIMEOUT = 'timeout'
+LEGACY_PATTERN = re.compile(r'^failed(_timeout)?_(.+)_([^_]+)_(\d+)\.\w+$', re.IGNORECASE)
+COLUMNS = ('hash', 'filename', 'so_tk', 'predicted_label', 'kind', 'created_at')
+
+
+def hash_image_bytes(image_bytes):
+    return hashlib.sha1(image_bytes).hexdigest()
+
+
+class FailedCaptchaStore:
+    def __init__(self, folder=DEFAULT_FOLDER):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        index_path = os.path.join(folder, INDEX_FILENAME)
+        is_new = not os.path.exists(index_path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(index_path, check_same_thread=False, timeout=30)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS failed_captchas ("
+                "hash TEXT PRIMARY KEY, filename TEXT NOT NULL, so_tk TEXT, predicted_label TEXT, "
+                "kind TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS failed_captchas_order ON failed_captchas (created_at, hash)")
+        if is_new:
+            self.import_untracked()
+
+    def path(self, filename):
+        return os.path.join(self.folder, filename)
+
+    def add(self, image_bytes, so_tk=None, predicted_label=None, kind=KIND_WRONG, created_at=None):
+        """Lưu ảnh nếu chưa có ảnh cùng nội dung. Trả về True nếu là ảnh mới."""
+        image_hash = hash_image_bytes(image_bytes)
+        filename = f"{image_hash}.png"
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM failed_captchas WHERE hash = ?", (image_hash,)).fetchone():
+                return False
+            tmp_path = self.path(filename) + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(image_bytes)
+            os.replace(tmp_path, self.path(filename))
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO failed_captchas (hash, filename, so_tk, predicted_label, kind, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (image_hash, filename, so_tk, predicted_label, kind, created_at or time.time())
+                )
+        return True
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM failed_captchas").fetchone()[0]
+
+    def counts_by_kind(self):
+        with self._lock:
+            return dict(self._conn.execute("SELECT kind, COUNT(*) FROM failed_captchas GROUP BY kind").fetchall())
+
+    def page(self, after=None, limit=50):
+        """
+        Tối đa `limit` ảnh theo thứ tự lưu, bắt đầu sau con trỏ `after` = [created_at, hash] của ảnh cuối trang trước.
+        Mỗi ảnh là một dict theo COLUMNS.
+        """
+        query = f"SELECT {', '.join(COLUMNS)} FROM failed_captchas"
+        params = ()
+        if after:
+            query += " WHERE (created_at, hash) > (?, ?)"
+            params = tuple(after)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY created_at, hash LIMIT ?", params + (limit,)).fetchall()
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def find(self, filename):
+        with self._lock:
+            row = self._conn.execute(f"SELECT {', '.join(COLUMNS)} FROM failed_captchas WHERE filename = ?", (filename,)).fetchone()
+        return dict(zip(COLUMNS, row)) if row else None
+
+    def remove(self, image_hash):
+        """Xóa ảnh khỏi chỉ mục (tệp ảnh do người gọi di chuyển/xóa)."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM failed_captchas WHERE hash = ?", (image_hash,))
+
+    def import_untracked(self):
+        """Đưa các ảnh chưa có trong chỉ mục (tên cũ hoặc chép tay vào thư mục) vào kho. Trả về số ảnh mới."""
+        with self._lock:
+            tracked = {row[0] for row in self._conn.execute("SELECT filename FROM failed_captchas")}
+        imported = 0
+        for filename in sorted(os.listdir(self.folder)):
+            if filename in tracked or not filename.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            file_path = self.path(filename)
+            with open(file_path, 'rb') as f:
+                image_bytes = f.read()
+            match = LEGACY_PATTERN.match(filename)
+            if match:
+                kind = KIND_TIMEOUT if match.group(1) else KIND_WRONG
+                so_tk, predicted_label, created_at = match.group(2), match.group(3), float(match.group(4))
+            else:
+                kind, so_tk, predicted_label, created_at = KIND_WRONG, None, None, os.path.getmtime(file_path)
+            is_new = self.add(image_bytes, so_tk, predicted_label, kind, created_at)
+            imported += is_new
+            if filename != f"{hash_image_bytes(image_bytes)}.png":
+                os.remove(file_path)
+        return imported
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_failed_captcha_store(folder=DEFAULT_FOLDER):
+    """Kho dùng chung cho mọi luồng tra cứu trong tiến trình (mỗi thư mục một kho)."""
+    key = os.path.abspath(folder)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = FailedCaptchaStore(folder)
+        return _stores[key]
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 """
-GIAO DIỆN ĐỒ HỌA ĐIỀU KHIỂN QUY TRÌNH TRA CỨU (V7.6 - Đã tách biệt)
-======================================================================
+GIAO DIỆN ĐỒ HỌA ĐIỀU KHIỂN QUY TRÌNH TRA CỨU (V7.8 - Xử lý sự kiện theo lô)
+============================================================================
+Các thư viện nặng (gspread, pandas, selenium, torch, cv2) chỉ được import khi bắt đầu tra cứu.
+Sự kiện từ luồng tra cứu được xử lý theo lô mỗi chu kỳ; nhật ký giới hạn MAX_LOG_LINES dòng.
 """
+import time
+_START_TIME = time.perf_counter()
 
 import tkinter as tk
 from tkinter import scrolledtext, messagebox
@@ -10,13 +14,10 @@ import ttkbootstrap as ttk
 from ttkbootstrap.constants import *
 import threading
 import queue
-import gspread
-import pandas as pd
 import sys
 import json
 import os
-import time
-from http.client import RemoteDisconnected
+from collections import deque
 
 def resource_path(relative_path):
     """ Lấy đường dẫn tuyệt đối đến tài nguyên, hoạt động cho cả môi trường dev và PyInstaller """
@@ -27,7 +28,7 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 try:
-    from batch_processor import run_batch_processing
+    from result_cache import open_result_cache
     from startup_helper import create_startup_shortcut, delete_startup_shortcut, check_shortcut_exists
 except ImportError as e:
     messagebox.showerror("Lỗi Import", f"Không tìm thấy tệp cần thiết: {e}. Vui lòng đảm bảo các tệp .py nằm cùng thư mục.")
@@ -39,12 +40,22 @@ RESULT_FIELDS = [
     "Ngày đăng ký", "Mã đơn vị"
 ]
 CONFIG_FILE = "app_config.json"
+PUMP_INTERVAL_MS = 100      # Chu kỳ lấy sự kiện từ hàng đợi
+PUMP_BUDGET_SECONDS = 0.05  # Thời gian xử lý sự kiện tối đa mỗi chu kỳ, để giao diện luôn phản hồi
+MAX_LOG_LINES = 2000        # Nhật ký chỉ giữ các dòng gần nhất
+
+def read_config():
+    try:
+        with open(CONFIG_FILE, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
 
 class AppController:
     def __init__(self, root):
         self.root = root
-        self.root.title("Công Cụ Tự Động Tra Cứu Tờ Khai v7.6")
-        self.root.geometry("850x750")
+        self.root.title("Công Cụ Tự Động Tra Cứu Tờ Khai v7.8")
+        self.root.geometry("850x860")
 
         self.thread = None
         self.stop_event = threading.Event()
@@ -53,6 +64,10 @@ class AppController:
         self.create_widgets()
         self.load_settings()
         self.periodic_call()
+        self.root.after_idle(self.report_startup_time)
+
+    def report_startup_time(self):
+        self.log(f"Giao diện sẵn sàng sau {time.perf_counter() - _START_TIME:.2f} giây.", "INFO")
 
     def create_widgets(self):
         main_frame = ttk.Frame(self.root, padding="15")
@@ -74,23 +89,25 @@ class AppController:
         self.read_col = tk.StringVar(value="A")
         ttk.Entry(config_frame, textvariable=self.read_col, width=10).grid(row=2, column=1, sticky="w", padx=5, pady=8)
 
-        ttk.Label(config_frame, text="Cột trả kết quả:").grid(row=2, column=2, sticky="w", padx=(20, 5), pady=8)
-        self.write_col = tk.StringVar(value="F")
-        ttk.Entry(config_frame, textvariable=self.write_col, width=10).grid(row=2, column=3, sticky="w", padx=5, pady=8)
-
-        automation_frame = ttk.LabelFrame(main_frame, text=" Tùy chọn & Tự động hóa ", padding="15", bootstyle=PRIMARY)
+        automation_frame = ttk.LabelFrame(main_frame, text=" Trường dữ liệu trả về & Tự động hóa ", padding="15", bootstyle=PRIMARY)
         automation_frame.pack(fill=tk.X, expand=False, pady=(0, 15))
-        automation_frame.grid_columnconfigure(0, weight=2)
-        automation_frame.grid_columnconfigure(1, weight=1)
-
-        ttk.Label(automation_frame, text="Chọn trường dữ liệu trả về:").grid(row=0, column=0, sticky="w", padx=5)
-        self.result_field_var = tk.StringVar(value=RESULT_FIELDS[0])
-        result_combobox = ttk.Combobox(automation_frame, textvariable=self.result_field_var, values=RESULT_FIELDS, state="readonly", bootstyle=PRIMARY)
-        result_combobox.grid(row=1, column=0, sticky="ew", padx=5, pady=5)
+        automation_frame.grid_columnconfigure(0, weight=1)
+        automation_frame.grid_columnconfigure(2, weight=1)
+
+        # Mỗi trường được chọn ghi vào một cột riêng; mọi trường của một lượt được ghi cùng lô
+        ttk.Label(automation_frame, text="Chọn trường và cột ghi kết quả:").grid(row=0, column=0, columnspan=4, sticky="w", padx=5)
+        self.field_vars = {}
+        rows_per_column = (len(RESULT_FIELDS) + 1) // 2
+        for i, field in enumerate(RESULT_FIELDS):
+            enabled_var, col_var = tk.BooleanVar(value=False), tk.StringVar()
+            grid_row, grid_col = 1 + i % rows_per_column, 2 * (i // rows_per_column)
+            ttk.Checkbutton(automation_frame, text=field, variable=enabled_var, bootstyle=PRIMARY).grid(row=grid_row, column=grid_col, sticky="w", padx=5, pady=3)
+            ttk.Entry(automation_frame, textvariable=col_var, width=6).grid(row=grid_row, column=grid_col + 1, sticky="w", padx=5, pady=3)
+            self.field_vars[field] = (enabled_var, col_var)
 
         self.startup_var = tk.BooleanVar()
         startup_check = ttk.Checkbutton(automation_frame, text="Tự động chạy khi mở máy", variable=self.startup_var, bootstyle="success-round-toggle", command=self.toggle_startup_script)
-        startup_check.grid(row=0, column=1, rowspan=2, sticky="w", padx=(20, 5))
+        startup_check.grid(row=rows_per_column + 1, column=0, columnspan=4, sticky="w", padx=5, pady=(10, 0))
 
         log_frame = ttk.LabelFrame(main_frame, text=" Điều khiển & Nhật ký hoạt động ", padding="10", bootstyle=INFO)
         log_frame.pack(fill=tk.BOTH, expand=True)
@@ -103,9 +120,14 @@ class AppController:
         self.stop_button.pack(side=tk.LEFT, padx=5, expand=True, fill=tk.X)
 
         self.progress_bar = ttk.Progressbar(log_frame, orient="horizontal", mode="determinate", bootstyle=STRIPED)
-        self.progress_bar.pack(fill=tk.X, expand=False, pady=(0, 10))
+        self.progress_bar.pack(fill=tk.X, expand=False, pady=(0, 2))
+        self.eta_label = ttk.Label(log_frame, text="")
+        self.eta_label.pack(anchor=tk.E, pady=(0, 8))
         self.log_area = scrolledtext.ScrolledText(log_frame, wrap=tk.WORD, state='disabled', height=15)
         self.log_area.pack(fill=tk.BOTH, expand=True)
+        self.log_area.tag_config("SUCCESS", foreground="green")
+        self.log_area.tag_config("ERROR", foreground="red")
+        self.log_area.tag_config("INFO", foreground="blue")
 
     def toggle_startup_script(self):
         self.save_settings()
@@ -122,41 +144,70 @@ class AppController:
             if is_enabled: self.startup_var.set(False)
 
     def log(self, message, style=""):
+        self.log_lines([(message, style)])
+
+    def log_lines(self, lines):
+        """Thêm nhiều dòng nhật ký trong một lần cập nhật; chỉ giữ MAX_LOG_LINES dòng gần nhất."""
+        if not lines:
+            return
         self.log_area.config(state='normal')
-        self.log_area.insert(tk.END, message + "\n", style)
+        for message, style in lines:
+            self.log_area.insert(tk.END, message + "\n", style)
+        excess = int(self.log_area.index('end-1c').split('.')[0]) - 1 - MAX_LOG_LINES
+        if excess > 0:
+            self.log_area.delete('1.0', f'{excess + 1}.0')
         self.log_area.config(state='disabled')
         self.log_area.see(tk.END)
-        self.log_area.tag_config("SUCCESS", foreground="green")
-        self.log_area.tag_config("ERROR", foreground="red")
-        self.log_area.tag_config("INFO", foreground="blue")
 
     def periodic_call(self):
-        self.root.after(200, self.periodic_call)
-        try:
-            msg = self.q.get(block=False)
+        """
+        Lấy hết sự kiện đang chờ (trong giới hạn PUMP_BUDGET_SECONDS), gộp nhật ký thành một lần chèn
+        và chỉ cập nhật thanh tiến trình/ETA theo sự kiện mới nhất.
+        """
+        self.root.after(PUMP_INTERVAL_MS, self.periodic_call)
+        deadline = time.monotonic() + PUMP_BUDGET_SECONDS
+        lines = deque(maxlen=MAX_LOG_LINES)
+        progress_value, eta_event = None, None
+        while time.monotonic() < deadline:
+            try:
+                msg = self.q.get(block=False)
+            except queue.Empty:
+                break
             status, message, value = msg.get('status'), msg.get('message'), msg.get('value')
-            
+
+            if msg.get('eta_seconds') is not None:
+                eta_event = msg
             if status == 'PROGRESS':
-                self.log(f"[Tiến trình] {message}", "INFO")
-                if value is not None: self.progress_bar['value'] = value
+                lines.append((f"[Tiến trình] {message}", "INFO"))
+                if value is not None: progress_value = value
             elif status in ['ERROR', 'FINAL_ERROR', 'FATAL_ERROR']:
-                self.log(f"[LỖI] {message}", "ERROR")
+                lines.append((f"[LỖI] {message}", "ERROR"))
             elif status == 'RESULT':
                 so_tk, data = msg.get('so_tk'), msg.get('data')
-                self.log(f"[THÀNH CÔNG] Tờ khai {so_tk} - Luồng: {data.get('Tên luồng', 'N/A')}", "SUCCESS")
-                self.write_single_result_to_sheet(so_tk, data)
+                lines.append((f"[THÀNH CÔNG] Tờ khai {so_tk} - Luồng: {data.get('Tên luồng', 'N/A')}", "SUCCESS"))
             elif status == 'STOPPED' or status == 'DONE':
-                self.log(f"[HOÀN TẤT] {message}", "INFO")
-                self.progress_bar['value'] = 100
+                lines.append((f"[HOÀN TẤT] {message}", "INFO"))
+                progress_value, eta_event = 100, None
+                self.eta_label.config(text="")
                 self.run_button.config(state="normal")
                 self.stop_button.config(state="disabled")
                 self.thread = None
-        except queue.Empty:
-            pass
+
+        self.log_lines(lines)
+        if progress_value is not None:
+            self.progress_bar['value'] = progress_value
+        if eta_event is not None:
+            minutes, seconds = divmod(int(eta_event['eta_seconds']), 60)
+            self.eta_label.config(text=f"{eta_event['rate_per_minute']:.1f} tờ khai/phút - còn khoảng {minutes} phút {seconds:02d} giây")
 
     def start_processing_thread(self):
-        if not all([self.g_sheet_url.get(), self.sheet_name.get(), self.read_col.get(), self.write_col.get()]):
-            messagebox.showerror("Thiếu thông tin", "Vui lòng điền đầy đủ thông tin cấu hình.")
+        field_columns = self.selected_field_columns()
+        if not all([self.g_sheet_url.get(), self.sheet_name.get(), self.read_col.get(), field_columns]):
+            messagebox.showerror("Thiếu thông tin", "Vui lòng điền đầy đủ thông tin cấu hình và chọn ít nhất một trường kèm cột ghi.")
+            return
+        invalid = [col for col in field_columns.values() if not col.isalpha()]
+        if invalid:
+            messagebox.showerror("Cột không hợp lệ", f"Cột ghi kết quả phải là chữ cái (ví dụ DD): {', '.join(invalid)}")
             return
         
         self.save_settings()
@@ -164,6 +215,7 @@ class AppController:
         self.stop_button.config(state="normal")
         self.log_area.config(state='normal'); self.log_area.delete('1.0', tk.END); self.log_area.config(state='disabled')
         self.progress_bar['value'] = 0
+        self.eta_label.config(text="")
         self.stop_event.clear()
 
         self.thread = threading.Thread(target=self.worker, daemon=True)
@@ -176,9 +228,22 @@ class AppController:
             self.stop_button.config(state="disabled")
 
     def worker(self):
+        import gspread
+        import captcha_solver
+        writer = None
+        result_cache = None
+        metrics = None
         try:
+            # Nạp model trên luồng nền trong lúc kết nối Google Sheets
+            captcha_solver.warm_up()
+            from worker_pool import run_lookup
+            from sheet_writer import SheetWriter
+            from sheet_tasks import load_pending_tasks
+            from run_metrics import RunMetrics, track, profile_run
+
             url, sheet_name = self.g_sheet_url.get(), self.sheet_name.get()
-            read_col, write_col = self.read_col.get().upper(), self.write_col.get().upper()
+            read_col = self.read_col.get().upper()
+            field_columns = self.selected_field_columns()
             
             self.q.put({'status': 'PROGRESS', 'message': 'Đang kết nối đến Google Sheets...'})
             
@@ -192,23 +257,34 @@ class AppController:
             spreadsheet = gc.open_by_url(url)
             self.worksheet = spreadsheet.worksheet(sheet_name)
             
-            all_records = self.worksheet.get_all_records()
-            df = pd.DataFrame(all_records)
-            read_col_name = df.columns[gspread.utils.a1_to_rowcol(read_col + '1')[1] - 1]
-            write_col_name = df.columns[gspread.utils.a1_to_rowcol(write_col + '1')[1] - 1]
-            df_todo = df[df[write_col_name] == '']
-            tasks = [{'so_tk': str(row[read_col_name]).strip(), 'row_index': index + 2} for index, row in df_todo.iterrows() if str(row[read_col_name]).strip().isdigit()]
+            tasks = load_pending_tasks(self.worksheet, read_col, field_columns.values())
 
             if not tasks: raise ValueError('Không có tờ khai nào cần xử lý.')
             
-            self.tasks_map = {task['so_tk']: task['row_index'] for task in tasks}
+            # Một Số TK có thể nằm ở nhiều dòng: chỉ tra cứu một lần, ghi kết quả vào mọi dòng
+            self.tasks_map = {}
+            for task in tasks:
+                self.tasks_map.setdefault(task['so_tk'], []).append(task['row_index'])
             so_tk_list_to_process = list(self.tasks_map.keys())
 
-            self.q.put({'status': 'PROGRESS', 'message': f'Tìm thấy {len(so_tk_list_to_process)} tờ khai cần xử lý.'})
+            self.q.put({'status': 'PROGRESS', 'message': f'Tìm thấy {len(so_tk_list_to_process)} tờ khai cần xử lý ({len(tasks)} dòng).'})
+
+            metrics = RunMetrics(total=len(so_tk_list_to_process))
 
-            for result in run_batch_processing(so_tk_list_to_process, self.stop_event):
-                self.q.put(result)
-                if self.stop_event.is_set(): break
+            def on_writer_event(event):
+                metrics.add(event)
+                self.q.put(event)
+
+            # Kết quả được ghi theo lô trên luồng nền, không chặn giao diện và vòng lặp tra cứu
+            writer = SheetWriter(self.worksheet, on_event=on_writer_event)
+            config = read_config()
+            result_cache = open_result_cache(config, base_dir=os.path.abspath("."))
+            with profile_run(config.get('profiling')):
+                for result in track(run_lookup(so_tk_list_to_process, self.stop_event, config, result_cache=result_cache), metrics):
+                    self.q.put(result)
+                    if result.get('status') == 'RESULT':
+                        self.write_result_to_sheet(writer, field_columns, result.get('so_tk'), result.get('data'))
+                    if self.stop_event.is_set(): break
 
         except FileNotFoundError as e:
             self.q.put({'status': 'FATAL_ERROR', 'message': f"Lỗi: {e}. Hãy đảm bảo tệp credentials.json tồn tại và đã chia sẻ Sheet với client_email."})
@@ -218,44 +294,32 @@ class AppController:
             self.q.put({'status': 'FATAL_ERROR', 'message': f"Lỗi: Không tìm thấy Sheet có tên '{sheet_name}'. Vui lòng kiểm tra lại Tên Sheet."})
         except Exception as e:
             self.q.put({'status': 'FATAL_ERROR', 'message': f"Lỗi nghiêm trọng: {e}"})
-        
+        finally:
+            if writer:
+                self.q.put({'status': 'PROGRESS', 'message': 'Đang ghi nốt các kết quả còn lại lên Google Sheet...'})
+                writer.close()
+            if result_cache:
+                result_cache.close()
+            if metrics:
+                for line in metrics.summary():
+                    self.q.put({'status': 'PROGRESS', 'message': f'[Thống kê] {line}'})
+
         if self.stop_event.is_set():
             self.q.put({'status': 'STOPPED', 'message': 'Chương trình đã dừng theo yêu cầu của người dùng.'})
         else:
             self.q.put({'status': 'DONE', 'message': 'Đã hoàn tất tất cả các tác vụ.'})
 
-    def write_single_result_to_sheet(self, so_tk, data):
-        MAX_WRITE_RETRIES = 3
-        RETRY_DELAY_SECONDS = 5
-        for attempt in range(MAX_WRITE_RETRIES):
-            try:
-                row_to_update = self.tasks_map.get(so_tk)
-                if not row_to_update: return
-
-                write_col_index = gspread.utils.a1_to_rowcol(self.write_col.get().upper() + '1')[1]
-                selected_field = self.result_field_var.get()
-                result_value = data.get(selected_field, "N/A")
-                result_str_to_write = f"'{result_value}"
-                
-                self.worksheet.update_cell(row_to_update, write_col_index, result_str_to_write)
-                return 
-            
-            except (gspread.exceptions.APIError, RemoteDisconnected) as e:
-                self.q.put({'status': 'ERROR', 'message': f'Lỗi mạng khi ghi kết quả cho TK {so_tk} (lần thử {attempt + 1}/{MAX_WRITE_RETRIES})...'})
-                if attempt < MAX_WRITE_RETRIES - 1:
-                    time.sleep(RETRY_DELAY_SECONDS)
-                else:
-                    self.q.put({'status': 'FINAL_ERROR', 'message': f'Không thể ghi kết quả cho TK {so_tk} sau {MAX_WRITE_RETRIES} lần thử.'})
-            except Exception as e:
-                self.q.put({'status': 'FATAL_ERROR', 'message': f'Lỗi không xác định khi ghi kết quả cho TK {so_tk}: {e}'})
-                return
+    def write_result_to_sheet(self, writer, field_columns, so_tk, data):
+        for row_to_update in self.tasks_map.get(so_tk, ()):
+            writer.write_fields(row_to_update, field_columns, data)
+
+    def selected_field_columns(self):
+        """Ánh xạ trường -> cột (chữ in hoa) của các trường được chọn và đã nhập cột."""
+        return {field: col_var.get().strip().upper() for field, (enabled_var, col_var) in self.field_vars.items()
+                if enabled_var.get() and col_var.get().strip()}
 
     def save_settings(self):
-        try:
-            with open(CONFIG_FILE, 'r') as f:
-                config = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            config = {}
+        config = read_config()
 
         if 'gui_app' not in config:
             config['gui_app'] = {}
@@ -264,8 +328,7 @@ class AppController:
             'g_sheet_url': self.g_sheet_url.get(),
             'sheet_name': self.sheet_name.get(),
             'read_col': self.read_col.get(),
-            'write_col': self.write_col.get(),
-            'result_field': self.result_field_var.get()
+            'field_columns': self.selected_field_columns()
         }
 
         with open(CONFIG_FILE, 'w') as f:
@@ -280,11 +343,16 @@ class AppController:
             self.g_sheet_url.set(gui_settings.get('g_sheet_url', ''))
             self.sheet_name.set(gui_settings.get('sheet_name', 'Sheet1'))
             self.read_col.set(gui_settings.get('read_col', 'A'))
-            self.write_col.set(gui_settings.get('write_col', 'F'))
-            
-            saved_field = gui_settings.get('result_field', RESULT_FIELDS[0])
-            if saved_field in RESULT_FIELDS:
-                self.result_field_var.set(saved_field)
+
+            field_columns = gui_settings.get('field_columns')
+            if not field_columns and gui_settings.get('result_field'):
+                # Cấu hình cũ: một trường 'result_field' ghi vào 'write_col'
+                field_columns = {gui_settings['result_field']: gui_settings.get('write_col', 'F')}
+            for field, col in (field_columns or {}).items():
+                if field in self.field_vars:
+                    enabled_var, col_var = self.field_vars[field]
+                    enabled_var.set(True)
+                    col_var.set(col)
 
         except (FileNotFoundError, json.JSONDecodeError):
             pass
@@ -293,8 +361,11 @@ class AppController:
 
 if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1] == '--headless':
-        from headless_logic import run_headless_mode
-        run_headless_mode()
+        from headless_logic import run_headless_mode, run_watch_mode, is_watch_enabled
+        if '--watch' in sys.argv[2:] or is_watch_enabled():
+            run_watch_mode()
+        else:
+            run_headless_mode()
     else:
         root = ttk.Window(themename="litera")
         app = AppController(root)
@@ -8,9 +8,9 @@ import os
 import sys
 import json
 import logging
+import time
 import threading
 import gspread
-import pandas as pd
 
 def resource_path(relative_path):
     """ Lấy đường dẫn tuyệt đối đến tài nguyên, hoạt động cho cả môi trường dev và PyInstaller """
@@ -25,17 +25,25 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(current_dir)
 
 try:
-    from batch_processor import run_batch_processing
+    from batch_processor import create_driver
+    from worker_pool import run_lookup, DEFAULT_ENGINE
+    from sheet_writer import SheetWriter, MAX_REQUESTS_PER_MINUTE
+    from sheet_tasks import load_pending_tasks, field_columns_from
+    from result_cache import open_result_cache
+    from run_metrics import RunMetrics, track, profile_run
 except ImportError:
     # Cấu hình logging cơ bản để ghi lại lỗi import
     log_dir = os.path.dirname(os.path.abspath(__file__))
     logging.basicConfig(filename=os.path.join(log_dir, 'scheduler_error.log'), level=logging.ERROR)
-    logging.error("Không thể import 'batch_processor'. Đảm bảo các tệp nằm cùng thư mục.")
+    logging.error("Không thể import các module xử lý ('batch_processor', 'worker_pool', 'sheet_writer', 'sheet_tasks', 'result_cache', 'run_metrics'). Đảm bảo các tệp nằm cùng thư mục.")
     sys.exit(1)
 
 # --- CẤU HÌNH ---
 CONFIG_FILE = "app_config.json"
 LOG_FILE = "scheduler.log"
+CHECKPOINT_FILE = "watch_checkpoint.json"
+DEFAULT_POLL_SECONDS = 120
+DEFAULT_RECHECK_HOURS = 12
 
 def setup_logging():
     """Cấu hình logging để ghi vào tệp."""
@@ -46,89 +54,308 @@ def setup_logging():
         filemode='a'
     )
 
+def log_event(result):
+    """Ghi một sự kiện của quy trình tra cứu (hoặc của bộ ghi Sheet) vào tệp log."""
+    status = result.get('status')
+    message = result.get('message')
+
+    if status == 'PROGRESS':
+        logging.info(f"[Tiến trình] {message}")
+    elif status in ['ERROR', 'FINAL_ERROR', 'FATAL_ERROR']:
+        logging.error(f"[LỖI] {message}")
+    elif status == 'RESULT':
+        data = result.get('data')
+        logging.info(f"[THÀNH CÔNG] Tờ khai {result.get('so_tk')} - Luồng: {data.get('Tên luồng', 'N/A')}")
+
+def load_config():
+    """Đọc app_config.json."""
+    with open(resource_path(CONFIG_FILE), 'r') as f:
+        return json.load(f)
+
+def sheet_settings(job):
+    """Lấy và kiểm tra cấu hình một Sheet ({g_sheet_url, sheet_name, read_col, field_columns})."""
+    settings = {
+        'url': job.get('g_sheet_url'),
+        'sheet_name': job.get('sheet_name'),
+        'read_col': (job.get('read_col') or 'A').upper(),
+        'field_columns': field_columns_from(job),
+    }
+    if not all(settings.values()):
+        raise ValueError(f"Cấu hình Sheet '{settings['sheet_name'] or '?'}' trong 'app_config.json' bị thiếu.")
+    return settings
+
+def load_jobs(config):
+    """
+    Danh sách công việc của chế độ chạy nền và chế độ theo dõi: mục 'headless_jobs' (mỗi phần tử có cùng các khóa
+    với mục 'gui_app': g_sheet_url, sheet_name, read_col, field_columns), hoặc chỉ Sheet trong 'gui_app'.
+    Công việc có cấu hình không hợp lệ được ghi lỗi và bỏ qua; báo lỗi nếu không còn công việc nào.
+    """
+    jobs = []
+    for job in config.get('headless_jobs') or [config.get('gui_app', {})]:
+        try:
+            jobs.append(sheet_settings(job))
+        except ValueError as e:
+            log_event({'status': 'ERROR', 'message': f"Bỏ qua công việc: {e}"})
+    if not jobs:
+        raise ValueError("Không có Sheet hợp lệ nào trong 'app_config.json'.")
+    return jobs
+
+def open_client():
+    """Kết nối Google Sheets bằng Service Account."""
+    # === SỬA LỖI XÁC THỰC ===
+    # Sử dụng gspread.service_account cho đúng loại credentials
+    credentials_path = resource_path('credentials.json')
+
+    if not os.path.exists(credentials_path):
+        raise FileNotFoundError("Không tìm thấy tệp credentials.json. Vui lòng đảm bảo tệp này nằm cùng thư mục với ứng dụng.")
+
+    gc = gspread.service_account(filename=credentials_path)
+    # === KẾT THÚC SỬA LỖI ===
+    return gc
+
+def open_job_worksheets(jobs):
+    """
+    Mở worksheet của từng công việc (mỗi bảng tính chỉ mở một lần), trả về danh sách (job, spreadsheet, worksheet).
+    Một Sheet lỗi được ghi lỗi và bỏ qua, không làm dừng các Sheet còn lại.
+    """
+    gc = open_client()
+    spreadsheets, opened = {}, []
+    for job in jobs:
+        try:
+            if job['url'] not in spreadsheets:
+                spreadsheets[job['url']] = gc.open_by_url(job['url'])
+            opened.append((job, spreadsheets[job['url']], spreadsheets[job['url']].worksheet(job['sheet_name'])))
+        except Exception as e:
+            logging.error(f"Bỏ qua Sheet '{job['sheet_name']}': {e}")
+    return opened
+
+def process_tasks(job_tasks, config, result_cache, stop_event, driver=None):
+    """
+    Tra cứu các tờ khai của mọi công việc trong `job_tasks` (danh sách (settings, worksheet, tasks))
+    và ghi kết quả theo lô lên từng Sheet. Mỗi Số TK chỉ được tra cứu một lần, kết quả được ghi vào
+    mọi dòng có Số TK đó (kể cả các dòng trùng trong cùng một Sheet).
+    Trả về (tập so_tk đã có kết quả, True nếu mất kết nối với trình duyệt).
+    """
+    targets = {}  # so_tk -> [(vị trí công việc, dòng), ...]
+    for job_index, (_, _, tasks) in enumerate(job_tasks):
+        for task in tasks:
+            targets.setdefault(task['so_tk'], []).append((job_index, task['row_index']))
+    so_tk_list_to_process = list(targets)
+    total_rows = sum(len(rows) for rows in targets.values())
+    logging.info(f"Tìm thấy {len(so_tk_list_to_process)} tờ khai cần xử lý ({total_rows} dòng trên {len(job_tasks)} Sheet).")
+
+    completed, browser_lost = set(), False
+    metrics = RunMetrics(total=len(so_tk_list_to_process))
+
+    def on_writer_event(event):
+        metrics.add(event)
+        log_event(event)
+
+    # Các bộ ghi chia nhau hạn mức ghi của Sheets API
+    requests_per_minute = max(1, MAX_REQUESTS_PER_MINUTE // len(job_tasks))
+    writers = [SheetWriter(worksheet, on_event=on_writer_event, max_requests_per_minute=requests_per_minute)
+               for _, worksheet, _ in job_tasks]
+    try:
+        with profile_run(config.get('profiling')):
+            for result in track(run_lookup(so_tk_list_to_process, stop_event, config, result_cache=result_cache, driver=driver), metrics):
+                log_event(result)
+                status = result.get('status')
+                if status == 'RESULT':
+                    so_tk = result.get('so_tk')
+                    completed.add(so_tk)
+                    for job_index, row_to_update in targets.get(so_tk, ()):
+                        writers[job_index].write_fields(row_to_update, job_tasks[job_index][0]['field_columns'], result.get('data'))
+                elif status == 'FATAL_ERROR':
+                    browser_lost = True
+    finally:
+        logging.info("Đang ghi nốt các kết quả còn lại lên Sheet...")
+        for writer in writers:
+            writer.close()
+        logging.info(f"Đã ghi {sum(w.cells_written for w in writers)} ô kết quả với {sum(w.api_calls for w in writers)} lần gọi API.")
+        for line in metrics.summary():
+            logging.info(f"[Thống kê] {line}")
+    return completed, browser_lost
+
 def run_headless_mode():
     """Hàm chính để thực hiện quy trình chạy nền."""
     setup_logging()
     logging.info("="*20 + " BẮT ĐẦU PHIÊN LÀM VIỆC TỰ ĐỘNG (STARTUP) " + "="*20)
 
+    result_cache = None
     try:
         # 1. Tải cấu hình
         logging.info("Đang tải cấu hình từ 'app_config.json'...")
-        config_path = resource_path(CONFIG_FILE)
-        with open(config_path, 'r') as f:
-            config = json.load(f)
-        gui_settings = config.get('gui_app', {})
-        
-        url = gui_settings.get('g_sheet_url')
-        sheet_name = gui_settings.get('sheet_name')
-        read_col = gui_settings.get('read_col', 'A').upper()
-        write_col = gui_settings.get('write_col', 'F').upper()
-        selected_field = gui_settings.get('result_field')
-
-        if not all([url, sheet_name, read_col, write_col, selected_field]):
-            raise ValueError("Cấu hình trong 'app_config.json' bị thiếu.")
-        
-        # 2. Kết nối Google Sheet và lấy công việc
+        config = load_config()
+        jobs = load_jobs(config)
+
+        # 2. Kết nối Google Sheet và lấy công việc của từng Sheet
         logging.info("Đang kết nối đến Google Sheets...")
-        
-        # === SỬA LỖI XÁC THỰC ===
-        # Sử dụng gspread.service_account cho đúng loại credentials
-        credentials_path = resource_path('credentials.json')
-
-        if not os.path.exists(credentials_path):
-            raise FileNotFoundError("Không tìm thấy tệp credentials.json. Vui lòng đảm bảo tệp này nằm cùng thư mục với ứng dụng.")
-            
-        gc = gspread.service_account(filename=credentials_path)
-        # === KẾT THÚC SỬA LỖI ===
-        
-        spreadsheet = gc.open_by_url(url)
-        worksheet = spreadsheet.worksheet(sheet_name)
-        
-        logging.info("Đang đọc và lọc dữ liệu từ Sheet...")
-        all_records = worksheet.get_all_records()
-        df = pd.DataFrame(all_records)
-
-        read_col_name = df.columns[gspread.utils.a1_to_rowcol(read_col + '1')[1] - 1]
-        write_col_name = df.columns[gspread.utils.a1_to_rowcol(write_col + '1')[1] - 1]
-
-        df_todo = df[df[write_col_name] == '']
-        tasks = [{'so_tk': str(row[read_col_name]).strip(), 'row_index': index + 2} for index, row in df_todo.iterrows() if str(row[read_col_name]).strip().isdigit()]
-
-        if not tasks:
+        job_tasks = []
+        for job, _, worksheet in open_job_worksheets(jobs):
+            try:
+                logging.info(f"Đang đọc và lọc dữ liệu từ Sheet '{job['sheet_name']}'...")
+                tasks = load_pending_tasks(worksheet, job['read_col'], job['field_columns'].values())
+            except Exception as e:
+                # Một Sheet lỗi không làm dừng các Sheet còn lại
+                logging.error(f"Bỏ qua Sheet '{job['sheet_name']}': {e}")
+                continue
+            logging.info(f"Sheet '{job['sheet_name']}': {len(tasks)} dòng cần xử lý.")
+            if tasks:
+                job_tasks.append((job, worksheet, tasks))
+
+        if not job_tasks:
             logging.info("Không có tờ khai nào cần xử lý. Kết thúc phiên.")
             return
 
-        tasks_map = {task['so_tk']: task['row_index'] for task in tasks}
-        so_tk_list_to_process = list(tasks_map.keys())
-        logging.info(f"Tìm thấy {len(so_tk_list_to_process)} tờ khai cần xử lý.")
-
-        # 3. Chạy quy trình tra cứu
-        stop_event = threading.Event() 
-        for result in run_batch_processing(so_tk_list_to_process, stop_event):
-            status = result.get('status')
-            message = result.get('message')
-            
-            if status == 'PROGRESS':
-                logging.info(f"[Tiến trình] {message}")
-            elif status in ['ERROR', 'FINAL_ERROR', 'FATAL_ERROR']:
-                logging.error(f"[LỖI] {message}")
-            elif status == 'RESULT':
-                so_tk = result.get('so_tk')
-                data = result.get('data')
-                logging.info(f"[THÀNH CÔNG] Tờ khai {so_tk} - Luồng: {data.get('Tên luồng', 'N/A')}")
-                
-                try:
-                    row_to_update = tasks_map.get(so_tk)
-                    if row_to_update:
-                        write_col_index = gspread.utils.a1_to_rowcol(write_col + '1')[1]
-                        result_value = data.get(selected_field, "N/A")
-                        result_str_to_write = f"'{result_value}"
-                        worksheet.update_cell(row_to_update, write_col_index, result_str_to_write)
-                        logging.info(f"Đã ghi kết quả cho tờ khai {so_tk} vào Sheet.")
-                except Exception as e:
-                    logging.error(f"Lỗi khi ghi kết quả cho TK {so_tk}: {e}")
+        # 3. Chạy quy trình tra cứu, kết quả được ghi theo lô trên luồng nền
+        result_cache = open_result_cache(config, base_dir=current_dir)
+        process_tasks(job_tasks, config, result_cache, threading.Event())
 
     except Exception as e:
         logging.error(f"LỖI NGHIÊM TRỌNG TRONG QUÁ TRÌNH CHẠY NỀN: {e}", exc_info=True)
     finally:
+        if result_cache:
+            result_cache.close()
         logging.info("="*20 + " KẾT THÚC PHIÊN LÀM VIỆC TỰ ĐỘNG " + "="*20 + "\n")
+
+# --- CHẾ ĐỘ THEO DÕI (WATCH) ---
+def is_watch_enabled():
+    """Chế độ theo dõi được bật trong mục 'watch' của app_config.json."""
+    try:
+        return bool(load_config().get('watch', {}).get('enabled', False))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+
+def get_modified_time(spreadsheet):
+    """Thời điểm sửa đổi cuối của bảng tính (một request nhẹ tới Drive API, không đọc dữ liệu)."""
+    getter = getattr(spreadsheet, 'get_lastUpdateTime', None)
+    return getter() if getter else spreadsheet.lastUpdateTime
+
+def sheet_key_of(job):
+    """Khóa checkpoint của một công việc; đổi Sheet hoặc cột thì bắt đầu lại từ đầu."""
+    return f"{job['url']}|{job['sheet_name']}|{job['read_col']}|{','.join(job['field_columns'].values())}"
+
+def load_checkpoints(path, sheet_keys):
+    """Đọc checkpoint của từng Sheet ({sheet_key: checkpoint}); bỏ qua các Sheet/cấu hình không còn dùng."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        saved = {}
+    # Tệp cũ chỉ chứa checkpoint của một Sheet
+    sheets = saved.get('sheets', {saved['sheet_key']: saved} if 'sheet_key' in saved else {})
+    return {key: sheets.get(key) or {'sheet_key': key, 'modified_time': None, 'handled': {}} for key in sheet_keys}
+
+def save_checkpoints(path, checkpoints):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'sheets': checkpoints}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def run_watch_mode():
+    """
+    Chạy nền liên tục cho mọi Sheet của `load_jobs`: kiểm tra thời điểm sửa đổi của từng bảng tính sau mỗi
+    `poll_seconds`, chỉ đọc lại các cột cần thiết khi bảng tính thay đổi (hoặc có dòng đến hạn tra cứu lại), và chỉ
+    tra cứu các dòng mới/thay đổi so với checkpoint, gộp chung mọi Sheet trong một lượt (mỗi Số TK một lần).
+    Dòng tra cứu lỗi được thử lại sau `recheck_hours`. Các lần ghi kết quả của chính chương trình không được tính
+    là thay đổi. Trình duyệt được giữ mở giữa các lượt.
+    """
+    setup_logging()
+    logging.info("="*20 + " BẮT ĐẦU CHẾ ĐỘ THEO DÕI (WATCH) " + "="*20)
+
+    driver, result_cache = None, None
+    try:
+        config = load_config()
+        watch_settings = config.get('watch', {})
+        poll_seconds = watch_settings.get('poll_seconds', DEFAULT_POLL_SECONDS)
+        recheck_seconds = watch_settings.get('recheck_hours', DEFAULT_RECHECK_HOURS) * 3600
+        checkpoint_path = os.path.join(current_dir, watch_settings.get('checkpoint_file', CHECKPOINT_FILE))
+        # Trình duyệt dùng lại giữa các lượt chỉ có ích với Selenium một trình duyệt
+        # (chế độ HTTP và nhóm nhiều trình duyệt tự mở trình duyệt của riêng chúng)
+        keep_browser = (config.get('lookup_engine', DEFAULT_ENGINE) != 'http'
+                        and config.get('worker_pool', {}).get('workers', 1) <= 1)
+
+        watched = open_job_worksheets(load_jobs(config))
+        if not watched:
+            raise ValueError("Không mở được Sheet nào để theo dõi.")
+        result_cache = open_result_cache(config, base_dir=current_dir)
+        checkpoints = load_checkpoints(checkpoint_path, [sheet_key_of(job) for job, _, _ in watched])
+        stop_event = threading.Event()
+        logging.info(f"Theo dõi {len(watched)} Sheet ({', '.join(job['sheet_name'] for job, _, _ in watched)}) mỗi {poll_seconds} giây.")
+
+        while not stop_event.is_set():
+            try:
+                now = time.time()
+                modified_times = {}  # Mỗi bảng tính chỉ hỏi thời điểm sửa đổi một lần mỗi lượt
+                job_tasks, job_checkpoints = [], []
+                for job, spreadsheet, worksheet in watched:
+                    checkpoint = checkpoints[sheet_key_of(job)]
+                    handled = checkpoint['handled']
+                    if job['url'] not in modified_times:
+                        modified_times[job['url']] = get_modified_time(spreadsheet)
+                    modified_time = modified_times[job['url']]
+                    recheck_due = any(now - entry['at'] >= recheck_seconds for entry in handled.values())
+                    if modified_time == checkpoint['modified_time'] and not recheck_due:
+                        continue
+
+                    checkpoint['modified_time'] = modified_time
+                    tasks = load_pending_tasks(worksheet, job['read_col'], job['field_columns'].values())
+                    pending_rows = {str(task['row_index']): task['so_tk'] for task in tasks}
+                    # Chỉ giữ lại các dòng vẫn còn trống và chưa đổi Số TK
+                    handled = {row: entry for row, entry in handled.items() if pending_rows.get(row) == entry['so_tk']}
+                    checkpoint['handled'] = handled
+                    new_tasks = [task for task in tasks
+                                 if str(task['row_index']) not in handled
+                                 or now - handled[str(task['row_index'])]['at'] >= recheck_seconds]
+                    if new_tasks:
+                        job_tasks.append((job, worksheet, new_tasks))
+                        job_checkpoints.append(checkpoint)
+
+                if job_tasks:
+                    # Chỉ giữ trình duyệt mở giữa các lượt khi chạy một trình duyệt
+                    if driver is None and keep_browser:
+                        logging.info("Đang khởi tạo trình duyệt (dùng lại cho các lượt sau)...")
+                        driver = create_driver(config.get('browser'))
+                    completed, browser_lost = process_tasks(job_tasks, config, result_cache, stop_event, driver=driver)
+                    for (_, _, new_tasks), checkpoint in zip(job_tasks, job_checkpoints):
+                        for task in new_tasks:
+                            # Dòng lỗi cũng được ghi nhận để thử lại sau `recheck_hours` thay vì chờ Sheet thay đổi;
+                            # khi mất trình duyệt thì các dòng chưa tra được sẽ được thử lại ngay ở lượt sau
+                            if task['so_tk'] in completed or not browser_lost:
+                                checkpoint['handled'][str(task['row_index'])] = {'so_tk': task['so_tk'], 'at': time.time()}
+                        if browser_lost:
+                            checkpoint['modified_time'] = None
+                    if browser_lost:
+                        if driver:
+                            try:
+                                driver.quit()
+                            except Exception:
+                                pass
+                            driver = None
+                    elif completed:
+                        # Bỏ qua thời điểm sửa đổi do chính các lần ghi kết quả vừa rồi tạo ra
+                        # (mọi Sheet của các bảng tính vừa được ghi đều đã được đọc lại trong lượt này)
+                        written_urls = {job['url'] for job, _, _ in job_tasks}
+                        latest = {}
+                        for job, spreadsheet, _ in watched:
+                            if job['url'] in written_urls:
+                                if job['url'] not in latest:
+                                    latest[job['url']] = get_modified_time(spreadsheet)
+                                checkpoints[sheet_key_of(job)]['modified_time'] = latest[job['url']]
+
+                save_checkpoints(checkpoint_path, checkpoints)
+            except Exception as e:
+                logging.error(f"Lỗi trong lượt theo dõi: {e}", exc_info=True)
+
+            stop_event.wait(poll_seconds)
+
+    except KeyboardInterrupt:
+        logging.info("Đã nhận lệnh dừng chế độ theo dõi.")
+    except Exception as e:
+        logging.error(f"LỖI NGHIÊM TRỌNG TRONG CHẾ ĐỘ THEO DÕI: {e}", exc_info=True)
+    finally:
+        if driver:
+            driver.quit()
+        if result_cache:
+            result_cache.close()
+        logging.info("="*20 + " KẾT THÚC CHẾ ĐỘ THEO DÕI " + "="*20 + "\n")
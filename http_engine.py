@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+MODULE TRA CỨU TRỰC TIẾP QUA HTTP (V1 - Không cần trình duyệt)
+===============================================================
+Cùng giao diện generator với `run_batch_processing`, nhưng dùng một `requests.Session`
+giữ cookie thay cho Chrome:
+1. Tải trang (hoặc `captcha_url`) và lấy ảnh base64 trong `#mainCaptcha img`.
+2. Giải bằng `captcha_solver.solve_captcha`.
+3. Gửi các trường `soTK`, `maDN`, `soCMT`, `check-input` tới `search_url`.
+4. Đọc bảng `tbl-TTTK` (hoặc thông báo "Sai mã kiểm tra") trong phản hồi.
+Các tờ khai không tra được qua HTTP được chuyển sang Selenium nếu bật `fallback_to_selenium`.
+Mọi địa chỉ đều cấu hình được trong mục 'http_engine' để chạy với máy chủ giả lập cục bộ.
+"""
+import re
+import time
+import base64
+from html.parser import HTMLParser
+import requests
+
+from captcha_solver import solve_captcha_with_confidence, reload_if_changed
+from run_metrics import SpanRecorder
+from batch_processor import (run_batch_processing, serve_cached_results, save_failed_captcha,
+                             URL, MAX_RETRIES_PER_TK, MA_DOANH_NGHIEP, SO_CMT)
+
+DEFAULT_SETTINGS = {
+    'page_url': URL,
+    'captcha_url': '',  # Để trống: tải lại trang để lấy CAPTCHA mới
+    'search_url': URL,
+    'timeout_seconds': 15,
+    'fallback_to_selenium': True,
+}
+CAPTCHA_PATTERN = re.compile(r'data:image/jpg;base64,([A-Za-z0-9+/=\s]+)')
+WRONG_CAPTCHA_TEXT = 'Sai mã kiểm tra'
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+
+
+class _ResultTableParser(HTMLParser):
+    """Đọc các dòng 2 ô (<td>tên</td><td>giá trị</td>) trong bảng có class `tbl-TTTK`."""
+    def __init__(self):
+        super().__init__()
+        self.found_table = False
+        self.result_data = {}
+        self._table_depth = 0
+        self._row = None
+        self._cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'table':
+            if self._table_depth:
+                self._table_depth += 1
+            elif 'tbl-TTTK' in (dict(attrs).get('class') or '').split():
+                self.found_table = True
+                self._table_depth = 1
+        elif self._table_depth and tag == 'tr':
+            self._row = []
+        elif self._table_depth and tag == 'td' and self._row is not None:
+            self._cell = []
+
+    def handle_endtag(self, tag):
+        if not self._table_depth:
+            return
+        if tag == 'td' and self._cell is not None:
+            self._row.append(' '.join(''.join(self._cell).split()))
+            self._cell = None
+        elif tag == 'tr' and self._row is not None:
+            if len(self._row) == 2:
+                self.result_data[self._row[0]] = self._row[1]
+            self._row = None
+        elif tag == 'table':
+            self._table_depth -= 1
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+
+
+def parse_result_table(html):
+    """Trả về `result_data` nếu phản hồi có bảng `tbl-TTTK`, None nếu không có bảng."""
+    parser = _ResultTableParser()
+    parser.feed(html)
+    return parser.result_data if parser.found_table else None
+
+
+def extract_captcha(html):
+    """Lấy bytes ảnh CAPTCHA từ HTML/JSON có chứa src `data:image/jpg;base64,...`."""
+    match = CAPTCHA_PATTERN.search(html)
+    return base64.b64decode(''.join(match.group(1).split())) if match else None
+
+
+class HttpLookupClient:
+    def __init__(self, settings=None, rate_limiter=None):
+        self.settings = {**DEFAULT_SETTINGS, **(settings or {})}
+        self.rate_limiter = rate_limiter
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+
+    def _request(self, method, url, **kwargs):
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+        response = self.session.request(method, url, timeout=self.settings['timeout_seconds'], **kwargs)
+        response.raise_for_status()
+        return response.text
+
+    def fetch_captcha(self):
+        url = self.settings['captcha_url'] or self.settings['page_url']
+        return extract_captcha(self._request('GET', url))
+
+    def submit(self, so_tk, captcha_text):
+        form = {'soTK': so_tk, 'maDN': MA_DOANH_NGHIEP, 'soCMT': SO_CMT, 'check-input': captcha_text}
+        return self._request('POST', self.settings['search_url'], data=form)
+
+    def close(self):
+        self.session.close()
+
+
+def run_http_processing(so_tk_list, stop_event, result_cache=None, rate_limiter=None, settings=None, browser_settings=None,
+                        confidence_gate=None):
+    """Tra cứu hàng loạt qua HTTP; sinh ra các sự kiện giống `run_batch_processing`."""
+    so_tk_list = yield from serve_cached_results(so_tk_list, result_cache)
+    if not so_tk_list:
+        yield {'status': 'DONE', 'message': 'Hoàn tất quá trình tra cứu.', 'value': 100}
+        return
+
+    client = HttpLookupClient(settings, rate_limiter)
+    total_tk = len(so_tk_list)
+    fallback_list = []
+    try:
+        yield {'status': 'PROGRESS', 'message': f'Tra cứu trực tiếp qua HTTP: {client.settings["page_url"]}', 'value': 0}
+        img_data = None
+        for index, so_tk in enumerate(so_tk_list):
+            if stop_event.is_set():
+                yield {'status': 'STOPPED', 'message': 'Người dùng đã yêu cầu dừng.'}
+                return
+
+            progress_value = int((index / total_tk) * 100)
+            yield {'status': 'PROGRESS', 'message': f'Bắt đầu xử lý tờ khai {index + 1}/{total_tk}: {so_tk}', 'value': progress_value}
+            new_version = reload_if_changed()
+            if new_version:
+                yield {'status': 'PROGRESS', 'message': f'Đã chuyển sang model CAPTCHA mới ({new_version}).', 'value': progress_value}
+
+            finished = False
+            skips_left = confidence_gate.settings['max_skips_per_tk'] if confidence_gate else 0
+            spans = SpanRecorder()
+            counts = {'attempts': 0, 'correct': 0, 'wrong': 0, 'skipped': 0}
+            try:
+                for attempt in range(MAX_RETRIES_PER_TK):
+                    try:
+                        if stop_event.is_set():
+                            yield {'status': 'STOPPED', 'message': 'Người dùng đã yêu cầu dừng.'}
+                            return
+
+                        if img_data is None:
+                            with spans.span('captcha_wait'):
+                                img_data = client.fetch_captcha()
+                        if img_data is None:
+                            yield {'status': 'ERROR', 'message': f'Tờ khai {so_tk}: Lần {attempt + 1} không tìm thấy ảnh CAPTCHA trong phản hồi.'}
+                            continue
+
+                        with spans.span('inference'):
+                            predicted_label, _, score = solve_captcha_with_confidence(img_data)
+                        # Dự đoán kém tin cậy: lấy CAPTCHA mới thay vì gửi (không tính vào số lần thử)
+                        while predicted_label and skips_left and confidence_gate.should_skip(score):
+                            skips_left -= 1
+                            counts['skipped'] += 1
+                            yield {'status': 'PROGRESS', 'message': f'Tờ khai {so_tk}: Độ tin cậy {score:.2f} dưới ngưỡng {confidence_gate.threshold:.2f}, lấy CAPTCHA mới.', 'value': progress_value}
+                            with spans.span('captcha_wait'):
+                                img_data = client.fetch_captcha()
+                            with spans.span('inference'):
+                                predicted_label, _, score = solve_captcha_with_confidence(img_data) if img_data else (None, [], 0.0)
+                        if not predicted_label:
+                            yield {'status': 'ERROR', 'message': f'Tờ khai {so_tk}: Lần {attempt + 1} không giải được CAPTCHA. Lấy CAPTCHA mới.'}
+                            img_data = None
+                            continue
+
+                        submitted_at = time.monotonic()
+                        counts['attempts'] += 1
+                        with spans.span('submit_wait'):
+                            html = client.submit(so_tk, predicted_label)
+                        submit_seconds = time.monotonic() - submitted_at
+                        used_img_data = img_data
+                        # Mỗi CAPTCHA chỉ dùng được một lần; phản hồi có thể kèm sẵn ảnh mới
+                        img_data = extract_captcha(html)
+                        result_data = parse_result_table(html)
+
+                        if result_data is not None:
+                            counts['correct'] += 1
+                        elif WRONG_CAPTCHA_TEXT in html:
+                            counts['wrong'] += 1
+                        if confidence_gate and (result_data is not None or WRONG_CAPTCHA_TEXT in html):
+                            confidence_gate.record(score, result_data is not None, submit_seconds, forced=not skips_left)
+                        if result_data:
+                            if result_cache:
+                                result_cache.put(so_tk, result_data)
+                            yield {'status': 'RESULT', 'so_tk': so_tk, 'data': result_data,
+                                   'metrics': {'so_tk': so_tk, 'spans': spans.spans, **counts}}
+                            finished = True
+                            break
+                        if result_data is not None:
+                            yield {'status': 'ERROR', 'message': f'Tờ khai {so_tk}: Tìm thấy bảng kết quả nhưng không có dữ liệu.',
+                                   'metrics': {'so_tk': so_tk, 'spans': spans.spans, **counts}}
+                            finished = True
+                            break
+                        if WRONG_CAPTCHA_TEXT in html:
+                            yield {'status': 'ERROR', 'message': f'Tờ khai {so_tk}: Lần thử {attempt + 1} thất bại (CAPTCHA sai).'}
+                            save_failed_captcha(used_img_data, so_tk, predicted_label)
+                        else:
+                            yield {'status': 'ERROR', 'message': f'Tờ khai {so_tk}: Lần thử {attempt + 1} - phản hồi không có kết quả hay thông báo lỗi.'}
+                    except requests.RequestException as e:
+                        # Lỗi mạng/HTTP chỉ làm mất một lần thử; CAPTCHA cũ không còn dùng được
+                        yield {'status': 'ERROR', 'message': f'Tờ khai {so_tk}: Lần thử {attempt + 1} - lỗi mạng khi tra cứu qua HTTP: {e}'}
+                        img_data = None
+            except Exception as e:
+                # Lỗi khác (phân tích phản hồi, giải CAPTCHA...) chỉ kết thúc tờ khai này
+                yield {'status': 'ERROR', 'message': f'Lỗi hệ thống khi xử lý tờ khai {so_tk} qua HTTP: {e}'}
+                img_data = None
+
+            if not finished:
+                fallback_list.append(so_tk)
+                # Tờ khai chuyển sang Selenium được tính khi Selenium xử lý xong; ở đây chỉ ghi thời gian và số lần gửi
+                metrics = {'spans': spans.spans, **counts}
+                if not client.settings['fallback_to_selenium']:
+                    metrics['so_tk'] = so_tk
+                yield {'status': 'PROGRESS', 'message': f'Tờ khai {so_tk}: Chưa tra được qua HTTP.', 'value': progress_value, 'metrics': metrics}
+    finally:
+        client.close()
+
+    if fallback_list and client.settings['fallback_to_selenium'] and not stop_event.is_set():
+        yield {'status': 'PROGRESS', 'message': f'Chuyển {len(fallback_list)} tờ khai chưa tra được sang Selenium...', 'value': 100}
+        for event in run_batch_processing(fallback_list, stop_event, result_cache=result_cache, rate_limiter=rate_limiter,
+                                          browser_settings=browser_settings, confidence_gate=confidence_gate):
+            if event['status'] == 'DONE':
+                continue
+            yield event
+            if event['status'] == 'STOPPED':
+                return
+    elif fallback_list:
+        yield {'status': 'FINAL_ERROR', 'message': f'Không thể lấy thông tin cho {len(fallback_list)} tờ khai qua HTTP: {", ".join(fallback_list)}'}
+
+    if not stop_event.is_set():
+        gate_summary = f' {confidence_gate.summary()}' if confidence_gate else ''
+        yield {'status': 'DONE', 'message': f'Hoàn tất quá trình tra cứu.{gate_summary}', 'value': 100}
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+MÁY CHỦ GIẢ LẬP TRANG TRA CỨU TỜ KHAI (V1)
+============================================
+Mô phỏng trang tra cứu của cổng hải quan để đo hiệu năng và thử nghiệm mà không gửi request thật:
+- Trang chính có các ô `soTK`, `maDN`, `soCMT`, `check-input`, nút `btn-search`,
+  ảnh `#mainCaptcha img` dạng `data:image/jpg;base64,...` và hàm `getCaptcha()`.
+- Ảnh CAPTCHA lấy ngẫu nhiên từ `captcha_result`; đáp án là nhãn trong tên tệp.
+  Mỗi CAPTCHA chỉ dùng được một lần (theo cookie phiên).
+- Đúng CAPTCHA: trả bảng `tbl-TTTK` (kèm sẵn CAPTCHA mới); sai: "Sai mã kiểm tra. ..."
+- Độ trễ và tỉ lệ lỗi máy chủ (HTTP 500) cấu hình được.
+Các đường dẫn: GET `/` (trang), GET `/captcha` (CAPTCHA mới), POST `/search` (tra cứu),
+dùng được cho cả Selenium (`browser.lookup_url`) và `http_engine` (`page_url`, `captcha_url`, `search_url`).
+
+Cách dùng:
+    python mock_portal.py [--port 8765] [--latency-ms 300] [--server-error-rate 0.02]
+"""
+import os
+import sys
+import time
+import html
+import uuid
+import base64
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from char_dataset import label_from_filename, IMAGE_EXTENSIONS
+from captcha_solver import CAPTCHA_LENGTH
+
+CAPTCHA_IMAGE_FOLDER = "captcha_result"
+SESSION_COOKIE = "portal_session"
+WRONG_CAPTCHA_MESSAGE = "Sai mã kiểm tra. Vui lòng nhập lại."
+DEFAULT_SETTINGS = {
+    'latency_ms': 300,          # Thời gian xử lý trung bình của mỗi request
+    'latency_jitter_ms': 100,   # Dao động ngẫu nhiên quanh `latency_ms`
+    'server_error_rate': 0.0,   # Tỉ lệ request tra cứu trả về HTTP 500
+}
+
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html lang="vi">
+<head><meta charset="utf-8"><title>Tra cứu tờ khai (giả lập)</title></head>
+<body>
+<form onsubmit="return false;">
+    <input id="soTK" name="soTK" placeholder="Số tờ khai">
+    <input id="maDN" name="maDN" placeholder="Mã doanh nghiệp">
+    <input id="soCMT" name="soCMT" placeholder="Số CMT/CCCD">
+    <div id="mainCaptcha"><img src="{captcha_src}" alt="captcha"></div>
+    <button type="button" onclick="getCaptcha()">Đổi mã</button>
+    <input id="check-input" name="check-input" placeholder="Mã kiểm tra">
+    <button type="button" id="btn-search" onclick="search()">Tra cứu</button>
+</form>
+<div id="result"></div>
+<script>
+function getCaptcha() {{
+    fetch('/captcha').then(r => r.text()).then(src => {{
+        document.querySelector('#mainCaptcha img').src = src.trim();
+    }});
+}}
+function search() {{
+    var body = new URLSearchParams();
+    ['soTK', 'maDN', 'soCMT', 'check-input'].forEach(id => body.append(id, document.getElementById(id).value));
+    document.getElementById('result').innerHTML = '';  // Như trang thật: bỏ kết quả/thông báo cũ khi đang chờ phản hồi
+    fetch('/search', {{method: 'POST', body: body}}).then(r => r.ok ? r.text() : '').then(fragment => {{
+        if (!fragment) return;  // Lỗi máy chủ: trang không thay đổi
+        var holder = document.createElement('div');
+        holder.innerHTML = fragment;
+        var next = holder.querySelector('#next-captcha');
+        if (next) {{
+            document.querySelector('#mainCaptcha img').src = next.dataset.captcha;
+            next.remove();
+        }}
+        document.getElementById('result').innerHTML = holder.innerHTML;
+    }});
+}}
+</script>
+</body>
+</html>"""
+
+
+def load_captchas(folder):
+    """Danh sách (bytes ảnh, đáp án) của các ảnh có nhãn hợp lệ trong `folder`."""
+    captchas = []
+    for filename in sorted(os.listdir(folder)):
+        if not filename.lower().endswith(IMAGE_EXTENSIONS): continue
+        label = label_from_filename(filename)
+        if len(label) != CAPTCHA_LENGTH: continue
+        with open(os.path.join(folder, filename), 'rb') as f:
+            captchas.append((f.read(), label))
+    return captchas
+
+
+def fake_result(so_tk):
+    """Dữ liệu tờ khai giả, cố định theo số tờ khai."""
+    rng = random.Random(so_tk)
+    day = f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/2025"
+    return {
+        "Số tờ khai": so_tk,
+        "Mã hải quan": "02CI", "Tên hải quan": "Chi cục HQ giả lập",
+        "Mã loại hình": "E31", "Tên loại hình": "Xuất sản phẩm SXXK",
+        "Năm đăng ký": "2025", "Ngày đăng ký": day,
+        "Tên luồng": rng.choice(["Xanh", "Vàng", "Đỏ"]),
+        "Ngày thông quan": day, "Ngày qua khu vực giám sát": day,
+        "Mã đơn vị": "3700482964",
+    }
+
+
+class MockPortal:
+    """Máy chủ giả lập chạy trên một luồng nền; `url` là địa chỉ trang tra cứu."""
+    def __init__(self, folder=CAPTCHA_IMAGE_FOLDER, settings=None, host="127.0.0.1", port=0):
+        self.settings = {**DEFAULT_SETTINGS, **(settings or {})}
+        self.captchas = load_captchas(folder)
+        if not self.captchas:
+            raise ValueError(f"Thư mục '{folder}' không có ảnh CAPTCHA nào có nhãn hợp lệ.")
+        self._lock = threading.Lock()
+        self._rng = random.Random()
+        self._answers = {}  # cookie phiên -> đáp án của CAPTCHA đang hiển thị
+        self.stats = {'pages': 0, 'captchas': 0, 'searches': 0, 'correct': 0, 'wrong': 0, 'server_errors': 0}
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _delay(self):
+        latency = self.settings['latency_ms'] + self._rng.uniform(-1, 1) * self.settings['latency_jitter_ms']
+        if latency > 0:
+            time.sleep(latency / 1000)
+
+    def new_captcha(self, session):
+        """Chọn CAPTCHA mới cho phiên, trả về src dạng data URI."""
+        with self._lock:
+            image_bytes, label = self._rng.choice(self.captchas)
+            self._answers[session] = label
+        return "data:image/jpg;base64," + base64.b64encode(image_bytes).decode('ascii')
+
+    def search(self, session, form):
+        """Trả về (mã HTTP, đoạn HTML kết quả) cho một lần tra cứu."""
+        self._count('searches')
+        if self._rng.random() < self.settings['server_error_rate']:
+            self._count('server_errors')
+            return 500, ''
+        with self._lock:
+            answer = self._answers.pop(session, None)  # CAPTCHA chỉ dùng được một lần
+        if answer is None or form.get('check-input', '').strip().lower() != answer.lower():
+            self._count('wrong')
+            return 200, f'<p class="error">{WRONG_CAPTCHA_MESSAGE}</p>'
+        self._count('correct')
+        rows = ''.join(f'<tr><td>{html.escape(name)}</td><td>{html.escape(value)}</td></tr>'
+                       for name, value in fake_result(form.get('soTK', '')).items())
+        next_captcha = f'<div id="next-captcha" data-captcha="{self.new_captcha(session)}"></div>'
+        return 200, f'{next_captcha}<table class="tbl-TTTK">{rows}</table>'
+
+    def _handler_class(self):
+        portal = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _session(self):
+                for part in self.headers.get('Cookie', '').split(';'):
+                    name, _, value = part.strip().partition('=')
+                    if name == SESSION_COOKIE and value:
+                        return value, False
+                return uuid.uuid4().hex, True
+
+            def _reply(self, status, body, content_type="text/html; charset=utf-8", session=None):
+                data = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                if session:
+                    self.send_header('Set-Cookie', f'{SESSION_COOKIE}={session}; Path=/')
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                session, is_new = self._session()
+                portal._delay()
+                path = self.path.split('?')[0]
+                if path == '/':
+                    portal._count('pages')
+                    page = PAGE_TEMPLATE.format(captcha_src=portal.new_captcha(session))
+                    self._reply(200, page, session=session if is_new else None)
+                elif path == '/captcha':
+                    portal._count('captchas')
+                    self._reply(200, portal.new_captcha(session), "text/plain; charset=utf-8", session if is_new else None)
+                else:
+                    self._reply(404, 'Không tìm thấy trang.')
+
+            def do_POST(self):
+                if self.path.split('?')[0] != '/search':
+                    self._reply(404, 'Không tìm thấy trang.')
+                    return
+                session, _ = self._session()
+                length = int(self.headers.get('Content-Length') or 0)
+                form = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode('utf-8')).items()}
+                portal._delay()
+                status, fragment = portal.search(session, form)
+                self._reply(status, fragment)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Máy chủ giả lập trang tra cứu tờ khai hải quan.")
+    parser.add_argument("--folder", default=CAPTCHA_IMAGE_FOLDER)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=DEFAULT_SETTINGS['latency_ms'])
+    parser.add_argument("--latency-jitter-ms", type=float, default=DEFAULT_SETTINGS['latency_jitter_ms'])
+    parser.add_argument("--server-error-rate", type=float, default=DEFAULT_SETTINGS['server_error_rate'])
+    args = parser.parse_args()
+
+    settings = {'latency_ms': args.latency_ms, 'latency_jitter_ms': args.latency_jitter_ms,
+                'server_error_rate': args.server_error_rate}
+    try:
+        portal = MockPortal(args.folder, settings, port=args.port)
+    except (OSError, ValueError) as e:
+        print(f"[ERROR] {e}")
+        return 1
+    print(f"[INFO] Trang tra cứu giả lập: {portal.url} ({len(portal.captchas)} ảnh CAPTCHA). Nhấn Ctrl+C để dừng.")
+    try:
+        portal.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        portal.server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+MODULE QUẢN LÝ PHIÊN BẢN MODEL (V1)
+====================================
+Mỗi lần huấn luyện tạo một thư mục phiên bản `models/vN/` (captcha_model.pth + label_encoder.pkl)
+được ghi vào thư mục tạm rồi đổi tên nguyên tử, và một `models/manifest.json`:
+    {"current": "v3", "versions": [{"version", "accuracy", "baseline_accuracy", "training_set_hash",
+                                     "excludes_holdout", "regressions", "created_at", "promoted"}]}
+- Phiên bản mới chỉ được dùng khi độ chính xác không thấp hơn model hiện tại trên cùng tập kiểm tra
+  và không kém hơn mốc tốc độ/độ chính xác của bộ giải (`regressions` rỗng, xem benchmark_solver).
+- `captcha_solver` đọc manifest để phát hiện phiên bản mới và nạp lại giữa các lần tra cứu.
+- Bản sao `captcha_model.pth`/`label_encoder.pkl` ở thư mục gốc vẫn được cập nhật (nguyên tử)
+  để đóng gói PyInstaller như trước.
+
+Cách dùng:
+    python model_store.py             # Liệt kê các phiên bản
+    python model_store.py --rollback  # Quay về phiên bản được dùng trước phiên bản hiện tại
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+MODELS_DIR = "models"
+MANIFEST_FILENAME = "manifest.json"
+MODEL_FILENAME = "captcha_model.pth"
+MODEL_LABELS_FILENAME = "label_encoder.pkl"
+
+
+def manifest_path(models_dir=MODELS_DIR):
+    return os.path.join(models_dir, MANIFEST_FILENAME)
+
+
+def read_manifest(models_dir=MODELS_DIR):
+    try:
+        with open(manifest_path(models_dir), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {'current': None, 'versions': []}
+
+
+def _write_manifest(manifest, models_dir):
+    tmp_path = manifest_path(models_dir) + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, manifest_path(models_dir))
+
+
+def _atomic_copy(src, dest):
+    tmp_path = dest + ".tmp"
+    shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dest)
+
+
+def current_version(models_dir=MODELS_DIR):
+    """Trả về thông tin phiên bản đang dùng (dict trong manifest) hoặc None."""
+    manifest = read_manifest(models_dir)
+    return next((v for v in manifest['versions'] if v['version'] == manifest['current']), None)
+
+
+def current_model_paths(models_dir=MODELS_DIR):
+    """(đường dẫn model, đường dẫn label encoder, tên phiên bản) của phiên bản hiện tại, hoặc None nếu chưa có."""
+    version = read_manifest(models_dir)['current']
+    if not version:
+        return None
+    return version_paths(version, models_dir)
+
+
+def version_paths(version, models_dir=MODELS_DIR):
+    """(đường dẫn model, đường dẫn label encoder, tên phiên bản) của một phiên bản bất kỳ trong `models_dir`."""
+    version_dir = os.path.join(models_dir, version)
+    return os.path.join(version_dir, MODEL_FILENAME), os.path.join(version_dir, MODEL_LABELS_FILENAME), version
+
+
+def training_set_hash(image_hashes, labels):
+    """Mã băm của tập huấn luyện: các cặp (mã băm ảnh, ký tự) đã sắp xếp."""
+    digest = hashlib.sha1()
+    for image_hash, label in sorted(set(zip(image_hashes, labels))):
+        digest.update(f"{image_hash}:{label}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def publish_model(write_files, accuracy, baseline_accuracy=None, training_set_hash=None, models_dir=MODELS_DIR,
+                  excludes_holdout=False, regressions=None):
+    """
+    Tạo phiên bản mới: `write_files(thư_mục)` ghi MODEL_FILENAME và MODEL_LABELS_FILENAME vào thư mục tạm,
+    sau đó thư mục được đổi tên thành `vN`. Phiên bản chỉ trở thành hiện tại khi `accuracy` không thấp
+    hơn `baseline_accuracy` (độ chính xác của model hiện tại trên cùng tập kiểm tra).
+    `excludes_holdout`: model không được huấn luyện trên tập kiểm tra giữ riêng của `char_dataset`.
+    `regressions`: các chỉ số kém hơn mốc của bộ giải; nếu có, phiên bản không được dùng.
+    Trả về (tên phiên bản, đã được dùng hay chưa).
+    """
+    os.makedirs(models_dir, exist_ok=True)
+    manifest = read_manifest(models_dir)
+    number = 1 + max((int(v['version'][1:]) for v in manifest['versions']), default=0)
+    version = f"v{number}"
+
+    tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=models_dir)
+    write_files(tmp_dir)
+    os.replace(tmp_dir, os.path.join(models_dir, version))
+
+    promoted = (baseline_accuracy is None or accuracy >= baseline_accuracy) and not regressions
+    manifest['versions'].append({
+        'version': version, 'accuracy': accuracy, 'baseline_accuracy': baseline_accuracy,
+        'training_set_hash': training_set_hash, 'excludes_holdout': excludes_holdout, 'regressions': regressions or [],
+        'created_at': time.time(), 'promoted': promoted,
+    })
+    if promoted:
+        manifest['current'] = version
+    _write_manifest(manifest, models_dir)
+    if promoted:
+        _export_current(models_dir)
+    return version, promoted
+
+
+def rollback(models_dir=MODELS_DIR):
+    """Quay về phiên bản đã được dùng ngay trước phiên bản hiện tại. Trả về tên phiên bản mới, hoặc None."""
+    manifest = read_manifest(models_dir)
+    promoted = [v['version'] for v in manifest['versions'] if v['promoted']]
+    if manifest['current'] not in promoted or promoted.index(manifest['current']) == 0:
+        return None
+    previous = promoted[promoted.index(manifest['current']) - 1]
+    for entry in manifest['versions']:
+        if entry['version'] == manifest['current']:
+            entry['promoted'] = False
+    manifest['current'] = previous
+    _write_manifest(manifest, models_dir)
+    _export_current(models_dir)
+    return previous
+
+
+def _export_current(models_dir):
+    model_path, labels_path, _ = current_model_paths(models_dir)
+    _atomic_copy(model_path, MODEL_FILENAME)
+    _atomic_copy(labels_path, MODEL_LABELS_FILENAME)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quản lý các phiên bản model CAPTCHA.")
+    parser.add_argument("--rollback", action="store_true", help="Quay về phiên bản trước phiên bản hiện tại.")
+    args = parser.parse_args()
+
+    if args.rollback:
+        version = rollback()
+        print(f"[INFO] Đã quay về phiên bản {version}." if version else "[ERROR] Không có phiên bản nào để quay về.")
+        return 0 if version else 1
+
+    manifest = read_manifest()
+    for entry in manifest['versions']:
+        marker = '*' if entry['version'] == manifest['current'] else ' '
+        baseline = entry['baseline_accuracy']
+        print(f"{marker} {entry['version']}: accuracy {entry['accuracy']:.2f}%"
+              f"{f' (model cũ {baseline:.2f}%)' if baseline is not None else ''}, "
+              f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['created_at']))}"
+              f"{'' if entry['promoted'] else ', không được dùng'}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+MODULE CHỜ TRANG SẴN SÀNG THEO SỰ KIỆN (V1)
+============================================
+Thay các lệnh `time.sleep` cố định trong quy trình tra cứu bằng điều kiện chờ thực:
+- Ảnh `#mainCaptcha img` đã có src base64 mới (khác ảnh vừa dùng) sau `getCaptcha()`.
+- Bảng `tbl-TTTK` cũ đã bị thay thế (stale) sau khi nhấn tra cứu.
+- Ô `soTK` đã xuất hiện sau khi tải lại trang.
+`ReadinessTracker` ghi lại thời gian chờ thực tế so với thời gian ngủ cố định trước đây.
+"""
+import time
+import threading
+from selenium.webdriver.common.by import By
+from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException
+
+CAPTCHA_SELECTOR = "#mainCaptcha img"
+CAPTCHA_SRC_PREFIX = "data:image/jpg;base64,"
+# Thời gian ngủ cố định của phiên bản cũ, dùng làm mốc để tính thời gian tiết kiệm được
+CAPTCHA_SLEEP_BASELINE = 1.0
+PAGE_RELOAD_SLEEP_BASELINE = 2.0
+
+
+class captcha_src_changed:
+    """
+    Điều kiện chờ (dùng với WebDriverWait): ảnh CAPTCHA hiển thị có src base64 hợp lệ
+    và khác `old_src`. Trả về phần tử ảnh khi thỏa mãn.
+    """
+    def __init__(self, old_src=None):
+        self.old_src = old_src
+
+    def __call__(self, driver):
+        try:
+            element = driver.find_element(By.CSS_SELECTOR, CAPTCHA_SELECTOR)
+            src = element.get_attribute('src')
+        except (NoSuchElementException, StaleElementReferenceException):
+            return False
+        if src and src.startswith(CAPTCHA_SRC_PREFIX) and src != self.old_src:
+            return element
+        return False
+
+
+class ReadinessTracker:
+    """Cộng dồn thời gian chờ thực tế và thời gian tiết kiệm so với các lệnh sleep cố định (an toàn đa luồng)."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.total_saved = 0.0
+        self.total_waited = 0.0
+        self.waits = 0
+
+    def wait_for(self, wait, condition, baseline_seconds):
+        """Chờ `condition`; trả về (kết quả điều kiện, số giây tiết kiệm được so với `baseline_seconds`)."""
+        start = time.monotonic()
+        result = wait.until(condition)
+        elapsed = time.monotonic() - start
+        saved = baseline_seconds - elapsed
+        with self._lock:
+            self.total_waited += elapsed
+            self.total_saved += saved
+            self.waits += 1
+        return result, saved
+
+    def summary(self):
+        with self._lock:
+            if not self.waits:
+                return 'Không có lần chờ nào.'
+            return (f'Chờ theo sự kiện {self.waits} lần, tổng {self.total_waited:.1f} giây '
+                    f'(tiết kiệm {self.total_saved:.1f} giây so với sleep cố định).')
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+MODULE GIỚI HẠN TỐC ĐỘ REQUEST DÙNG CHUNG GIỮA CÁC LUỒNG (V1)
+==============================================================
+Giãn đều các request tới customs.gov.vn để tổng lưu lượng của mọi trình duyệt
+không vượt quá `max_per_minute`.
+"""
+import time
+import threading
+
+
+class RateLimiter:
+    def __init__(self, max_per_minute):
+        self.interval = 60.0 / max_per_minute if max_per_minute else 0.0
+        self._lock = threading.Lock()
+        self._next_allowed = 0.0
+
+    def acquire(self):
+        """Chặn cho đến khi được phép gửi request tiếp theo."""
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_allowed)
+            self._next_allowed = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
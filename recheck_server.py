@@ -5,14 +5,15 @@ BACKEND SERVER CHO ỨNG DỤNG KIỂM TRA LẠI CAPTCHA (V2.6 - Quy trình tự
 """
 
 import os
+import re
 import sys
 import logging
-import shutil
-import subprocess
 from collections import Counter
 from flask import Flask, render_template, send_from_directory
 from flask_socketio import SocketIO
 import eventlet
+from eventlet import tpool
+from eventlet.green import subprocess
 import webbrowser
 from threading import Timer
 
@@ -24,9 +25,10 @@ except Exception:
 sys.path.append(base_path)
 
 try:
-    from captcha_solver import solve_captcha
+    from captcha_solver import solve_captcha_variants, solve_captchas_variants
+    from failed_captcha_store import FailedCaptchaStore, hash_image_bytes
 except ImportError:
-    print("LỖI: Không thể import captcha_solver. Hãy đảm bảo tệp tồn tại.")
+    print("LỖI: Không thể import captcha_solver/failed_captcha_store. Hãy đảm bảo tệp tồn tại.")
     sys.exit(1)
 
 # --- CẤU HÌNH ---
@@ -43,6 +45,14 @@ TRAIN_SCRIPT = "train_captcha_model.py"
 NUM_PREDICTIONS = 5
 CONSENSUS_THRESHOLD = 4 
 CAPTCHA_LENGTH = 5
+BULK_MIN_IMAGES = 20  # Từ số ảnh này trở lên, trang tự chuyển sang gán nhãn hàng loạt
+BULK_BATCH_SIZE = 64
+PAGE_SIZE = 50  # Số ảnh gửi cho trình duyệt mỗi lần
+EPOCH_PATTERN = re.compile(r"Epoch (\d+)/(\d+), Loss: ([\d.]+), Accuracy: ([\d.]+)%, Elapsed: ([\d.]+)s")
+
+bulk_job_running = False
+training_process = None
+training_cancelled = False
 
 def resource_path(relative_path):
     """ Lấy đường dẫn tuyệt đối đến tài nguyên, hoạt động cho cả môi trường dev và PyInstaller """
@@ -52,6 +62,8 @@ def resource_path(relative_path):
         base_path = os.path.dirname(os.path.abspath(__file__))
     return os.path.join(base_path, relative_path)
 
+failed_store = FailedCaptchaStore(resource_path(CAPTCHA_FOLDER))
+
 # --- ROUTES ---
 @app.route('/')
 def index():
@@ -77,16 +89,25 @@ def handle_disconnect():
     print("[Server] Client đã ngắt kết nối.")
 
 @socketio.on('get_images')
-def handle_get_images():
+def handle_get_images(data=None):
+    """
+    Gửi một trang PAGE_SIZE ảnh sau con trỏ `after` (ảnh cuối của trang trước; bỏ trống để bắt đầu lại từ đầu),
+    kèm tổng số ảnh và số ảnh theo loại lỗi. 'next' là con trỏ của trang kế tiếp (None nếu là trang cuối).
+    'allow_bulk' = False (sau một lượt gán nhãn hàng loạt) để các ảnh mơ hồ còn lại được kiểm tra từng ảnh.
+    """
     try:
-        captcha_dir = resource_path(CAPTCHA_FOLDER)
-        if not os.path.exists(captcha_dir): os.makedirs(captcha_dir)
-            
-        images = [f for f in os.listdir(captcha_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-        print(f"[Server] Tìm thấy {len(images)} ảnh trong '{CAPTCHA_FOLDER}'.")
-        socketio.emit('image_list', {'images': images})
-
-        if not images:
+        after = (data or {}).get('after')
+        allow_bulk = (data or {}).get('allow_bulk', True)
+        entries = failed_store.page(after=after, limit=PAGE_SIZE)
+        total = failed_store.count()
+        if not after:
+            print(f"[Server] Tìm thấy {total} ảnh trong '{CAPTCHA_FOLDER}'.")
+        next_cursor = [entries[-1]['created_at'], entries[-1]['hash']] if len(entries) == PAGE_SIZE else None
+        socketio.emit('image_list', {'images': [entry['filename'] for entry in entries], 'entries': entries,
+                                     'total': total, 'counts': failed_store.counts_by_kind(), 'next': next_cursor,
+                                     'bulk': not after and allow_bulk and total >= BULK_MIN_IMAGES})
+
+        if not total:
             socketio.start_background_task(shutdown_and_train, needs_training=False)
 
     except Exception as e:
@@ -100,73 +121,150 @@ def handle_solve_image(data):
         socketio.emit('error', {'message': 'Tên ảnh không hợp lệ.'}); return
 
     try:
-        captcha_dir = resource_path(CAPTCHA_FOLDER)
-        image_path = os.path.join(captcha_dir, image_name)
+        image_path = failed_store.path(os.path.basename(image_name))
         
-        if not os.path.exists(image_path):
+        if not failed_store.find(os.path.basename(image_name)) or not os.path.exists(image_path):
             socketio.emit('error', {'message': f'Không tìm thấy ảnh: {image_name}'}); return
 
-        print(f"[Server] Bắt đầu phân tích đa luồng cho: {image_name}")
+        print(f"[Server] Bắt đầu phân tích đa biến thể cho: {image_name}")
         with open(image_path, "rb") as image_file:
             image_data_bytes = image_file.read()
         
-        predictions = []
-        for i in range(NUM_PREDICTIONS):
-            prediction = solve_captcha(image_data_bytes)
-            predictions.append(prediction)
+        # Một lần forward trên NUM_PREDICTIONS biến thể; chạy trong thread pool để không chặn eventlet hub
+        predictions = tpool.execute(solve_captcha_variants, image_data_bytes, NUM_PREDICTIONS)
+        for i, prediction in enumerate(predictions):
             socketio.emit('prediction_result', {'attempt': i + 1, 'prediction': prediction})
-            socketio.sleep(0.2)
 
-        valid_predictions = [p for p in predictions if p and len(p) == CAPTCHA_LENGTH]
-        
-        consensus_achieved = False
-        if valid_predictions:
-            prediction_counts = Counter(valid_predictions)
-            most_common = prediction_counts.most_common(1)[0]
-            consensus_label, count = most_common
-
-            if count >= CONSENSUS_THRESHOLD:
-                consensus_achieved = True
-                print(f"[Server] Đạt đồng thuận cho {image_name}: '{consensus_label}' (x{count})")
-                new_filename = move_and_rename_file(image_name, consensus_label)
-                socketio.emit('consensus_found', {'consensus_label': consensus_label, 'image_name': image_name, 'new_filename': new_filename})
-            
-        if not consensus_achieved:
+        consensus_label = find_consensus(predictions)
+        if consensus_label:
+            print(f"[Server] Đạt đồng thuận cho {image_name}: '{consensus_label}'")
+            new_filename = move_and_rename_file(image_name, consensus_label)
+            socketio.emit('consensus_found', {'consensus_label': consensus_label, 'image_name': image_name, 'new_filename': new_filename})
+        else:
             print(f"[Server] Không đạt đồng thuận cho {image_name}.")
             socketio.emit('consensus_failed', {'image_name': image_name})
 
         socketio.sleep(0.5)
-        if not os.listdir(captcha_dir):
+        if not failed_store.count():
             socketio.start_background_task(shutdown_and_train)
 
     except Exception as e:
         print(f"[Server Lỗi] Lỗi trong quá trình giải mã: {e}")
         socketio.emit('error', {'message': str(e)})
 
+@socketio.on('start_bulk_label')
+def handle_start_bulk_label():
+    global bulk_job_running
+    if bulk_job_running:
+        socketio.emit('error', {'message': 'Đang có một lượt gán nhãn hàng loạt chạy.'}); return
+    bulk_job_running = True
+    socketio.start_background_task(run_bulk_label)
+
+def find_consensus(predictions):
+    """Trả về nhãn được ít nhất CONSENSUS_THRESHOLD dự đoán hợp lệ đồng ý, ngược lại None."""
+    valid_predictions = [p for p in predictions if p and len(p) == CAPTCHA_LENGTH]
+    if not valid_predictions: return None
+    consensus_label, count = Counter(valid_predictions).most_common(1)[0]
+    return consensus_label if count >= CONSENSUS_THRESHOLD else None
+
+def run_bulk_label():
+    """
+    Chấm toàn bộ kho CAPTCHA_FOLDER theo lô BULK_BATCH_SIZE ảnh (một lần forward mỗi lô, trong thread pool),
+    chuyển các ảnh đạt đồng thuận sang RESULT_FOLDER và chỉ giữ lại các ảnh mơ hồ để người dùng kiểm tra.
+    """
+    global bulk_job_running
+    try:
+        total = failed_store.count()
+        labeled, ambiguous = 0, []
+        print(f"[Server] Bắt đầu gán nhãn hàng loạt cho {total} ảnh.")
+        socketio.emit('bulk_progress', {'done': 0, 'total': total, 'labeled': 0, 'ambiguous': 0})
+
+        done, after = 0, None
+        while done < total:
+            entries = failed_store.page(after=after, limit=BULK_BATCH_SIZE)
+            if not entries:
+                break
+            after = [entries[-1]['created_at'], entries[-1]['hash']]
+            batch, images_data = [], []
+            for entry in entries:
+                try:
+                    with open(failed_store.path(entry['filename']), "rb") as image_file:
+                        images_data.append(image_file.read())
+                except FileNotFoundError:
+                    # Ảnh đã bị xóa khỏi thư mục: bỏ khỏi chỉ mục
+                    failed_store.remove(entry['hash'])
+                    continue
+                batch.append(entry['filename'])
+            batch_predictions = tpool.execute(solve_captchas_variants, images_data, NUM_PREDICTIONS) if images_data else []
+
+            for image_name, predictions in zip(batch, batch_predictions):
+                consensus_label = find_consensus(predictions)
+                if consensus_label:
+                    new_filename = move_and_rename_file(image_name, consensus_label)
+                    labeled += 1
+                    socketio.emit('bulk_item', {'image_name': image_name, 'status': 'success', 'label': consensus_label, 'new_filename': new_filename})
+                else:
+                    ambiguous.append(image_name)
+                    socketio.emit('bulk_item', {'image_name': image_name, 'status': 'fail', 'predictions': predictions})
+            done += len(entries)
+            socketio.emit('bulk_progress', {'done': done, 'total': total, 'labeled': labeled, 'ambiguous': len(ambiguous)})
+
+        print(f"[Server] Gán nhãn hàng loạt xong: {labeled} ảnh đạt đồng thuận, {len(ambiguous)} ảnh cần kiểm tra thủ công.")
+        socketio.emit('bulk_finished', {'labeled': labeled, 'ambiguous': len(ambiguous)})
+    except Exception as e:
+        print(f"[Server Lỗi] Lỗi khi gán nhãn hàng loạt: {e}")
+        socketio.emit('error', {'message': str(e)})
+        return
+    finally:
+        bulk_job_running = False
+
+    if not ambiguous:
+        shutdown_and_train(needs_training=labeled > 0)
+    elif labeled:
+        # Còn ảnh mơ hồ: vẫn huấn luyện với các nhãn mới, sau đó trang kiểm tra từng ảnh mơ hồ (không gán hàng loạt lại)
+        socketio.sleep(1)
+        run_training()
+
 def move_and_rename_file(original_name, new_label):
+    """
+    Chuyển ảnh đã gán nhãn sang RESULT_FOLDER với tên `{nhãn}_{12 ký tự đầu mã băm}.png`: tên không trùng
+    giữa các ảnh khác nhau nên không phải dò tên trống; cùng tên nghĩa là cùng nội dung nên được ghi đè.
+    """
     try:
-        src_folder = resource_path(CAPTCHA_FOLDER)
         dest_folder = resource_path(RESULT_FOLDER)
         if not os.path.exists(dest_folder): os.makedirs(dest_folder)
 
-        original_path = os.path.join(src_folder, original_name)
-        
-        new_filename = f"{new_label}.png"
-        dest_path = os.path.join(dest_folder, new_filename)
-        counter = 1
-        while os.path.exists(dest_path):
-            new_filename = f"{new_label}_{counter}.png"
-            dest_path = os.path.join(dest_folder, new_filename)
-            counter += 1
-            
-        shutil.move(original_path, dest_path)
+        original_path = failed_store.path(original_name)
+        entry = failed_store.find(original_name)
+        if entry:
+            image_hash = entry['hash']
+        else:
+            with open(original_path, "rb") as image_file:
+                image_hash = hash_image_bytes(image_file.read())
+
+        new_filename = f"{new_label}_{image_hash[:12]}.png"
+        os.replace(original_path, os.path.join(dest_folder, new_filename))
+        failed_store.remove(image_hash)
         print(f"[Server] Đã chuyển '{original_name}' thành '{new_filename}' trong '{RESULT_FOLDER}'.")
         return new_filename
     except Exception as e:
         print(f"[Server Lỗi] Không thể di chuyển file: {e}")
         return original_name
 
+@socketio.on('cancel_training')
+def handle_cancel_training():
+    global training_cancelled
+    if training_process and training_process.poll() is None:
+        print("[Server] Người dùng yêu cầu hủy huấn luyện.")
+        training_cancelled = True
+        training_process.terminate()
+
 def run_training():
+    """
+    Chạy script huấn luyện như một tiến trình con không chặn (eventlet.green.subprocess) và
+    chuyển tiếp từng dòng đầu ra; các dòng "Epoch ..." được gửi thành sự kiện 'training_progress'.
+    """
+    global training_process, training_cancelled
     print("\n" + "="*50)
     print("[Server] Bắt đầu quá trình tái huấn luyện mô hình...")
     print("="*50)
@@ -185,16 +283,32 @@ def run_training():
         if sys.platform == "win32":
             creationflags = subprocess.CREATE_NO_WINDOW
         
-        result = subprocess.run(
-            [python_executable, train_script_path],
-            capture_output=True, text=True, check=False, creationflags=creationflags
+        training_cancelled = False
+        training_process = subprocess.Popen(
+            [python_executable, '-u', train_script_path, '--fine-tune'],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, creationflags=creationflags,
+            env=dict(os.environ, PYTHONIOENCODING='utf-8')
         )
+        output_lines = []
+        for raw_line in iter(training_process.stdout.readline, b''):
+            line = raw_line.decode('utf-8', errors='replace').rstrip()
+            print(line)
+            output_lines.append(line)
+            match = EPOCH_PATTERN.search(line)
+            if match:
+                epoch, epochs, loss, accuracy, elapsed = match.groups()
+                socketio.emit('training_progress', {'epoch': int(epoch), 'epochs': int(epochs), 'loss': float(loss),
+                                                    'accuracy': float(accuracy), 'elapsed': float(elapsed)})
+            elif line:
+                socketio.emit('training_log', {'line': line})
+        returncode = training_process.wait()
         
-        print(result.stdout)
-        if result.returncode != 0:
+        if training_cancelled:
+            print("[Server] Quá trình huấn luyện đã bị hủy.")
+            socketio.emit('training_cancelled', {})
+        elif returncode != 0:
             print("[Server Lỗi] Quá trình huấn luyện gặp lỗi.")
-            print(result.stderr)
-            socketio.emit('error', {'message': 'Quá trình huấn luyện gặp lỗi.'})
+            socketio.emit('error', {'message': f'Quá trình huấn luyện gặp lỗi: {output_lines[-1] if output_lines else returncode}'})
         else:
             print("[Server] Huấn luyện hoàn tất thành công!")
             socketio.emit('training_finished', {})
@@ -202,6 +316,8 @@ def run_training():
     except Exception as e:
         print(f"[Server Lỗi] Không thể chạy script huấn luyện: {e}")
         socketio.emit('error', {'message': f'Lỗi khi chạy script huấn luyện: {e}'})
+    finally:
+        training_process = None
 
 def shutdown_and_train(needs_training=True):
     socketio.sleep(2)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+MODULE LƯU TRỮ KẾT QUẢ TRA CỨU CỤC BỘ (V1 - SQLite)
+====================================================
+Lưu toàn bộ `result_data` của mỗi tờ khai (khóa theo `so_tk`) kèm thời điểm tra cứu.
+- Tờ khai đã ở trạng thái cuối (đã có "Ngày qua khu vực giám sát") luôn được lấy từ bộ nhớ.
+- Các tờ khai khác chỉ được tra cứu lại khi kết quả cũ hơn TTL cấu hình.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+
+DEFAULT_DB_FILE = "result_cache.sqlite3"
+DEFAULT_TTL_HOURS = 12
+TERMINAL_FIELDS = ("Ngày qua khu vực giám sát",)
+
+
+def is_terminal(result_data):
+    """Tờ khai đã hoàn tất thủ tục, kết quả sẽ không thay đổi nữa."""
+    return any(str(result_data.get(field, '')).strip() for field in TERMINAL_FIELDS)
+
+
+class ResultCache:
+    def __init__(self, db_path=DEFAULT_DB_FILE, ttl_hours=DEFAULT_TTL_HOURS):
+        self.ttl_seconds = ttl_hours * 3600
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "so_tk TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def get(self, so_tk):
+        """Trả về `result_data` nếu còn dùng được (trạng thái cuối hoặc chưa hết TTL), ngược lại None."""
+        with self._lock:
+            row = self._conn.execute("SELECT data, updated_at FROM results WHERE so_tk = ?", (so_tk,)).fetchone()
+        if not row:
+            return None
+        result_data = json.loads(row[0])
+        if is_terminal(result_data) or time.time() - row[1] < self.ttl_seconds:
+            return result_data
+        return None
+
+    def put(self, so_tk, result_data):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (so_tk, data, updated_at) VALUES (?, ?, ?)",
+                (so_tk, json.dumps(result_data, ensure_ascii=False), time.time())
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def open_result_cache(config, base_dir="."):
+    """Mở bộ nhớ kết quả theo mục 'result_cache' trong app_config.json. Trả về None nếu bị tắt."""
+    settings = config.get('result_cache', {})
+    if not settings.get('enabled', True):
+        return None
+    db_path = settings.get('db_file', DEFAULT_DB_FILE)
+    if not os.path.isabs(db_path):
+        db_path = os.path.join(base_dir, db_path)
+    return ResultCache(db_path, ttl_hours=settings.get('ttl_hours', DEFAULT_TTL_HOURS))
@@ -13,6 +13,8 @@ import subprocess
 import sys
 import os
 
+from failed_captcha_store import FailedCaptchaStore
+
 CAPTCHA_FOLDER = "failed_captchas"
 
 def resource_path(relative_path):
@@ -28,11 +30,12 @@ def check_if_captchas_exist():
     captcha_dir = resource_path(CAPTCHA_FOLDER)
     if not os.path.isdir(captcha_dir):
         return False
-    # Kiểm tra xem có bất kỳ file ảnh nào trong thư mục không
-    for filename in os.listdir(captcha_dir):
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            return True
-    return False
+    # Đếm trên chỉ mục của kho ảnh thay vì liệt kê cả thư mục
+    store = FailedCaptchaStore(captcha_dir)
+    try:
+        return store.count() > 0
+    finally:
+        store.close()
 
 try:
     python_executable = sys.executable
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+MODULE ĐO THỜI GIAN THEO GIAI ĐOẠN VÀ BÁO CÁO LƯỢT CHẠY (V1)
+=============================================================
+- `SpanRecorder`: đo thời gian từng giai đoạn của một tờ khai (tải trang, chờ CAPTCHA, giải CAPTCHA,
+  chờ phản hồi sau khi gửi, ghi Sheet). Kết quả được gắn vào sự kiện dưới khóa 'metrics':
+      {'spans': [(giai đoạn, giây), ...], 'so_tk', 'attempts', 'correct', 'wrong', 'skipped'}
+  ('so_tk' chỉ có ở sự kiện cuối cùng của mỗi tờ khai; chỉ các sự kiện này được tính là một tờ khai).
+- `RunMetrics`: gộp các sự kiện của một lượt chạy; tính ETA và báo cáo cuối lượt (p50/p95 mỗi giai đoạn,
+  số lần thử mỗi tờ khai, tỉ lệ giải đúng CAPTCHA, số tờ khai mỗi phút).
+- `SamplingProfiler`: bộ lấy mẫu ngăn xếp (tùy chọn, mục 'profiling' trong app_config.json),
+  ghi dạng "collapsed stacks" dùng được với flamegraph.pl / speedscope.
+"""
+import os
+import sys
+import time
+import threading
+import contextlib
+from collections import defaultdict, Counter
+
+STAGES = ('page_load', 'captcha_wait', 'inference', 'submit_wait', 'sheet_write')
+DEFAULT_PROFILING_SETTINGS = {
+    'enabled': False,
+    'interval_ms': 10,
+    'output_file': 'profile_stacks.txt',
+}
+
+
+class SpanRecorder:
+    def __init__(self):
+        self.spans = []
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((stage, round(time.perf_counter() - start, 4)))
+
+
+def percentile(values, p):
+    """Phân vị `p` (0-100) theo thứ hạng gần nhất; None nếu danh sách rỗng."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+class RunMetrics:
+    """Gộp số liệu của một lượt chạy (an toàn đa luồng, vì bộ ghi Sheet gửi sự kiện từ luồng riêng)."""
+    def __init__(self, total=0):
+        self.total = total
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+        self.stage_seconds = defaultdict(list)
+        self.attempts = []
+        self.declarations = 0
+        self.cached = 0
+        self.correct = self.wrong = self.skipped = 0
+
+    def add(self, event):
+        with self._lock:
+            if event.get('status') == 'RESULT' and event.get('cached'):
+                self.declarations += 1
+                self.cached += 1
+                return
+            metrics = event.get('metrics')
+            if not metrics:
+                return
+            for stage, seconds in metrics.get('spans', ()):
+                self.stage_seconds[stage].append(seconds)
+            self.correct += metrics.get('correct', 0)
+            self.wrong += metrics.get('wrong', 0)
+            self.skipped += metrics.get('skipped', 0)
+            if 'so_tk' in metrics:
+                self.declarations += 1
+                self.attempts.append(metrics.get('attempts', 0))
+
+    def declarations_per_minute(self):
+        elapsed = time.monotonic() - self.started_at
+        return self.declarations / elapsed * 60 if elapsed > 0 else 0.0
+
+    def eta_seconds(self):
+        """Thời gian còn lại ước tính theo tốc độ thực đo; None khi chưa đủ dữ liệu."""
+        rate = self.declarations_per_minute()
+        if not self.declarations or not rate or not self.total:
+            return None
+        return max(self.total - self.declarations, 0) / rate * 60
+
+    def summary(self):
+        """Báo cáo cuối lượt chạy, mỗi dòng một chỉ số."""
+        with self._lock:
+            elapsed = time.monotonic() - self.started_at
+            lines = [f"Đã xử lý {self.declarations}/{self.total} tờ khai ({self.cached} lấy từ bộ nhớ) trong {elapsed:.0f} giây "
+                     f"- {self.declarations_per_minute():.1f} tờ khai/phút."]
+            if self.attempts:
+                lines.append(f"Số lần gửi CAPTCHA mỗi tờ khai: trung bình {sum(self.attempts) / len(self.attempts):.2f}, "
+                             f"p95 {percentile(self.attempts, 95)}.")
+            submitted = self.correct + self.wrong
+            if submitted:
+                lines.append(f"CAPTCHA giải đúng {self.correct}/{submitted} ({100 * self.correct / submitted:.1f}%), "
+                             f"bỏ qua {self.skipped} dự đoán kém tin cậy.")
+            for stage in sorted(self.stage_seconds, key=lambda s: STAGES.index(s) if s in STAGES else len(STAGES)):
+                values = self.stage_seconds[stage]
+                lines.append(f"  {stage:<13} n={len(values):<6} p50={percentile(values, 50):.3f}s  "
+                             f"p95={percentile(values, 95):.3f}s  tổng={sum(values):.1f}s")
+            return lines
+
+
+def track(events, metrics):
+    """Chuyển tiếp các sự kiện tra cứu, đồng thời ghi vào `metrics` và gắn 'eta_seconds' cho sự kiện có tiến độ."""
+    for event in events:
+        metrics.add(event)
+        if event.get('status') in ('PROGRESS', 'RESULT'):
+            event['eta_seconds'] = metrics.eta_seconds()
+            event['rate_per_minute'] = metrics.declarations_per_minute()
+        yield event
+
+
+class SamplingProfiler:
+    """Lấy mẫu ngăn xếp của mọi luồng sau mỗi `interval` giây bằng `sys._current_frames()`."""
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, output_file):
+        self._stop_event.set()
+        self._thread.join()
+        with open(output_file, 'w', encoding='utf-8') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+@contextlib.contextmanager
+def profile_run(settings=None):
+    """Bọc một lượt chạy bằng `SamplingProfiler` nếu mục 'profiling' được bật; ngược lại không làm gì."""
+    settings = {**DEFAULT_PROFILING_SETTINGS, **(settings or {})}
+    if not settings['enabled']:
+        yield None
+        return
+    profiler = SamplingProfiler(settings['interval_ms'] / 1000)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop(settings['output_file'])
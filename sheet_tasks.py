@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+MODULE ĐỌC DANH SÁCH TỜ KHAI CẦN XỬ LÝ TỪ GOOGLE SHEETS (V1)
+=============================================================
+Chỉ tải các cột cần thiết (cột Số TK và các cột kết quả) bằng một lệnh `batch_get`
+thay vì `get_all_records()` trên toàn bộ sheet, sau đó lọc các dòng chưa có
+kết quả bằng phép toán vector của pandas.
+"""
+import pandas as pd
+
+FIRST_DATA_ROW = 2  # Dòng 1 là tiêu đề
+
+
+def _column_values(value_range):
+    """Lấy danh sách giá trị của một cột từ kết quả `batch_get` (major_dimension='COLUMNS')."""
+    return list(value_range[0]) if value_range else []
+
+
+def field_columns_from(gui_settings):
+    """
+    Ánh xạ trường kết quả -> cột ghi từ mục 'gui_app' trong app_config.json: 'field_columns',
+    hoặc cặp 'result_field'/'write_col' của cấu hình cũ (một trường).
+    """
+    field_columns = gui_settings.get('field_columns')
+    if field_columns:
+        return {field: col.upper() for field, col in field_columns.items() if col}
+    if gui_settings.get('result_field') and gui_settings.get('write_col'):
+        return {gui_settings['result_field']: gui_settings['write_col'].upper()}
+    return {}
+
+
+def load_pending_tasks(worksheet, read_col, write_cols):
+    """
+    Trả về danh sách {'so_tk', 'row_index'} cho các dòng có Số TK hợp lệ (chỉ gồm chữ số)
+    và còn ít nhất một ô trống trong các cột kết quả `write_cols`.
+    """
+    read_col = read_col.upper()
+    write_cols = list(dict.fromkeys(col.upper() for col in write_cols))
+    read_range, *write_ranges = worksheet.batch_get(
+        [f"{col}{FIRST_DATA_ROW}:{col}" for col in [read_col] + write_cols],
+        major_dimension='COLUMNS'
+    )
+
+    so_tk = pd.Series(_column_values(read_range), dtype='object').fillna('').astype(str).str.strip()
+    # Google Sheets bỏ các ô trống ở cuối cột, nên cột kết quả có thể ngắn hơn cột Số TK
+    written = pd.concat([pd.Series(_column_values(write_range), dtype='object').reindex(so_tk.index).fillna('')
+                         for write_range in write_ranges], axis=1)
+
+    pending = written.eq('').any(axis=1) & so_tk.str.isdigit()
+    row_indexes = so_tk.index[pending] + FIRST_DATA_ROW
+    return [{'so_tk': s, 'row_index': int(r)} for s, r in zip(so_tk[pending].tolist(), row_indexes.tolist())]
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+MODULE GHI KẾT QUẢ LÊN GOOGLE SHEETS THEO LÔ (V1)
+==================================================
+Gom các ô kết quả vào bộ đệm và ghi bằng `batch_update` trên một luồng nền,
+để vòng lặp tra cứu (Selenium) và giao diện không phải chờ Google API.
+- Ghi khi bộ đệm đủ `batch_size` ô hoặc sau `flush_interval` giây.
+- Giới hạn số request mỗi phút theo hạn mức ghi của Sheets API.
+- Tự động thử lại với thời gian chờ tăng dần khi gặp lỗi 429/5xx.
+"""
+import time
+import queue
+import threading
+import gspread
+
+BATCH_SIZE = 200
+FLUSH_INTERVAL_SECONDS = 30
+MAX_REQUESTS_PER_MINUTE = 50  # Hạn mức của Sheets API là 60 request ghi/phút/người dùng
+MAX_WRITE_RETRIES = 5
+INITIAL_BACKOFF_SECONDS = 2
+MAX_BACKOFF_SECONDS = 64
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class SheetWriter:
+    """
+    Bộ ghi chạy nền cho một worksheet. Sự kiện (PROGRESS/ERROR/FINAL_ERROR) được
+    gửi qua `on_event` theo cùng định dạng dict mà `run_batch_processing` trả về.
+    """
+    def __init__(self, worksheet, on_event=None, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL_SECONDS, max_requests_per_minute=MAX_REQUESTS_PER_MINUTE):
+        self.worksheet = worksheet
+        self.on_event = on_event or (lambda event: None)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.min_request_interval = 60.0 / max_requests_per_minute
+        self.api_calls = 0
+        self.cells_written = 0
+        self._pending = queue.Queue()
+        self._stop_event = threading.Event()
+        self._last_request_time = 0.0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, row, col, value):
+        """Đưa một ô (hàng, cột dạng chữ như 'DD') vào hàng đợi ghi. Không chặn."""
+        self._pending.put((row, col.upper(), value))
+
+    def write_fields(self, row, field_columns, result_data):
+        """Đưa mọi trường trong `field_columns` (trường -> cột) của một tờ khai vào hàng đợi ghi, cùng lô."""
+        for field, col in field_columns.items():
+            self.write(row, col, f"'{result_data.get(field, 'N/A')}")
+
+    def close(self, timeout=None):
+        """Ghi nốt phần còn lại trong bộ đệm rồi dừng luồng nền."""
+        self._stop_event.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        buffer = []
+        deadline = None
+        while True:
+            try:
+                buffer.append(self._pending.get(timeout=0.5))
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            except queue.Empty:
+                pass
+
+            stopping = self._stop_event.is_set()
+            if stopping:
+                while True:
+                    try:
+                        buffer.append(self._pending.get_nowait())
+                    except queue.Empty:
+                        break
+
+            if buffer and (stopping or len(buffer) >= self.batch_size or time.monotonic() >= deadline):
+                self._flush(buffer)
+                buffer, deadline = [], None
+
+            if stopping:
+                return
+
+    def _flush(self, cells):
+        for start in range(0, len(cells), self.batch_size):
+            chunk = cells[start:start + self.batch_size]
+            data = [{'range': f"{col}{row}", 'values': [[value]]} for row, col, value in chunk]
+            started_at = time.perf_counter()
+            if self._send(data):
+                self.cells_written += len(chunk)
+                self.on_event({'status': 'PROGRESS', 'message': f'Đã ghi {len(chunk)} ô kết quả lên Google Sheet (tổng {self.cells_written}).',
+                               'metrics': {'spans': [('sheet_write', round(time.perf_counter() - started_at, 4))]}})
+            else:
+                rows = sorted({row for row, _, _ in chunk})
+                self.on_event({'status': 'FINAL_ERROR', 'message': f'Không thể ghi {len(chunk)} ô kết quả (các dòng {rows[0]}-{rows[-1]}) sau {MAX_WRITE_RETRIES} lần thử.'})
+
+    def _throttle(self):
+        wait_time = self._last_request_time + self.min_request_interval - time.monotonic()
+        if wait_time > 0:
+            time.sleep(wait_time)
+        self._last_request_time = time.monotonic()
+
+    def _send(self, data):
+        backoff = INITIAL_BACKOFF_SECONDS
+        for attempt in range(MAX_WRITE_RETRIES):
+            self._throttle()
+            try:
+                self.api_calls += 1
+                self.worksheet.batch_update(data, value_input_option='USER_ENTERED')
+                return True
+            except gspread.exceptions.APIError as e:
+                status_code = getattr(getattr(e, 'response', None), 'status_code', None)
+                if status_code not in RETRYABLE_STATUS_CODES:
+                    self.on_event({'status': 'ERROR', 'message': f'Lỗi Google API khi ghi kết quả: {e}'})
+                    return False
+                self.on_event({'status': 'ERROR', 'message': f'Google Sheets báo lỗi {status_code} (lần thử {attempt + 1}/{MAX_WRITE_RETRIES}). Chờ {backoff} giây...'})
+            except Exception as e:
+                self.on_event({'status': 'ERROR', 'message': f'Lỗi mạng khi ghi kết quả (lần thử {attempt + 1}/{MAX_WRITE_RETRIES}): {e}'})
+            if attempt < MAX_WRITE_RETRIES - 1:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF_SECONDS)
+        return False
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+BÁO CÁO THỜI GIAN KHỞI ĐỘNG (V1)
+=================================
+So sánh thời gian import các module của ứng dụng trong một tiến trình Python mới:
+- "Nạp trễ": chỉ import giao diện như khi mở ứng dụng (torch/cv2/gspread/selenium chưa được nạp).
+- "Nạp sẵn": import toàn bộ chuỗi tra cứu và nạp model như phiên bản cũ làm ngay khi khởi động.
+
+Cách dùng:
+    python startup_report.py [--repeat 3]
+"""
+import sys
+import argparse
+import subprocess
+
+SCENARIOS = [
+    ("Nạp trễ (gui_app)",
+     "import gui_app"),
+    ("Nạp sẵn (gspread, pandas, selenium, torch, cv2 + model)",
+     "import gui_app, gspread, pandas, worker_pool, sheet_writer, sheet_tasks, captcha_solver; captcha_solver.load_model()"),
+]
+HEAVY_MODULES = ["torch", "cv2", "pandas", "gspread", "selenium"]
+
+
+def time_scenario(statement):
+    """Chạy `statement` trong tiến trình mới, trả về (số giây, các thư viện nặng đã được nạp)."""
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        f"{statement}\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"loaded = [m for m in {HEAVY_MODULES!r} if m in sys.modules]\n"
+        "print(elapsed); print(','.join(loaded))\n"
+    )
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout.splitlines()
+    return float(output[-2]), output[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Đo thời gian khởi động của ứng dụng.")
+    parser.add_argument("--repeat", type=int, default=3, help="Số lần đo cho mỗi kịch bản (lấy giá trị nhỏ nhất).")
+    args = parser.parse_args()
+
+    results = []
+    for name, statement in SCENARIOS:
+        try:
+            runs = [time_scenario(statement) for _ in range(args.repeat)]
+        except subprocess.CalledProcessError as e:
+            print(f"{name}: lỗi khi import\n{e.stderr}")
+            return 1
+        best = min(seconds for seconds, _ in runs)
+        results.append(best)
+        print(f"{name}: {best:.2f} giây (thư viện nặng đã nạp: {runs[0][1] or 'không'})")
+
+    lazy, eager = results
+    print(f"Tiết kiệm: {eager - lazy:.2f} giây ({eager / lazy:.1f} lần nhanh hơn)" if lazy else "")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
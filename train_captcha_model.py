@@ -1,110 +1,248 @@
 # -*- coding: utf-8 -*-
 """
-HUẤN LUYỆN MÔ HÌNH NHẬN DẠNG KÝ TỰ CAPTCHA (V3 - Không dùng scikit-learn)
+HUẤN LUYỆN MÔ HÌNH NHẬN DẠNG KÝ TỰ CAPTCHA (V4 - Có chế độ fine-tune)
 ===========================================================================
+Cách dùng:
+    python train_captcha_model.py              # Huấn luyện lại từ đầu trên toàn bộ dữ liệu
+    python train_captcha_model.py --fine-tune  # Tiếp tục từ model hiện tại với các ảnh mới
+                                               # (huấn luyện lại từ đầu nếu chưa có model hoặc model fine-tune bị loại)
+Chế độ fine-tune nạp `captcha_model.pth`, mở rộng label encoder khi có ký tự mới và chỉ huấn luyện
+vài epoch trên các ảnh được thêm sau lần lưu model gần nhất, trộn với một mẫu ngẫu nhiên ảnh cũ
+(replay) để không quên kiến thức cũ. Thời gian huấn luyện tỉ lệ với lượng dữ liệu mới.
+Mỗi lần huấn luyện tạo một phiên bản trong `models/` (xem model_store); phiên bản chỉ được dùng
+khi độ chính xác không thấp hơn model hiện tại trên tập kiểm tra giữ riêng của `char_dataset`
+(các ảnh này không bao giờ được dùng để huấn luyện, ở cả hai chế độ).
 """
 
 import os
-import cv2
+import copy
+import time
+import argparse
 import numpy as np
 import pickle
 import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import DataLoader, TensorDataset
-from sklearn.model_selection import train_test_split
-import imutils
 from captcha_solver import SimpleLabelEncoder, CaptchaNet
+from char_dataset import load_character_dataset, DEFAULT_CACHE_DIR
+import model_store
+from benchmark_solver import check_solver_baseline
 
 # --- CÁC THAM SỐ CẤU HÌNH ---
 CAPTCHA_IMAGE_FOLDER = "captcha_result"
 MODEL_FILENAME = "captcha_model.pth"
 MODEL_LABELS_FILENAME = "label_encoder.pkl"
-IMAGE_WIDTH = 20
-IMAGE_HEIGHT = 20
-CAPTCHA_LENGTH = 5
-
-
-# --- CÁC HÀM VÀ LỚP KHÁC ---
-def preprocess_and_segment(image_path):
-    image = cv2.imread(image_path)
-    if image is None: return []
-    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    lower_blue = np.array([90, 80, 2])
-    upper_blue = np.array([150, 255, 255])
-    mask = cv2.inRange(hsv, lower_blue, upper_blue)
-    opening = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((2, 2), np.uint8))
-    closing = cv2.morphologyEx(opening, cv2.MORPH_CLOSE, np.ones((3, 3), np.uint8))
-    contours = cv2.findContours(closing.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    contours = imutils.grab_contours(contours)
-    char_contours = [c for c in contours if cv2.contourArea(c) > 15 and cv2.boundingRect(c)[3] > 10]
-    if len(char_contours) < CAPTCHA_LENGTH: return []
-    char_contours = sorted(char_contours, key=cv2.contourArea, reverse=True)[:CAPTCHA_LENGTH]
-    char_contours = sorted(char_contours, key=lambda c: cv2.boundingRect(c)[0])
-    if len(char_contours) != CAPTCHA_LENGTH: return []
-    segmented_chars = [cv2.resize(closing[y:y+h, x:x+w], (IMAGE_WIDTH, IMAGE_HEIGHT)) for x,y,w,h in [cv2.boundingRect(c) for c in char_contours]]
-    return segmented_chars
+CHAR_CACHE_DIR = DEFAULT_CACHE_DIR
+EPOCHS = 30
+LEARNING_RATE = 0.001
+BATCH_SIZE = 32
+FINE_TUNE_EPOCHS = 5
+FINE_TUNE_LEARNING_RATE = 0.0005
+REPLAY_RATIO = 2  # Số ký tự cũ được trộn vào cho mỗi ký tự mới
 
 
-def main():
-    print("[INFO] Loading and preparing data...")
-    data, labels = [], []
-    
-    for filename in os.listdir(CAPTCHA_IMAGE_FOLDER):
-        if not filename.lower().endswith((".png", ".jpg", ".jpeg")): continue
-        image_path = os.path.join(CAPTCHA_IMAGE_FOLDER, filename)
-        captcha_text = os.path.splitext(filename)[0].split('_')[0]
-        if len(captcha_text) != CAPTCHA_LENGTH: continue
-        segmented_chars = preprocess_and_segment(image_path)
-        if len(segmented_chars) == CAPTCHA_LENGTH:
-            for char_text, char_image in zip(captcha_text, segmented_chars):
-                data.append(char_image)
-                labels.append(char_text)
-
-    if not data:
-        print("[ERROR] No data was loaded.")
-        return
-
-    print(f"[INFO] Found {len(data)} individual characters.")
-    data = np.array(data, dtype="float32") / 255.0
-    data = np.expand_dims(data, axis=1)
-
-    le = SimpleLabelEncoder()
-    labels_encoded = le.fit_transform(labels)
-
-    (X_train, X_test, y_train, y_test) = train_test_split(
-        data, labels_encoded, test_size=0.2, random_state=42, stratify=labels_encoded)
-
-    train_loader = DataLoader(TensorDataset(torch.from_numpy(X_train), torch.from_numpy(y_train).type(torch.LongTensor)), batch_size=32, shuffle=True)
-
-    print("[INFO] Building and training the model...")
-    model = CaptchaNet(num_classes=len(le.classes_))
+def train(model, X_train, y_train, epochs, learning_rate):
+    train_loader = DataLoader(TensorDataset(torch.from_numpy(X_train), torch.from_numpy(y_train).type(torch.LongTensor)), batch_size=BATCH_SIZE, shuffle=True)
     criterion = nn.CrossEntropyLoss()
-    optimizer = optim.Adam(model.parameters(), lr=0.001)
+    optimizer = optim.Adam(model.parameters(), lr=learning_rate)
 
-    epochs = 30
+    start = time.perf_counter()
     for epoch in range(epochs):
         model.train()
-        running_loss = 0.0
+        running_loss, correct = 0.0, 0
         for inputs, targets in train_loader:
+            inputs = inputs.float() / 255.0
             optimizer.zero_grad(); outputs = model(inputs); loss = criterion(outputs, targets)
             loss.backward(); optimizer.step(); running_loss += loss.item()
-        print(f"Epoch {epoch+1}/{epochs}, Loss: {running_loss/len(train_loader):.4f}")
+            correct += (outputs.argmax(1) == targets).sum().item()
+        # Dòng này được recheck_server đọc để hiển thị tiến độ theo từng epoch
+        print(f"Epoch {epoch+1}/{epochs}, Loss: {running_loss/len(train_loader):.4f}, "
+              f"Accuracy: {100 * correct / len(y_train):.2f}%, Elapsed: {time.perf_counter() - start:.1f}s", flush=True)
 
-    print("[INFO] Evaluating and saving the model...")
+
+def evaluate(model, le, X_test, test_labels):
+    """Độ chính xác (%) theo ký tự; so sánh theo chuỗi nhãn để dùng được cho model có bộ mã nhãn khác."""
+    model.eval()
+    if not len(test_labels): return 0.0
+    with torch.no_grad():
+        outputs = model(torch.from_numpy(X_test).float() / 255.0)
+        predicted = le.inverse_transform(torch.max(outputs.data, 1)[1].numpy())
+        return 100 * float(np.mean(predicted == np.asarray(test_labels)))
+
+
+def load_current_model():
+    """
+    Model đang dùng: (model, le, thời điểm tạo, đã loại tập kiểm tra giữ riêng khi huấn luyện hay chưa)
+    hoặc None nếu chưa có model nào.
+    """
+    versioned = model_store.current_model_paths()
+    if versioned and os.path.exists(versioned[0]):
+        model_path, labels_path, _ = versioned
+        version = model_store.current_version()
+        created_at, excludes_holdout = version['created_at'], version.get('excludes_holdout', False)
+    elif os.path.exists(MODEL_FILENAME) and os.path.exists(MODEL_LABELS_FILENAME):
+        model_path, labels_path = MODEL_FILENAME, MODEL_LABELS_FILENAME
+        created_at, excludes_holdout = os.path.getmtime(MODEL_FILENAME), False
+    else:
+        return None
+    with open(labels_path, "rb") as f:
+        le = pickle.load(f)
+    model = CaptchaNet(num_classes=len(le.classes_))
+    model.load_state_dict(torch.load(model_path, map_location=torch.device('cpu')))
     model.eval()
+    return model, le, created_at, excludes_holdout
+
+
+def holdout_indexes(dataset, current):
+    """
+    Chỉ số các ký tự dùng để so sánh model mới với `current`: tập kiểm tra giữ riêng. Với model được huấn luyện
+    trước khi có tập này, chỉ lấy ảnh thêm vào sau khi model được tạo (các ảnh cũ model có thể đã học).
+    """
+    indexes = np.flatnonzero(dataset.holdout)
+    if current and not current[3]:
+        unseen = indexes[dataset.added_at[indexes] > current[2]]
+        if len(unseen):
+            return unseen
+        print("[WARNING] The current model was trained before the holdout set existed; "
+              "its accuracy on the holdout set may be overestimated.")
+    return indexes
+
+
+def save_model(model, le, accuracy, baseline_accuracy, dataset):
+    """
+    Ghi phiên bản mới vào `models/`; chỉ dùng nó khi không kém model hiện tại trên cùng tập kiểm tra
+    và không kém hơn mốc `solver_baseline.json` của benchmark_solver (nếu đã có mốc).
+    """
+    def write_files(target_dir):
+        torch.save(model.state_dict(), os.path.join(target_dir, MODEL_FILENAME))
+        with open(os.path.join(target_dir, MODEL_LABELS_FILENAME), "wb") as f:
+            pickle.dump(le, f)
+
+    train_indexes = np.flatnonzero(~dataset.holdout)
+    training_set_hash = model_store.training_set_hash([dataset.image_hashes[i] for i in train_indexes],
+                                                      [dataset.labels[i] for i in train_indexes])
+    regressions = []
+    if baseline_accuracy is None or accuracy >= baseline_accuracy:
+        regressions = check_solver_baseline(model, le)
+    version, promoted = model_store.publish_model(write_files, accuracy, baseline_accuracy, training_set_hash,
+                                                  excludes_holdout=True, regressions=regressions)
+    if promoted:
+        print(f"[INFO] Model saved as version {version} and is now in use.")
+    elif regressions:
+        print(f"[WARNING] Model saved as version {version} but NOT used: worse than the solver baseline "
+              f"({'; '.join(regressions)}).")
+    else:
+        print(f"[WARNING] Model saved as version {version} but NOT used: accuracy {accuracy:.2f}% "
+              f"is lower than the current model's {baseline_accuracy:.2f}% on the holdout set.")
+    return promoted
+
+
+def expand_output_layer(model, num_classes):
+    """Mở rộng lớp đầu ra cho các ký tự mới, giữ nguyên trọng số của các lớp đã học."""
+    old_fc = model.fc2
+    new_fc = nn.Linear(old_fc.in_features, num_classes)
     with torch.no_grad():
-        outputs = model(torch.from_numpy(X_test))
-        _, predicted = torch.max(outputs.data, 1)
-        accuracy = 100 * (predicted == torch.from_numpy(y_test)).sum().item() / len(y_test)
-        print(f"[INFO] Test accuracy: {accuracy:.2f}%")
-
-    torch.save(model.state_dict(), MODEL_FILENAME)
-    print(f"[INFO] Model saved to {MODEL_FILENAME}")
-    with open(MODEL_LABELS_FILENAME, "wb") as f:
-        pickle.dump(le, f)
-    print(f"[INFO] Label encoder saved to {MODEL_LABELS_FILENAME}")
-    
+        new_fc.weight[:old_fc.out_features] = old_fc.weight
+        new_fc.bias[:old_fc.out_features] = old_fc.bias
+    model.fc2 = new_fc
+
+
+def load_dataset():
+    start = time.perf_counter()
+    dataset = load_character_dataset(CAPTCHA_IMAGE_FOLDER, CHAR_CACHE_DIR)
+    stats = dataset.stats
+    print(f"[INFO] {stats['images']} unique images ({stats['new_images']} newly segmented, {stats['relabelled']} relabelled, "
+          f"{stats['duplicates']} duplicates skipped, {stats['segmentation_failed']} unsegmentable) "
+          f"in {time.perf_counter() - start:.1f}s.")
+    return dataset
+
+
+def train_from_scratch(dataset):
+    train_indexes = np.flatnonzero(~dataset.holdout)
+    print(f"[INFO] Found {len(dataset.labels)} individual characters ({len(train_indexes)} for training).")
+    if not len(train_indexes):
+        print("[ERROR] Not enough data outside the holdout set to train.")
+        return False
+    # Giữ dạng uint8 (N, 1, H, W); chỉ chuẩn hóa về float theo từng batch
+    X_train = np.expand_dims(dataset.chars[train_indexes], axis=1)
+
+    le = SimpleLabelEncoder()
+    y_train = le.fit_transform([dataset.labels[i] for i in train_indexes])
+
+    print("[INFO] Building and training the model...")
+    model = CaptchaNet(num_classes=len(le.classes_))
+    train(model, X_train, y_train, EPOCHS, LEARNING_RATE)
+
+    print("[INFO] Evaluating and saving the model...")
+    current = load_current_model()
+    test_indexes = holdout_indexes(dataset, current)
+    X_test = np.expand_dims(dataset.chars[test_indexes], axis=1)
+    test_labels = [dataset.labels[i] for i in test_indexes]
+    accuracy = evaluate(model, le, X_test, test_labels)
+    print(f"[INFO] Holdout accuracy: {accuracy:.2f}% on {len(test_labels)} characters")
+    baseline_accuracy = evaluate(current[0], current[1], X_test, test_labels) if current else None
+    return save_model(model, le, accuracy, baseline_accuracy, dataset)
+
+
+def fine_tune(dataset, current):
+    """Tiếp tục huấn luyện model hiện tại trên các ký tự mới + một mẫu replay ký tự cũ."""
+    current_model, current_le, created_at, _ = current
+    model, le = copy.deepcopy(current_model), copy.deepcopy(current_le)
+
+    is_new = dataset.added_at > created_at
+    new_indexes = np.flatnonzero(is_new & ~dataset.holdout)
+    old_indexes = np.flatnonzero(~is_new & ~dataset.holdout)
+    if not len(new_indexes):
+        print("[INFO] No new images since the last model was saved. Nothing to fine-tune.")
+        return
+
+    added = le.extend(dataset.labels)
+    if added:
+        print(f"[INFO] Extending label encoder with {added} new character(s).")
+        expand_output_layer(model, len(le.classes_))
+
+    rng = np.random.default_rng(42)
+    replay_indexes = rng.choice(old_indexes, size=min(len(old_indexes), REPLAY_RATIO * len(new_indexes)), replace=False)
+    indexes = rng.permutation(np.concatenate([new_indexes, replay_indexes]))
+    print(f"[INFO] Fine-tuning on {len(new_indexes)} new + {len(replay_indexes)} replay characters.")
+
+    data = np.expand_dims(dataset.chars[indexes], axis=1)
+    labels_encoded = le.transform([dataset.labels[i] for i in indexes])
+    train(model, data, labels_encoded, FINE_TUNE_EPOCHS, FINE_TUNE_LEARNING_RATE)
+
+    print("[INFO] Evaluating and saving the model...")
+    test_indexes = holdout_indexes(dataset, current)
+    X_test = np.expand_dims(dataset.chars[test_indexes], axis=1)
+    test_labels = [dataset.labels[i] for i in test_indexes]
+    accuracy = evaluate(model, le, X_test, test_labels)
+    baseline_accuracy = evaluate(current_model, current_le, X_test, test_labels)
+    print(f"[INFO] Holdout accuracy: {accuracy:.2f}% (current model: {baseline_accuracy:.2f}%) on {len(test_labels)} characters")
+    return save_model(model, le, accuracy, baseline_accuracy, dataset)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Huấn luyện mô hình nhận dạng ký tự CAPTCHA.")
+    parser.add_argument("--fine-tune", action="store_true", help="Tiếp tục từ model hiện tại với các ảnh mới.")
+    args = parser.parse_args()
+
+    print("[INFO] Loading and preparing data...")
+    dataset = load_dataset()
+    if not dataset.labels:
+        print("[ERROR] No data was loaded.")
+        return
+
+    current = load_current_model() if args.fine_tune else None
+    if current:
+        if fine_tune(dataset, current) is False:
+            # Model fine-tune kém hơn model hiện tại (lệch do replay tích lũy, tập nhãn thay đổi nhiều...)
+            print("[INFO] Fine-tuned model was rejected, retraining from scratch.")
+            train_from_scratch(dataset)
+    else:
+        if args.fine_tune:
+            print("[INFO] No existing model found, training from scratch.")
+        train_from_scratch(dataset)
+
     print("\n[SUCCESS] Training process completed!")
 
 if __name__ == "__main__":
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+MODULE TRA CỨU SONG SONG VỚI NHIỀU TRÌNH DUYỆT (V1)
+====================================================
+- N trình duyệt cùng lấy tờ khai từ một hàng đợi chung.
+- Một `RateLimiter` dùng chung giữ tổng lưu lượng tới cổng hải quan ở mức cấu hình.
+- Sự kiện của mọi trình duyệt được gộp vào một luồng sự kiện duy nhất, cùng định dạng
+  với `run_batch_processing`, để giao diện và chế độ chạy nền dùng lại nguyên vẹn.
+"""
+import os
+import queue
+import threading
+from selenium.webdriver.support.ui import WebDriverWait
+
+from batch_processor import (run_batch_processing, serve_cached_results, create_driver,
+                             load_lookup_page, lookup_declaration, lookup_url_from, FAILED_CAPTCHA_FOLDER)
+from captcha_solver import warm_up
+from confidence_gate import open_confidence_gate
+from rate_limiter import RateLimiter
+from page_readiness import ReadinessTracker
+from run_metrics import SpanRecorder
+
+DEFAULT_ENGINE = "selenium"
+DEFAULT_WORKERS = 1
+DEFAULT_MAX_REQUESTS_PER_MINUTE = 20
+
+# Trạng thái nội bộ giữa các luồng trình duyệt và bộ gộp sự kiện
+_TASK_DONE = '_TASK_DONE'
+_WORKER_EXIT = '_WORKER_EXIT'
+
+
+def run_lookup(so_tk_list, stop_event, config, result_cache=None, driver=None):
+    """
+    Chọn cách tra cứu theo app_config.json: 'lookup_engine' = "http" dùng `run_http_processing`
+    (Selenium làm dự phòng); ngược lại theo mục 'worker_pool': một trình duyệt
+    (`run_batch_processing`) hoặc nhóm nhiều trình duyệt.
+    """
+    # Nạp model CAPTCHA song song với việc khởi động trình duyệt/kết nối mạng
+    warm_up()
+    pool_settings = config.get('worker_pool', {})
+    num_workers = pool_settings.get('workers', DEFAULT_WORKERS)
+    rate_limiter = RateLimiter(pool_settings.get('max_requests_per_minute', DEFAULT_MAX_REQUESTS_PER_MINUTE))
+    browser_settings = config.get('browser')
+    confidence_gate = open_confidence_gate(config, base_dir=os.path.abspath("."))
+    if config.get('lookup_engine', DEFAULT_ENGINE) == 'http':
+        from http_engine import run_http_processing
+        return run_http_processing(so_tk_list, stop_event, result_cache=result_cache, rate_limiter=rate_limiter,
+                                   settings=config.get('http_engine'), browser_settings=browser_settings,
+                                   confidence_gate=confidence_gate)
+    if num_workers <= 1 or driver is not None:
+        return run_batch_processing(so_tk_list, stop_event, result_cache=result_cache, driver=driver,
+                                    rate_limiter=rate_limiter, browser_settings=browser_settings,
+                                    confidence_gate=confidence_gate)
+    return run_pooled_processing(so_tk_list, stop_event, num_workers, rate_limiter, result_cache=result_cache,
+                                 browser_settings=browser_settings, confidence_gate=confidence_gate)
+
+
+def _browser_worker(worker_id, task_queue, event_queue, stop_event, rate_limiter, result_cache, readiness, browser_settings,
+                    confidence_gate):
+    driver = None
+    lookup_url = lookup_url_from(browser_settings)
+    try:
+        event_queue.put({'status': 'PROGRESS', 'message': f'[Trình duyệt {worker_id}] Đang khởi tạo...'})
+        driver = create_driver(browser_settings)
+        wait = WebDriverWait(driver, 15)
+        spans = SpanRecorder()
+        with spans.span('page_load'):
+            load_lookup_page(driver, rate_limiter, lookup_url)
+        event_queue.put({'status': 'PROGRESS', 'message': f'[Trình duyệt {worker_id}] Trang tra cứu đã sẵn sàng.', 'metrics': {'spans': spans.spans}})
+
+        while not stop_event.is_set():
+            try:
+                so_tk = task_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            event_queue.put({'status': 'PROGRESS', 'message': f'[Trình duyệt {worker_id}] Bắt đầu xử lý tờ khai {so_tk}'})
+            browser_lost = False
+            for event in lookup_declaration(driver, wait, so_tk, stop_event, None, result_cache, rate_limiter, readiness,
+                                            confidence_gate, lookup_url):
+                if event['status'] == 'STOPPED':
+                    return
+                if event['status'] == 'FATAL_ERROR':
+                    browser_lost = True
+                    break
+                event_queue.put(event)
+
+            if browser_lost:
+                # Trả tờ khai lại cho các trình duyệt còn hoạt động
+                task_queue.put(so_tk)
+                event_queue.put({'status': 'ERROR', 'message': f'[Trình duyệt {worker_id}] Mất kết nối, trả tờ khai {so_tk} về hàng đợi.'})
+                return
+            event_queue.put({'status': _TASK_DONE, 'so_tk': so_tk})
+
+    except Exception as e:
+        event_queue.put({'status': 'ERROR', 'message': f'[Trình duyệt {worker_id}] Lỗi Selenium/WebDriver: {e}'})
+    finally:
+        if driver:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+        event_queue.put({'status': _WORKER_EXIT, 'worker': worker_id})
+
+
+def run_pooled_processing(so_tk_list, stop_event, num_workers, rate_limiter, result_cache=None, browser_settings=None,
+                          confidence_gate=None):
+    """Tra cứu song song bằng `num_workers` trình duyệt; sinh ra sự kiện như `run_batch_processing`."""
+    so_tk_list = yield from serve_cached_results(so_tk_list, result_cache)
+    total_tk = len(so_tk_list)
+    if not so_tk_list:
+        yield {'status': 'DONE', 'message': 'Hoàn tất quá trình tra cứu.', 'value': 100}
+        return
+
+    os.makedirs(FAILED_CAPTCHA_FOLDER, exist_ok=True)
+    task_queue, event_queue = queue.Queue(), queue.Queue()
+    for so_tk in so_tk_list:
+        task_queue.put(so_tk)
+
+    readiness = ReadinessTracker()
+    num_workers = min(num_workers, total_tk)
+    yield {'status': 'PROGRESS', 'message': f'Khởi chạy {num_workers} trình duyệt song song cho {total_tk} tờ khai...', 'value': 0}
+    for worker_id in range(1, num_workers + 1):
+        threading.Thread(target=_browser_worker, daemon=True,
+                         args=(worker_id, task_queue, event_queue, stop_event, rate_limiter, result_cache, readiness, browser_settings,
+                               confidence_gate)).start()
+
+    finished, running = 0, num_workers
+    while running:
+        event = event_queue.get()
+        status = event['status']
+        if status == _WORKER_EXIT:
+            running -= 1
+        elif status == _TASK_DONE:
+            finished += 1
+        else:
+            event['value'] = int(finished / total_tk * 100)
+            yield event
+
+    if stop_event.is_set():
+        yield {'status': 'STOPPED', 'message': 'Người dùng đã yêu cầu dừng.'}
+        return
+    if not task_queue.empty():
+        yield {'status': 'FATAL_ERROR', 'message': f'Tất cả trình duyệt đã dừng, còn {task_queue.qsize()} tờ khai chưa được xử lý.'}
+    gate_summary = f' {confidence_gate.summary()}' if confidence_gate else ''
+    yield {'status': 'DONE', 'message': f'Hoàn tất quá trình tra cứu. {readiness.summary()}{gate_summary}', 'value': 100}